@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# ambiguity.py
+# range and velocity ambiguity of staggered PRI pulse sequences, per band
+
+import argparse
+import collections
+import sys
+import numpy
+import prettytable
+
+from parser import HeaderParseError, TCUParams, to_clock_ticks
+from validation import L_BAND_MODES, ParameterBatch
+
+SPEED_OF_LIGHT = 299792458.0
+
+BANDS = ('L', 'X')  # index 0: pol_mode 0-3, index 1: pol_mode 4 and up
+
+# ANALYSIS MODEL:
+# ---------------------
+# echoes of a band are only confused with echoes of earlier pulses of the
+# same band, so every band is analysed on the sequence of its own pulses:
+#
+# spacing             time from a pulse to the next pulse of its band,
+#                     cycling through the pulse block
+# unambiguous range   c * shortest spacing / 2
+# blind speed         first radial speed at which every spacing sees a whole
+#                     number of Doppler cycles: lambda / (2 * gcd(spacings)),
+#                     at the highest frequency of the band
+# duty cycle          transmit time of the band / pulse block
+# minimum range       c * longest pulse width / 2, echoes arriving during
+#                     their own main bang
+#
+# the receiver is blanked during every main bang, so the echo of each pulse
+# is eclipsed by the next main bang, of any band, between
+# c * (PRI - pulse_width) / 2 and c * (PRI + next pulse_width) / 2.
+# Times are the clock ticks loaded into the registers; bands without pulses
+# are NaN.
+
+# per band results are (N, 2) arrays, per pulse results (N, P) arrays
+Ambiguity = collections.namedtuple('Ambiguity', ['unambiguous_range', 'blind_speed', 'duty_cycle',
+                                                 'min_range', 'eclipse_start', 'eclipse_end'])
+
+
+def _gcd(a, b):
+    """ element-wise greatest common divisor of integer arrays """
+    a = numpy.abs(a)
+    b = numpy.abs(b)
+    while numpy.any(b):
+        nonzero = b != 0
+        a, b = numpy.where(nonzero, b, a), numpy.where(nonzero, a % numpy.where(nonzero, b, 1), 0)
+    return a
+
+
+def analyse_batch(batch):
+    """ returns the Ambiguity of every candidate of a validation.ParameterBatch
+
+        all candidates are analysed at once with array operations
+    """
+    active = batch.active()
+    num_rows, num_pulses = active.shape
+    clk_s = batch.clk_period_ns * 1e-9
+    pri = numpy.where(active, to_clock_ticks(batch.pri, batch.clk_period_ns), 0)
+    pulse_width = numpy.where(active, to_clock_ticks(batch.pulse_width, batch.clk_period_ns), 0)
+    start = numpy.cumsum(pri, axis=1) - pri
+    block = pri.sum(axis=1)[:, None]
+    band = (batch.pol_mode >= L_BAND_MODES).astype(numpy.int64)
+
+    # the next pulse of any band, and its width
+    next_pulse = numpy.arange(1, num_pulses + 1) % numpy.maximum(active.sum(axis=1), 1)[:, None]
+    rows = numpy.arange(num_rows)[:, None]
+    next_width = pulse_width[rows, next_pulse]
+    eclipse_start = numpy.where(active, SPEED_OF_LIGHT * (pri - pulse_width) * clk_s / 2, numpy.nan)
+    eclipse_end = numpy.where(active, SPEED_OF_LIGHT * (pri + next_width) * clk_s / 2, numpy.nan)
+
+    # pulse block repeated once, so the next pulse of a band always follows
+    start2 = numpy.concatenate([start, start + block], axis=1)
+    positions = numpy.arange(2 * num_pulses)
+    shape = (num_rows, len(BANDS))
+    unambiguous_range = numpy.full(shape, numpy.nan)
+    blind_speed = numpy.full(shape, numpy.nan)
+    duty_cycle = numpy.full(shape, numpy.nan)
+    min_range = numpy.full(shape, numpy.nan)
+    for index in range(len(BANDS)):
+        in_band = active & (band == index)
+        present = in_band.any(axis=1)
+        in_band2 = numpy.concatenate([in_band, in_band], axis=1)
+        # position of the first pulse of the band at or after each position
+        following = numpy.where(in_band2, positions, 2 * num_pulses)
+        following = numpy.minimum.accumulate(following[:, ::-1], axis=1)[:, ::-1]
+        next_in_band = numpy.minimum(following[:, 1:num_pulses + 1], 2 * num_pulses - 1)
+        spacing = numpy.where(in_band, start2[rows, next_in_band] - start, 0)
+
+        divisor = numpy.zeros(num_rows, dtype=numpy.int64)
+        for column in range(num_pulses):
+            divisor = _gcd(divisor, spacing[:, column])
+        shortest = numpy.where(in_band, spacing, numpy.iinfo(numpy.int64).max).min(axis=1)
+        frequency = numpy.where(in_band, batch.frequency, 0).max(axis=1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            wavelength = SPEED_OF_LIGHT / (frequency * 1e6)
+            blind = wavelength / (2 * divisor * clk_s)
+            duty = numpy.where(in_band, pulse_width, 0).sum(axis=1) / block[:, 0]
+        widest = numpy.where(in_band, pulse_width, 0).max(axis=1)
+        unambiguous_range[:, index] = numpy.where(present, SPEED_OF_LIGHT * shortest * clk_s / 2, numpy.nan)
+        blind_speed[:, index] = numpy.where(present & (divisor > 0), blind, numpy.nan)
+        duty_cycle[:, index] = numpy.where(present, duty, numpy.nan)
+        min_range[:, index] = numpy.where(present, SPEED_OF_LIGHT * widest * clk_s / 2, numpy.nan)
+    return Ambiguity(unambiguous_range, blind_speed, duty_cycle, min_range, eclipse_start, eclipse_end)
+
+
+def analyse(tcu_params):
+    """ returns the Ambiguity of a single TCUParams """
+    return analyse_batch(ParameterBatch.from_params([tcu_params], tcu_params.clk_period_ns))
+
+
+def pri_set_batch(tcu_params, pri_sets):
+    """ returns a ParameterBatch of tcu_params with every PRI set of pri_sets
+
+        pri_sets is an (N, P) array of PRIs in microseconds, one row per
+        candidate, for the first P pulses of tcu_params. Built directly from
+        arrays, so tens of thousands of candidates cost a few array copies.
+    """
+    pri_sets = numpy.atleast_2d(numpy.asarray(pri_sets, dtype=numpy.float64))
+    num_rows, num_pulses = pri_sets.shape
+    base = ParameterBatch.from_params([tcu_params], tcu_params.clk_period_ns)
+    if num_pulses > base.pri.shape[1]:
+        raise ValueError('PRI sets of {} pulses, but only {} pulses are defined'
+                         .format(num_pulses, base.pri.shape[1]))
+    scalars = dict((name, numpy.repeat(getattr(base, name), num_rows)) for name in ParameterBatch.SCALARS)
+    scalars['num_pulses'] = numpy.minimum(scalars['num_pulses'], num_pulses)
+    pulses = dict()
+    for field in ('pulse_width', 'pol_mode', 'frequency'):
+        pulses[field] = numpy.repeat(getattr(base, field)[:, :num_pulses], num_rows, axis=0)
+    pulses['pri'] = pri_sets
+    return ParameterBatch(scalars, pulses, numpy.full(num_rows, num_pulses), tcu_params.clk_period_ns)
+
+
+def format_ambiguity(ambiguity, candidate=0):
+    """ returns the per band results of a candidate as a table """
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Band', 'Unambiguous Range [km]', 'Blind Speed [m/s]', 'Duty Cycle [%]',
+                          'Minimum Range [m]']
+    for index, band in enumerate(BANDS):
+        if numpy.isnan(ambiguity.duty_cycle[candidate, index]):
+            continue
+        ptable.add_row([band,
+                        '{:.2f}'.format(ambiguity.unambiguous_range[candidate, index] / 1000),
+                        '{:.2f}'.format(ambiguity.blind_speed[candidate, index]),
+                        '{:.3f}'.format(100 * ambiguity.duty_cycle[candidate, index]),
+                        '{:.0f}'.format(ambiguity.min_range[candidate, index])])
+    return str(ptable)
+
+
+def format_eclipses(ambiguity, candidate=0):
+    """ returns the eclipsed ranges of every pulse of a candidate as a table """
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Pulse', 'Eclipsed From [km]', 'Eclipsed To [km]']
+    for pulse in range(ambiguity.eclipse_start.shape[1]):
+        if numpy.isnan(ambiguity.eclipse_start[candidate, pulse]):
+            continue
+        ptable.add_row([pulse, '{:.3f}'.format(ambiguity.eclipse_start[candidate, pulse] / 1000),
+                        '{:.3f}'.format(ambiguity.eclipse_end[candidate, pulse] / 1000)])
+    return str(ptable)
+
+
+if __name__ == '__main__':
+    clargparser = argparse.ArgumentParser(usage='ambiguity.py HEADER',
+                                          description='Blind ranges, blind speeds and range '
+                                                      'ambiguity of a NeXtRAD header file')
+    clargparser.add_argument('headerfile', help='header file to analyse')
+    args = clargparser.parse_args()
+
+    try:
+        tcu_params = TCUParams(args.headerfile)
+    except HeaderParseError as e:
+        sys.stderr.write('failed to parse header file: {}\n'.format(e))
+        sys.exit(65)
+    ambiguity = analyse(tcu_params)
+    print(format_ambiguity(ambiguity))
+    print(format_eclipses(ambiguity))
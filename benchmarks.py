@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+# benchmarks.py
+# timing benchmarks for the header parsing and register encoding paths
+
+import argparse
+import collections
+import json
+import os.path
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import struct
+import prettytable
+
+from ioreg import IORegBatch
+from parser import HeaderFileParser, ParamsSnapshot, TCUParams, header_cache
+from registers import MAX_PULSES, REGISTER_OFFSETS, SCALAR_REGISTERS, ShadowRegisters, encode_registers
+
+
+def write_synthetic_header(file_name, num_pulses, num_repeats=75000):
+    """ writes a NeXtRAD.ini style header with num_pulses pulses """
+    pulses = list()
+    for index in range(num_pulses):
+        pol_mode = index % 8
+        frequency = 1300.0 if pol_mode < 4 else 8500.0
+        pulses.append('10.0,{},{},{}'.format(500.0 + 10 * index, pol_mode, frequency))
+    with open(file_name, 'w') as header_file:
+        header_file.write('[PulseParameters]\n'
+                          'WAVEFORM_INDEX = 5\n'
+                          'NUM_PRIS = {}\n'
+                          'PRE_PULSE = 30\n'
+                          'PRI_PULSE_WIDTH = 100\n'
+                          'X_AMP_DELAY = 3.5\n'
+                          'L_AMP_DELAY = 1.0\n'
+                          'REX_DELAY = 1.0\n'
+                          'DAC_DELAY = 1\n'
+                          'ADC_DELAY = 372\n'
+                          'SAMPLES_PER_PRI = 2048\n'
+                          'PULSES = "{}"\n'.format(num_pulses * num_repeats, '|'.join(pulses)))
+
+
+def legacy_pulses_bytes(tcu_params):
+    """ reg_pulses contents built the way write_registers used to build them """
+    pulse_param_str = str()
+    for pulse in tcu_params.get_hex_params()['pulses']:
+        pulse_param_str += pulse['pulse_width'].replace('\\x', '') \
+                           + pulse['pri'].replace('\\x', '') \
+                           + pulse['pol_mode'].replace('\\x', '') \
+                           + pulse['frequency'].replace('\\x', '')
+    return bytearray.fromhex(pulse_param_str)
+
+
+def time_call(func, number, repeat=5):
+    """ returns the best time per call of func, in microseconds """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def time_auto(func, min_time=0.05, repeat=5):
+    """ returns the best time per call of func in microseconds, calling it
+        often enough for each timing run to take at least min_time seconds
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+    return time_call(func, number, repeat)
+
+
+def _fresh_hfparser(file_name):
+    hfparser = HeaderFileParser()
+    hfparser.read_header(file_name)
+    return hfparser
+
+
+# name -> setup(file_name, tmp_dir) returning the function to time. Derived
+# forms of TCUParams are memoised, so their benchmarks time the computation.
+SUITE = collections.OrderedDict([
+    ('read_header', lambda file_name, tmp_dir: lambda: HeaderFileParser().read_header(file_name)),
+    ('get_tcu_params', lambda file_name, tmp_dir: _fresh_hfparser(file_name).get_tcu_params),
+    ('TCUParams.__init__', lambda file_name, tmp_dir: lambda: TCUParams(file_name, cache=None)),
+    ('TCUParams.__init__ (cached)', lambda file_name, tmp_dir: lambda: TCUParams(file_name)),
+    ('get_int_params', lambda file_name, tmp_dir: TCUParams(file_name, cache=None)._int_params),
+    ('get_hex_params', lambda file_name, tmp_dir: lambda tcu_params=TCUParams(file_name, cache=None):
+        tcu_params._hex_params(False)),
+    ('_int_to_hex_str', lambda file_name, tmp_dir: lambda tcu_params=TCUParams(file_name, cache=None):
+        tcu_params._int_to_hex_str(tcu_params.num_repeats, bytes=4)),
+    ('__str__', lambda file_name, tmp_dir: TCUParams(file_name, cache=None)._to_table_str),
+    ('export', lambda file_name, tmp_dir: TCUParams(file_name, cache=None,
+                                                    outputfile=os.path.join(tmp_dir, 'export.ini')).export),
+    ('to_pulses_string', lambda file_name, tmp_dir: TCUParams(file_name, cache=None).to_pulses_string),
+    ('encode_registers', lambda file_name, tmp_dir: lambda int_params=TCUParams(file_name, cache=None)
+        .get_int_params(): encode_registers(int_params)),
+])
+
+
+def run_suite(pulse_counts, names=None, min_time=0.05, repeat=5):
+    """ times every SUITE benchmark on synthetic headers with each number
+        of pulses
+
+        returns a list of {'benchmark', 'num_pulses', 'us_per_call'} records
+    """
+    results = list()
+    header_cache.clear()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_pulses in pulse_counts:
+            file_name = os.path.join(tmp_dir, 'NeXtRAD_{}.ini'.format(num_pulses))
+            write_synthetic_header(file_name, num_pulses)
+            for name in names or SUITE:
+                func = SUITE[name](file_name, tmp_dir)
+                results.append({'benchmark': name, 'num_pulses': num_pulses,
+                                'us_per_call': time_auto(func, min_time, repeat)})
+    return results
+
+
+def suite_report(results):
+    """ returns the suite results with a description of where they were run """
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """ compares suite results with a baseline report
+
+        returns a list of (benchmark, num_pulses, baseline us, us, ratio,
+        regressed) rows; a benchmark regressed if it got slower by more than
+        threshold (a fraction).
+    """
+    baseline_times = dict(((record['benchmark'], record['num_pulses']), record['us_per_call'])
+                          for record in baseline['results'])
+    rows = list()
+    for record in results:
+        key = (record['benchmark'], record['num_pulses'])
+        if key not in baseline_times:
+            continue
+        ratio = record['us_per_call'] / baseline_times[key]
+        rows.append(key + (baseline_times[key], record['us_per_call'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def benchmark_encoder(pulse_counts, number):
+    """ compares the hex string pipeline with the struct based encoder
+
+        returns a list of (num_pulses, legacy_us, encoder_us) rows
+    """
+    rows = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_pulses in pulse_counts:
+            file_name = os.path.join(tmp_dir, 'NeXtRAD_{}.ini'.format(num_pulses))
+            write_synthetic_header(file_name, num_pulses)
+            tcu_params = TCUParams(file_name, cache=None)
+            int_params = tcu_params.get_int_params()
+            if bytes(legacy_pulses_bytes(tcu_params)) != bytes(encode_registers(int_params)['pulses']):
+                raise AssertionError('encoder output differs from legacy path '
+                                     'for {} pulses'.format(num_pulses))
+            legacy = time_call(lambda: legacy_pulses_bytes(tcu_params), number)
+            encoder = time_call(lambda: encode_registers(tcu_params.get_int_params()), number)
+            encoder_only = time_call(lambda: encode_registers(int_params), number)
+            rows.append((num_pulses, legacy, encoder, encoder_only))
+    return rows
+
+
+def ioreg_output(batch, failed=()):
+    """ returns what the ssh link to a RHINO returns for batch.command():
+        the echoed command and a status line per write
+    """
+    return ('$ ' + batch.command() + '\r\n' +
+            ''.join('ioreg {} {}\r\n'.format(index, 1 if index in failed else 0)
+                    for index in range(len(batch)))).encode()
+
+
+def register_write_operations(num_pulses=MAX_PULSES):
+    """ returns (operation, shadow, image, fixed writes) for the register
+        writes of the controller, on a synthetic header
+
+        operations with an image write what shadow.diff(image) reports, the
+        others write the fixed (register, data) pairs
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'NeXtRAD.ini')
+        write_synthetic_header(file_name, num_pulses)
+        tcu_params = TCUParams(file_name, cache=None)
+    image = tcu_params.get_register_image()
+    confirmed = ShadowRegisters()
+    for name in REGISTER_OFFSETS:
+        confirmed.update(name, image[name])
+    tcu_params.num_repeats += 1
+    repeats_image = tcu_params.get_register_image()
+    tcu_params.pulses[num_pulses // 2]['frequency'] += 10
+    pulse_image = tcu_params.get_register_image()
+    return [('write_registers (all)', ShadowRegisters(), image, None),
+            ('write_registers (num_repeats)', confirmed, repeats_image, None),
+            ('write_registers (num_repeats, 1 pulse)', confirmed, pulse_image, None),
+            ('arm', None, None, [('instruction', struct.pack('<H', 0)), ('instruction', struct.pack('<H', 1))]),
+            ('abort', None, None, [('num_repeats', struct.pack('<' + SCALAR_REGISTERS['num_repeats'], 1))])]
+
+
+def benchmark_register_writes(number):
+    """ times building and parsing the batched remote command of the
+        controller's register writes, see ioreg.IORegBatch
+
+        the commands themselves are not sent. Per-register writes, the way
+        harpoon.Register.write does them, take one remote command each,
+        batched writes one in all. Returns a list of (operation, writes,
+        command bytes, diff and write() us, command() us, parse() us) rows
+    """
+    rows = list()
+    for operation, shadow, image, writes in register_write_operations():
+
+        def build():
+            batch = IORegBatch('1234')
+            if image is None:
+                for name, data in writes:
+                    batch.write(name, data)
+            else:
+                batch.write_changes(image, shadow.diff(image))
+            return batch
+
+        batch = build()
+        output = ioreg_output(batch)
+        if not all(written for _, _, _, written in batch.parse(output)):
+            raise AssertionError('{}: status lines not parsed'.format(operation))
+        rows.append((operation, len(batch), len(batch.command()), time_call(build, number),
+                     time_call(batch.command, number), time_call(lambda: batch.parse(output), number)))
+    return rows
+
+
+def allocated_bytes(build):
+    """ returns the result of build() and the bytes it allocated and kept """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def benchmark_memory(num_configs, num_pulses=MAX_PULSES):
+    """ compares the memory held per configuration by TCUParams objects,
+        get_tcu_params() dictionaries and ParamsSnapshots
+
+        returns a list of (representation, bytes per configuration) rows
+    """
+    rows = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'NeXtRAD.ini')
+        write_synthetic_header(file_name, num_pulses)
+        params = HeaderFileParser(file_name).get_tcu_params()
+
+        def variations(index):
+            # distinct values, so nothing is shared between configurations
+            varied = dict(params, num_repeats=index + 1)
+            varied['pulses'] = [dict(pulse, pri=pulse['pri'] + index) for pulse in params['pulses']]
+            return varied
+
+        configs, size = allocated_bytes(lambda: [TCUParams(file_name, cache=None) for _ in range(num_configs)])
+        rows.append(('TCUParams', size / num_configs))
+        del configs
+        configs, size = allocated_bytes(lambda: [variations(index) for index in range(num_configs)])
+        rows.append(('dict', size / num_configs))
+        snapshots, size = allocated_bytes(lambda: [ParamsSnapshot.from_dict(config) for config in configs])
+        rows.append(('ParamsSnapshot', size / num_configs))
+    return rows
+
+
+if __name__ == '__main__':
+    clargparser = argparse.ArgumentParser(usage='benchmarks.py [-n NUMBER] [-s] [-o JSON] [-c BASELINE]',
+                                          description='Benchmarks for the TCU '
+                                                      'parameter and register paths')
+    clargparser.add_argument('-n', '--number', type=int, default=2000,
+                             help='calls per timing run of the encoder comparison [2000]')
+    clargparser.add_argument('-m', '--memory', type=int, default=0, metavar='CONFIGS',
+                             help='also measure memory per configuration over CONFIGS configurations')
+    clargparser.add_argument('-s', '--suite', action='store_true', default=False,
+                             help='run the parser, encoder and formatting suite instead')
+    clargparser.add_argument('-b', '--benchmarks',
+                             help='comma separated suite benchmarks to run [all]')
+    clargparser.add_argument('-p', '--pulses', default='1:{}'.format(MAX_PULSES),
+                             help='pulse counts of the suite, "N" or "FIRST:LAST" [1:{}]'.format(MAX_PULSES))
+    clargparser.add_argument('-o', '--output', help='write the suite results as JSON to this file')
+    clargparser.add_argument('-c', '--compare', metavar='BASELINE',
+                             help='compare the suite with the JSON results of an earlier run')
+    clargparser.add_argument('-t', '--threshold', type=float, default=0.1,
+                             help='slowdown counted as a regression when comparing [0.1]')
+    clargparser.add_argument('-w', '--writes', action='store_true', default=False,
+                             help='also count the remote commands of register writes and time '
+                                  'building and parsing the batched command')
+    args = clargparser.parse_args()
+
+    if args.suite or args.output or args.compare:
+        first, _, last = args.pulses.partition(':')
+        pulse_counts = range(int(first), int(last or first) + 1)
+        names = args.benchmarks.split(',') if args.benchmarks else None
+        unknown = set(names or ()) - set(SUITE)
+        if unknown:
+            clargparser.error('unknown benchmark(s): {}'.format(', '.join(sorted(unknown))))
+        results = run_suite(pulse_counts, names)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(suite_report(results), output_file, indent=2)
+        ptable = prettytable.PrettyTable()
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                rows = compare_results(json.load(baseline_file), results, args.threshold)
+            ptable.field_names = ['Benchmark', 'Pulses', 'Baseline [us]', 'Now [us]', 'Ratio', '']
+            for name, num_pulses, before, now, ratio, regressed in rows:
+                ptable.add_row([name, num_pulses, '{:.2f}'.format(before), '{:.2f}'.format(now),
+                                '{:.2f}'.format(ratio), 'REGRESSION' if regressed else ''])
+            ptable.align['Benchmark'] = 'l'
+            print(ptable)
+            sys.exit(1 if any(row[-1] for row in rows) else 0)
+        ptable.field_names = ['Benchmark', 'Pulses', 'Time [us]']
+        ptable.align['Benchmark'] = 'l'
+        for record in results:
+            ptable.add_row([record['benchmark'], record['num_pulses'], '{:.2f}'.format(record['us_per_call'])])
+        print(ptable)
+        sys.exit(0)
+
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Pulses', 'Hex strings [us]', 'Encoder + get_int_params [us]',
+                          'Encoder only [us]', 'Speedup']
+    for num_pulses, legacy, encoder, encoder_only in benchmark_encoder(range(1, MAX_PULSES + 1),
+                                                                       args.number):
+        ptable.add_row([num_pulses, '{:.2f}'.format(legacy), '{:.2f}'.format(encoder),
+                        '{:.2f}'.format(encoder_only), '{:.1f}x'.format(legacy / encoder)])
+    print(ptable)
+
+    if args.memory:
+        ptable = prettytable.PrettyTable()
+        ptable.field_names = ['Representation ({} pulses)'.format(MAX_PULSES), 'Bytes per configuration']
+        for name, size in benchmark_memory(args.memory):
+            ptable.add_row([name, '{:.0f}'.format(size)])
+        print(ptable)
+
+    if args.writes:
+        ptable = prettytable.PrettyTable()
+        ptable.field_names = ['Operation', 'Per-register commands', 'Batched commands', 'Command bytes',
+                              'Diff + write() [us]', 'command() [us]', 'parse() [us]']
+        for operation, writes, command_bytes, diff, command, parse in benchmark_register_writes(args.number):
+            ptable.add_row([operation, writes, 1, command_bytes, '{:.2f}'.format(diff),
+                            '{:.2f}'.format(command), '{:.2f}'.format(parse)])
+        ptable.align['Operation'] = 'l'
+        print(ptable)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+# compiler.py
+# parses, validates and encodes batches of header files into register images
+
+import argparse
+import concurrent.futures
+import csv
+import fnmatch
+import glob
+import logging
+import os
+import os.path
+import re
+import sys
+import time
+
+from parser import DEFAULT_CLK_PERIOD_NS, HeaderParseError, TCUParams
+from validation import format_violation, validate
+
+logger = logging.getLogger('tcu_compiler_logger')
+
+REPORT_FIELDS = ['header', 'node', 'status', 'num_pulses', 'num_repeats', 'image', 'message']
+
+
+def iter_header_files(paths, pattern='*.ini', recursive=False):
+    """ yields (header file, root) for every header in the given paths
+
+        directories are searched for files matching pattern, anything else is
+        treated as a glob. root is the directory output paths are made
+        relative to. Files are yielded lazily, so the inputs are never held
+        in memory as a whole.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                walker = os.walk(path)
+            else:
+                walker = [(path, None, os.listdir(path))]
+            for directory, _, file_names in walker:
+                for file_name in sorted(fnmatch.filter(file_names, pattern)):
+                    yield os.path.join(directory, file_name), path
+        else:
+            for file_name in glob.iglob(path, recursive=True):
+                if os.path.isfile(file_name):
+                    yield file_name, glob_root(path)
+
+
+def glob_root(pattern):
+    """ returns the leading part of a glob pattern that contains no wildcards
+
+        for a plain file name this is the directory holding the file
+    """
+    root = list()
+    parts = pattern.split(os.sep)
+    for part in parts:
+        if any(char in part for char in '*?['):
+            break
+        root.append(part)
+    if len(root) == len(parts):
+        root.pop()
+    return os.sep.join(root) or os.curdir
+
+
+def compile_header(header, output_file=None, clk_period_ns=None):
+    """ parses, validates and encodes a single header file
+
+        writes the register image to output_file if given and returns a
+        dictionary with the REPORT_FIELDS of the result. clk_period_ns
+        overrides the CLK_PERIOD_NS of the header
+    """
+    # failures are returned in the results, not logged by each worker
+    logging.getLogger('header_file_parser_logger').setLevel(logging.CRITICAL)
+    result = _new_result(header)
+    try:
+        if not os.path.isfile(header):
+            raise HeaderParseError('header file not found', header)
+        tcu_params = TCUParams(header, cache=None, clk_period_ns=clk_period_ns)
+    except HeaderParseError as e:
+        result['message'] = str(e)
+        return result
+    return _encode(tcu_params, result, output_file)
+
+
+def compile_nodes(header, output_file=None, clk_period_ns=None):
+    """ parses, validates and encodes every node of a multi-node header
+
+        the header is parsed once for all of its [PulseParameters:<node>]
+        sections, see TCUParams.for_nodes(). The image of each node is
+        written next to output_file, see node_image_path(). Returns a list
+        of REPORT_FIELDS dictionaries, one per node; a header without node
+        sections is compiled like compile_header().
+    """
+    logging.getLogger('header_file_parser_logger').setLevel(logging.CRITICAL)
+    result = _new_result(header)
+    try:
+        if not os.path.isfile(header):
+            raise HeaderParseError('header file not found', header)
+        nodes = TCUParams.for_nodes(header, clk_period_ns=clk_period_ns)
+    except HeaderParseError as e:
+        result['message'] = str(e)
+        return [result]
+    if not nodes:
+        return [compile_header(header, output_file, clk_period_ns)]
+    results = list()
+    for node, tcu_params in nodes.items():
+        result = _new_result(header, node)
+        node_file = None if output_file is None else node_image_path(output_file, node)
+        results.append(_encode(tcu_params, result, node_file))
+    return results
+
+
+def _new_result(header, node=''):
+    return {'header': header, 'node': node, 'status': 'error', 'num_pulses': '',
+            'num_repeats': '', 'image': '', 'message': ''}
+
+
+def _encode(tcu_params, result, output_file):
+    """ validates and encodes tcu_params, filling in and returning result """
+    header = result['header']
+    if result['node']:
+        header = '{} [{}]'.format(header, result['node'])
+    try:
+        if not tcu_params.hfparser.section_found:
+            raise HeaderParseError('no "PulseParameters" section found', header)
+        header_violations = validate(tcu_params)
+        if header_violations:
+            raise HeaderParseError('; '.join(format_violation(violation)
+                                             for violation in header_violations), header)
+        image = tcu_params.get_register_image()
+    except HeaderParseError as e:
+        result['message'] = str(e)
+        return result
+    except ValueError as e:
+        result['message'] = '{}: {}'.format(header, e)
+        return result
+    result['num_pulses'] = tcu_params.num_pulses
+    result['num_repeats'] = tcu_params.num_repeats
+    if output_file is not None:
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(output_file, 'wb') as image_file:
+            image_file.write(image.buffer)
+        result['image'] = output_file
+    result['status'] = 'ok'
+    return result
+
+
+def image_path(header, root, output_dir):
+    """ returns where the register image of header is written
+
+        the layout of the input below root is mirrored in output_dir
+    """
+    relative = os.path.relpath(header, root)
+    if relative.startswith(os.pardir):
+        relative = os.path.abspath(header).lstrip(os.sep)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + '.bin')
+
+
+def node_image_path(output_file, node):
+    """ returns where the register image of a node is written, given the
+        image path of its header: <header>.<node>.bin
+    """
+    base, extension = os.path.splitext(output_file)
+    return '{}.{}{}'.format(base, re.sub(r'[^0-9A-Za-z_.-]+', '_', node), extension)
+
+
+def pool_map(func, args, jobs=None, window=None):
+    """ calls func(*arguments) for every tuple of arguments in args in a
+        process pool, yielding the results as they complete
+
+        args is only advanced when a call is submitted and at most 'window'
+        calls are in flight, so memory use does not grow with the number of
+        calls and arguments may depend on the results yielded so far.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    window = window or 2 * jobs
+    args = iter(args)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                try:
+                    arguments = next(args)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(func, *arguments))
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def compile_headers(headers, output_dir=None, jobs=None, window=None, nodes=False, clk_period_ns=None):
+    """ compiles (header, root) pairs in a process pool, yielding results
+
+        results are yielded as they complete. At most 'window' headers are
+        in flight at any time, so memory use does not grow with the number of
+        headers. With nodes set, every node of multi-node headers is
+        compiled, see compile_nodes(). clk_period_ns overrides the clock
+        period of every header.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    tasks = ((header, None if output_dir is None else image_path(header, root, output_dir), clk_period_ns)
+             for header, root in headers)
+    for results in pool_map(compile_nodes if nodes else compile_header, tasks, jobs, window or 4 * jobs):
+        for result in results if nodes else [results]:
+            yield result
+
+
+if __name__ == '__main__':
+
+    # -------------------------------------------------------------------------
+    # PARSE COMMAND LINE ARGUMENTS
+    # -------------------------------------------------------------------------
+    clargparser = argparse.ArgumentParser(usage='compiler.py [-o DIR] [-r REPORT] PATH [PATH ...]',
+                                          description='Batch compiler for NeXtRAD '
+                                                      'header files')
+    clargparser.add_argument('paths', nargs='+',
+                             help='header files, directories or glob patterns')
+    clargparser.add_argument('-o', '--outputdir',
+                             help='directory for the compiled register images, '
+                                  'headers are only validated if not given')
+    clargparser.add_argument('-r', '--report', default='compile_report.csv',
+                             help='summary report [./compile_report.csv]')
+    clargparser.add_argument('-p', '--pattern', default='*.ini',
+                             help='file pattern used in directories [*.ini]')
+    clargparser.add_argument('-R', '--recursive', action='store_true', default=False,
+                             help='search directories recursively')
+    clargparser.add_argument('-j', '--jobs', type=int, default=None,
+                             help='number of worker processes [cpu count]')
+    clargparser.add_argument('-N', '--nodes', action='store_true', default=False,
+                             help='compile every [PulseParameters:<node>] section of '
+                                  'multi-node headers to <header>.<node>.bin')
+    clargparser.add_argument('-c', '--clk-period', type=float, metavar='NS',
+                             help='clock period in ns [CLK_PERIOD_NS of each header, or {}]'
+                                  .format(DEFAULT_CLK_PERIOD_NS))
+    clargparser.add_argument('-q', '--quiet', action='store_true', default=False,
+                             help='only display failures and the summary')
+    args = clargparser.parse_args()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(console)
+    logger.setLevel(logging.INFO)
+
+    num_ok = 0
+    num_errors = 0
+    start_time = time.time()
+    with open(args.report, 'w', newline='') as report_file:
+        report = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+        report.writeheader()
+        headers = iter_header_files(args.paths, args.pattern, args.recursive)
+        for result in compile_headers(headers, args.outputdir, args.jobs, nodes=args.nodes,
+                                      clk_period_ns=args.clk_period):
+            report.writerow(result)
+            if result['status'] == 'ok':
+                num_ok += 1
+                if not args.quiet:
+                    header = result['header']
+                    if result['node']:
+                        header = '{} [{}]'.format(header, result['node'])
+                    logger.info('{} -> {}'.format(header, result['image'] or 'valid'))
+            else:
+                num_errors += 1
+                logger.error(result['message'])
+    elapsed = time.time() - start_time
+
+    total = num_ok + num_errors
+    logger.info('compiled {} header(s): {} ok, {} failed in {:.2f}s ({:.1f} files/s), '
+                'report written to {}'.format(total, num_ok, num_errors, elapsed,
+                                              total / elapsed if elapsed > 0 else 0.0,
+                                              args.report))
+    sys.exit(0 if num_errors == 0 else 65)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# conflicts.py
+# interval based detection of timing conflicts within the pulse sequence
+
+import argparse
+import sys
+import numpy
+import prettytable
+
+from timeline import L_BAND_MODES
+
+# INTERVAL MODEL:
+# ---------------------
+# all times are in clock ticks from the start of the pulse block, see
+# timeline.py for the events of a PRI
+#
+# pri          [PRI start, next PRI start)
+# main bang    [PRI start + pre_pulse, main bang + pulse_width)
+# amp off      main bang end + x_amp_delay or l_amp_delay (one tick)
+# rex          main bang end + rex_delay (one tick)
+# adc          [main bang + adc_delay, + samples_per_pri * ADC_TICKS_PER_SAMPLE)
+#
+# the amp off, rex and adc intervals of a pulse must not overlap the main
+# bang of any other pulse, in its own pulse block or the next one, and
+# sampling must end within the PRI.
+
+# the ADC is assumed to be clocked by the TCU clock, one sample per tick.
+# This is not confirmed, so the controllers only warn about timing conflicts
+# (validation.WARNING_RULES)
+ADC_TICKS_PER_SAMPLE = 1
+
+INTERVALS = ('pri', 'main_bang', 'amp_off', 'rex', 'adc')
+
+
+def pulse_intervals(batch, registers):
+    """ returns interval name -> (start, end) of every pulse of a
+        validation.ParameterBatch, as (N, P) arrays of ticks
+
+        registers are the batch's register_values(). Pulses that are not
+        loaded into reg_pulses take no time.
+    """
+    active = batch.active()
+    pulses = registers['pulses']
+    pre_pulse = registers['pre_pulse'][:, None]
+    pri_ticks = numpy.where(active, pre_pulse + pulses['pulse_width'] + pulses['pri'], 0)
+    pri_start = numpy.cumsum(pri_ticks, axis=1) - pri_ticks
+    main_bang = pri_start + pre_pulse
+    main_bang_end = main_bang + pulses['pulse_width']
+    amp_delay = numpy.where(batch.pol_mode < L_BAND_MODES, registers['l_amp_delay'][:, None],
+                            registers['x_amp_delay'][:, None])
+    amp_off = main_bang_end + amp_delay
+    rex = main_bang_end + registers['rex_delay'][:, None]
+    adc = main_bang + batch.adc_delay.astype(numpy.int64)[:, None]
+    adc_end = adc + batch.samples_per_pri.astype(numpy.int64)[:, None] * ADC_TICKS_PER_SAMPLE
+    return {'pri': (pri_start, pri_start + pri_ticks),
+            'main_bang': (main_bang, main_bang_end),
+            'amp_off': (amp_off, amp_off + 1),
+            'rex': (rex, rex + 1),
+            'adc': (adc, adc_end)}
+
+
+def first_overlaps(query_start, query_end, window_start, window_end, window_valid, own):
+    """ finds the first window overlapping each query interval, ignoring
+        the query's own window
+
+        queries are (N, Q) arrays and windows (N, W) arrays, own is the
+        (N, Q) index of the window each query belongs to or -1. Returns the
+        (N, Q) index of the first overlapping window, or -1 if there is none.
+
+        All rows are laid out end to end on one axis, so the windows are
+        sorted once and every query is answered with two binary searches:
+        O((Q + W) log W) for the whole batch. The result is exact when the
+        windows of a row do not overlap each other.
+    """
+    num_rows, num_windows = window_start.shape
+    if query_start.size == 0 or window_start.size == 0:
+        return numpy.full(query_start.shape, -1, dtype=numpy.int64)
+    lowest = min(query_start.min(), window_start.min())
+    highest = max(query_end.max(), window_end.max())
+    stride = int(highest - lowest) + 2
+    # windows that do not exist sit empty at the end of their row
+    window_start = numpy.where(window_valid, window_start - lowest, stride - 1)
+    window_end = numpy.where(window_valid, window_end - lowest, stride - 1)
+    row_offset = (numpy.arange(num_rows, dtype=numpy.int64) * stride)[:, None]
+
+    flat_start = (window_start + row_offset).ravel()
+    order = numpy.argsort(flat_start, kind='mergesort')
+    sorted_start = flat_start[order]
+    sorted_end = numpy.maximum.accumulate((window_end + row_offset).ravel()[order])
+
+    query_start = query_start - lowest + row_offset
+    query_end = query_end - lowest + row_offset
+    first = numpy.searchsorted(sorted_end, query_start, side='right')
+    stop = numpy.searchsorted(sorted_start, query_end, side='left')
+    row_first = (numpy.arange(num_rows, dtype=numpy.int64) * num_windows)[:, None]
+    own_flat = numpy.where(own < 0, -1, own + row_first)
+    is_own = order[numpy.minimum(first, len(order) - 1)] == own_flat
+    first = first + (is_own & (first < stop))
+    found = (first < stop) & (query_end > query_start)
+    index = order[numpy.minimum(first, len(order) - 1)] - row_first
+    return numpy.where(found, index, -1)
+
+
+def find_conflicts(batch, registers):
+    """ returns the timing conflicts of every candidate of a batch as a list
+        of (field, (N, P) mask, (N, P) values, message)
+
+        values are ticks from the start of the pulse's PRI. The main bangs
+        of the next pulse block are only considered when there is one.
+    """
+    intervals = pulse_intervals(batch, registers)
+    active = batch.active()
+    num_pulses = active.shape[1]
+    pri_start, pri_end = intervals['pri']
+    main_bang, main_bang_end = intervals['main_bang']
+
+    # main bangs of this pulse block followed by those of the next one
+    repeat_ticks = pri_end[:, -1:] if num_pulses else numpy.zeros((len(active), 1), dtype=numpy.int64)
+    next_block = active & (batch.num_repeats[:, None] > 1)
+    window_start = numpy.concatenate([main_bang, main_bang + repeat_ticks], axis=1)
+    window_end = numpy.concatenate([main_bang_end, main_bang_end + repeat_ticks], axis=1)
+    window_valid = numpy.concatenate([active, next_block], axis=1)
+    own = numpy.broadcast_to(numpy.arange(num_pulses), active.shape)
+    rows = numpy.arange(len(active))[:, None]
+
+    checks = list()
+    adc_start, adc_end = intervals['adc']
+    checks.append(('samples_per_pri', active & (adc_end > pri_end), adc_end - pri_start,
+                   'ADC sampling ends at this tick of the PRI, after its end'))
+    for name, field, message in (('adc', 'adc_delay', 'ADC sampling overlaps the main bang of another '
+                                                      'pulse at this tick of the PRI'),
+                                 ('amp_off', 'amp_delay', 'amplifier switch-off at this tick of the PRI '
+                                                          'falls inside the main bang of another pulse'),
+                                 ('rex', 'rex_delay', 'REX at this tick of the PRI falls inside the main '
+                                                      'bang of another pulse')):
+        start, end = intervals[name]
+        hit = first_overlaps(start, end, window_start, window_end, window_valid, own)
+        hit_start = window_start[rows, numpy.maximum(hit, 0)]
+        checks.append((field, active & (hit >= 0), numpy.maximum(start, hit_start) - pri_start, message))
+    return checks
+
+
+def format_intervals(batch, candidate=0):
+    """ returns a table of the intervals of every pulse of a candidate """
+    intervals = pulse_intervals(batch, batch.register_values())
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Pulse', 'Mode'] + ['{} [ticks]'.format(name) for name in INTERVALS]
+    for pulse in range(int(batch.active()[candidate].sum())):
+        row = [pulse, int(batch.pol_mode[candidate, pulse])]
+        for name in INTERVALS:
+            start, end = intervals[name]
+            row.append('{} - {}'.format(start[candidate, pulse], end[candidate, pulse]))
+        ptable.add_row(row)
+    return str(ptable)
+
+
+if __name__ == '__main__':
+    # validation uses this module for its timing_conflicts rule
+    from parser import HeaderParseError, TCUParams
+    from validation import ParameterBatch, format_violation, validate
+
+    clargparser = argparse.ArgumentParser(usage='conflicts.py HEADER',
+                                          description='Timing conflicts in the pulse sequence '
+                                                      'of a NeXtRAD header file')
+    clargparser.add_argument('headerfile', help='header file to analyse')
+    args = clargparser.parse_args()
+
+    try:
+        tcu_params = TCUParams(args.headerfile)
+    except HeaderParseError as e:
+        sys.stderr.write('failed to parse header file: {}\n'.format(e))
+        sys.exit(65)
+    print(format_intervals(ParameterBatch.from_params([tcu_params], tcu_params.clk_period_ns)))
+    found = validate(tcu_params, ['timing_conflicts'])
+    for violation in found:
+        print(format_violation(violation))
+    print('{} timing conflict(s)'.format(len(found)))
+    sys.exit(0 if not found else 65)
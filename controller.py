@@ -9,7 +9,7 @@
 # EXIT CODES:
 # 0     : all good, tcu is armed and waiting
 # 64    : headerfile not found
-# 65    : expected parameter missing from headerfile
+# 65    : expected parameter missing or malformed in headerfile
 # 66    : failed to connect to rhino
 # 67    : read registers don't match expected
 # user codes: '0', '64 - 113' http://www.tldp.org/LDP/abs/html/exitcodes.html
@@ -23,7 +23,10 @@ import prettytable
 
 import harpoon
 from harpoon.boardsupport import borph
-from parser import TCUParams
+from parser import HeaderParseError
+from registers import (compare_registers, decode_registers, format_mismatch,
+                       od_words_to_bytes, to_echo_str)
+from store import register_store
 
 # SYMBOLS:
 # ---------------------
@@ -37,19 +40,16 @@ from parser import TCUParams
 # instruction      0x02
 # pre_pulse        0x02
 
-num_pulses = str()
-num_repeats = str()
-x_amp_delay = str()
-l_amp_delay = str()
-rex_delay = str()
-pri_pulse_width = str()
-pulses = list()
-status = str()
-instruction = str()
-pre_pulse = str()
+# byte image of the registers, see registers.py for the layout
+register_image = None
+# registers are written in this order
+REGISTER_WRITE_ORDER = ['pulses', 'num_repeats', 'num_pulses', 'x_amp_delay',
+                        'l_amp_delay', 'rex_delay', 'pri_pulse_width', 'pre_pulse']
 
-CLK_PERIOD_NS = 10
-CLK_FREQUENCY_HZ = 1 / (CLK_PERIOD_NS * pow(10, -9))
+# clock period override, the CLK_PERIOD_NS of the header is used if None
+CLK_PERIOD_NS = None
+# clock period the register image was compiled for
+clk_period_ns = None
 
 
 logger = logging.getLogger('tcu_project_logger')
@@ -78,46 +78,21 @@ def init_logger():
 
 def parse_header():
 
-    tcu_params = TCUParams(HEADER_FILE)
-    logger.debug('Extracted parameters from header:\n' + str(tcu_params))
-
-    global num_pulses
-    global num_repeats
-    global x_amp_delay
-    global l_amp_delay
-    global rex_delay
-    global pri_pulse_width
-    global pulses
-    global status
-    global instruction
-    global pre_pulse
-
-    hex_params = tcu_params.get_hex_params()
-    num_pulses = hex_params['num_pulses']
-    num_repeats = hex_params['num_repeats']
-    # ensuring num_repeats is 32bit hex number
-    if len(num_repeats) == 8:
-        # NOTE: change this depending on how num_repeats is stored in HDL
-        # num_repeats = '\\x00\\x00' + num_repeats
-        num_repeats = num_repeats + '\\x00\\x00'
-    x_amp_delay = hex_params['x_amp_delay']
-    l_amp_delay = hex_params['l_amp_delay']
-    rex_delay = hex_params['rex_delay']
-    pri_pulse_width = hex_params['pri_pulse_width']
-    # ensuring pri_pulse_width is 32bit hex number
-    if len(pri_pulse_width) == 8:
-        # NOTE: change this depending on how pri_pulse_width is stored in HDL
-        # pri_pulse_width = '\\x00\\x00' + pri_pulse_width
-        pri_pulse_width = pri_pulse_width + '\\x00\\x00'
-    pulses = hex_params['pulses']
-    pre_pulse = hex_params['pre_pulse']
-
-    for index, pulse in enumerate(pulses):
-        # ensuring PRI is 32bit hex number
-        if len(pulse['pri']) == 8:
-            # NOTE: change this depending on how PRI is stored in HDL
-            # pulse['pri'] = '\\x00\\x00' + pulse['pri']
-            pulse['pri'] = pulse['pri'] + '\\x00\\x00'
+    global register_image
+    global clk_period_ns
+
+    # compiled images of known headers are taken from the store
+    try:
+        entry = register_store.load(HEADER_FILE, CLK_PERIOD_NS)
+    except HeaderParseError as e:
+        logger.error('failed to parse header file: {}'.format(e))
+        sys.exit(65)
+    logger.debug('register image {} for header file {}'.format(entry.key, HEADER_FILE))
+    register_image = entry.image
+    clk_period_ns = entry.summary['clk_period_ns']
+    logger.debug('clock period {}ns'.format(clk_period_ns))
+    for warning in entry.warnings:
+        logger.warning('header file: {}'.format(warning))
 
     logging.info('header parsing complete')
 
@@ -175,157 +150,69 @@ def write_registers():
     #       core_tcu.write_reg('m', num_repeats)
     #       core_tcu.write_reg('n', num_pulses)
 
-    pulse_param_str = str()
-    for pulse in pulses:
-        pulse_param_str += pulse['pulse_width'] + pulse['pri'] + pulse['pol_mode'] + pulse['frequency']
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pulse_param_str, fpga_con._pid, 'pulses'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pulse_param_str, fpga_con._pid, 'pulses'))
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(num_repeats, fpga_con._pid, 'num_repeats'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(num_repeats, fpga_con._pid, 'num_repeats'))
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(num_pulses, fpga_con._pid, 'num_pulses'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(num_pulses, fpga_con._pid, 'num_pulses'))
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(x_amp_delay, fpga_con._pid, 'x_amp_delay'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(x_amp_delay, fpga_con._pid, 'x_amp_delay'))
+    for name in REGISTER_WRITE_ORDER:
+        command = 'echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(
+            to_echo_str(register_image[name]), fpga_con._pid, name)
+        logger.debug(command)
+        fpga_con._action(command)
 
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(l_amp_delay, fpga_con._pid, 'l_amp_delay'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(l_amp_delay, fpga_con._pid, 'l_amp_delay'))
 
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(rex_delay, fpga_con._pid, 'rex_delay'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(rex_delay, fpga_con._pid, 'rex_delay'))
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pri_pulse_width, fpga_con._pid, 'pri_pulse_width'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pri_pulse_width, fpga_con._pid, 'pri_pulse_width'))
-
-    logger.debug('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pre_pulse, fpga_con._pid, 'pre_pulse'))
-    fpga_con._action('echo -en \'{}\' | cat > /proc/{}/hw/ioreg/{}'.format(pre_pulse, fpga_con._pid, 'pre_pulse'))
+def read_register(name):
+    """ returns the raw contents of a TCU register """
+    logger.debug('reading {}...'.format(name))
+    output = fpga_con._action('od -v -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, name))
+    logger.debug(name + ':' + output.decode('utf-8'))
+    # first line is the echoed command, last line is the prompt
+    return od_words_to_bytes('\n'.join(output.decode('utf-8').split('\r\n')[1:-1]))
 
 
 def verify_registers():
 
     # -------------------------------------------------------------------------
-    # verifying global parameters
+    # reading back registers
     # -------------------------------------------------------------------------
-    logger.debug('reading num_pulses...')
-    reg_num_pulses_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'num_pulses'))
-    logger.debug('num_pulses:' + reg_num_pulses_rcv.decode('utf-8'))
-    reg_num_pulses_rcv = "'"+reg_num_pulses_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_num_pulses_rcv.replace("'", "").split(" ")
-    reg_num_pulses_rcv = ("0x" + arr[1] + arr[0])
-
-    logger.debug('reading num_repeats...')
-    reg_num_repeats_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'num_repeats'))
-    logger.debug('num_repeats:' + reg_num_repeats_rcv.decode('utf-8'))
-    reg_num_repeats_rcv = "'"+reg_num_repeats_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_num_repeats_rcv.replace("'", "").split(" ")
-    reg_num_repeats_rcv = ("0x" + arr[2] + arr[1])
-
-    logger.debug('reading x_amp_delay...')
-    reg_x_amp_delay_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'x_amp_delay'))
-    logger.debug('x_amp_delay:' + reg_x_amp_delay_rcv.decode('utf-8'))
-    reg_x_amp_delay_rcv = "'"+reg_x_amp_delay_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_x_amp_delay_rcv.replace("'", "").split(" ")
-    reg_x_amp_delay_rcv = ("0x" + arr[1] + arr[0])
-
-    logger.debug('reading l_amp_delay...')
-    reg_l_amp_delay_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'l_amp_delay'))
-    logger.debug('l_amp_delay:' + reg_l_amp_delay_rcv.decode('utf-8'))
-    reg_l_amp_delay_rcv = "'"+reg_l_amp_delay_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_l_amp_delay_rcv.replace("'", "").split(" ")
-    reg_l_amp_delay_rcv = ("0x" + arr[1] + arr[0])
-
-    logger.debug('reading rex_delay...')
-    reg_rex_delay_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'rex_delay'))
-    logger.debug('rex_delay:' + reg_rex_delay_rcv.decode('utf-8'))
-    reg_rex_delay_rcv = "'"+reg_rex_delay_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_rex_delay_rcv.replace("'", "").split(" ")
-    reg_rex_delay_rcv = ("0x" + arr[1] + arr[0])
-
-    logger.debug('reading pri_pulse_width...')
-    reg_pri_pulse_width_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'pri_pulse_width'))
-    logger.debug('pri_pulse_width:' + reg_pri_pulse_width_rcv.decode('utf-8'))
-    reg_pri_pulse_width_rcv = "'"+reg_pri_pulse_width_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_pri_pulse_width_rcv.replace("'", "").split(" ")
-    reg_pri_pulse_width_rcv = ("0x" + arr[2] + arr[1])
-
-    logger.debug('reading pre_pulse...')
-    reg_pre_pulse_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'pre_pulse'))
-    logger.debug('pre_pulse:' + reg_pre_pulse_rcv.decode('utf-8'))
-    reg_pre_pulse_rcv = "'"+reg_pre_pulse_rcv.decode('utf-8').split("\r\n")[1:-1:][0]+"'"
-    arr = reg_pre_pulse_rcv.replace("'", "").split(" ")
-    reg_pre_pulse_rcv = ("0x" + arr[1] + arr[0])
+    readback = dict()
+    for name in REGISTER_WRITE_ORDER:
+        readback[name] = read_register(name)
+    try:
+        params = decode_registers(readback)
+    except ValueError as e:
+        logger.error('failed to decode registers: {}'.format(e))
+        sys.exit(67)
 
     ptable_global = prettytable.PrettyTable()
     ptable_global.field_names = ['Parameter', 'Value', 'Hex Cycles [big endian]']
     ptable_global.align['Parameter'] = 'l'
-    ptable_global.add_row(['num_pulses', eval(reg_num_pulses_rcv), reg_num_pulses_rcv])
-
-    ptable_global.add_row(['num_repeats', eval(reg_num_repeats_rcv), reg_num_repeats_rcv])
-
-    ptable_global.add_row(
-        ['pri_pulse_width', eval(reg_pri_pulse_width_rcv), reg_pri_pulse_width_rcv])
-    ptable_global.add_row(['pre_pulse', eval(reg_pre_pulse_rcv), reg_pre_pulse_rcv])
-    ptable_global.add_row(
-        ['x_amp_delay', eval(reg_x_amp_delay_rcv), reg_x_amp_delay_rcv])
-    ptable_global.add_row(
-        ['l_amp_delay', eval(reg_l_amp_delay_rcv), reg_l_amp_delay_rcv])
-    ptable_global.add_row(
-        ['rex_delay', eval(reg_rex_delay_rcv), reg_rex_delay_rcv])
+    for name in ['num_pulses', 'num_repeats', 'pri_pulse_width', 'pre_pulse',
+                 'x_amp_delay', 'l_amp_delay', 'rex_delay']:
+        ptable_global.add_row([name, params[name], hex(params[name])])
     logger.debug("Global Registers:")
     logger.debug("\n"+str(ptable_global))
 
-    # -------------------------------------------------------------------------
-    # verifying pulse parameters
-    # -------------------------------------------------------------------------
-    logger.debug('reading pulses...')
-    reg_pulses_rcv = fpga_con._action('od -x -An /proc/{}/hw/ioreg/{}'.format(fpga_con._pid, 'pulses'))
-    logger.debug('pulses:' + reg_pulses_rcv.decode('utf-8'))
-
-    array = reg_pulses_rcv.decode('utf-8').split("\r\n")
-    array = array[1:-2:]  # extract only the data
-    for i in range(len(array)):
-        array[i] = array[i].lstrip()
-
-    # "splitting up pulses info into 16bit chunks...:")
-    read_data_array = list()
-    for i in range(len(array)):
-        line_in_array = array[i].split(" ")
-        for word in line_in_array:
-            read_data_array.append(word)
-
     ptable_pulses = prettytable.PrettyTable()
     ptable_pulses.field_names = ['Pulse Number', 'Pulse Width', 'PRIoffset',
                                  'Mode', 'Frequency', "PRF[Hz]"]
-
-    for pulse_number in range(eval(reg_num_pulses_rcv)):
-
-        pulse_width = read_data_array[((pulse_number*5)+0)]
-        pulse_width = eval("0x"+pulse_width)*CLK_PERIOD_NS
-
-        pri_lower = read_data_array[((pulse_number*5)+1)]
-        pri_upper = read_data_array[((pulse_number*5)+2)]
-        pri_offset = eval("0x"+pri_upper+pri_lower)*CLK_PERIOD_NS
-
-        mode = read_data_array[((pulse_number*5)+3)]
-        mode = eval("0x"+mode)
-
-        freq = read_data_array[((pulse_number*5)+4)]
-        freq = freq[2:4] + freq[0:2]
-        freq = eval("0x"+freq)
-
-        pre_pulse = eval(reg_pre_pulse_rcv)*CLK_PERIOD_NS
+    pre_pulse = params['pre_pulse']*clk_period_ns
+    for pulse_number, pulse in enumerate(params['pulses']):
+        pulse_width = pulse['pulse_width']*clk_period_ns
+        pri_offset = pulse['pri']*clk_period_ns
         pri_calc = (pulse_width + pre_pulse + pri_offset) / 1000000000  # PRI in seconds
         prf_calc = 1 / pri_calc  # PRF in Hertz
         ptable_pulses.add_row([str(pulse_number), str(pulse_width),
-                               str(pri_offset), str(mode), str(freq),
-                               str(prf_calc)])
+                               str(pri_offset), str(pulse['pol_mode']),
+                               str(pulse['frequency']), str(prf_calc)])
     logger.debug("Pulses Register")
     logger.debug("\n"+str(ptable_pulses))
-    # TODO: check if registers don't match
-    #       sys.exit(67)
+
+    # -------------------------------------------------------------------------
+    # comparing against the parameters sent
+    # -------------------------------------------------------------------------
+    mismatches = compare_registers(decode_registers(register_image), params)
+    for mismatch in mismatches:
+        logger.error(format_mismatch(mismatch))
+    if mismatches:
+        sys.exit(67)
+    logger.debug('All registers have been verified')
 
 
 def arm_tcu():
@@ -399,6 +286,8 @@ if __name__ == '__main__':
                         '[\'/tmp\']', default='/tmp')
     parser.add_argument('-k', '--kill', help='kill running .bof',
                         action="store_true", default=False)
+    parser.add_argument('-c', '--clk_period', help='clock period in ns '
+                        '[CLK_PERIOD_NS of the header, or 10]', type=float, default=None)
     args = parser.parse_args()
 
     init_logger()
@@ -409,6 +298,7 @@ if __name__ == '__main__':
     HEADER_FILE = args.file
     TCU_ADDRESS = args.address
     BOF_EXE = args.bof  # NOTE: assumes .bof must already be in /opt/rhinofs/
+    CLK_PERIOD_NS = args.clk_period
     if args.kill:
         # -------------------------------------------------------------------------
         # CONNECT TO RHINO
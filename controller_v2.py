@@ -1,6 +1,8 @@
 import sys
 import os.path
 import argparse
+import contextlib
+import struct
 import time
 import logging
 import npyscreen
@@ -14,7 +16,13 @@ from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem
 from controller_v2_gui import Ui_MainWindow
 import harpoon
 from harpoon.boardsupport import borph
-from parser import TCUParams
+from ioreg import IORegBatch
+from parser import HeaderParseError
+from registers import (MAX_PULSES, SCALAR_REGISTERS, ShadowRegisters, compare_registers, decode_pulses,
+                       decode_registers, format_mismatch)
+from store import register_store
+
+INSTRUCTION_STRUCT = struct.Struct('<H')
 
 
 class TCUController(harpoon.Project):
@@ -38,7 +46,8 @@ class TCUController(harpoon.Project):
                  auto_arm=False,
                  retry_connect=False,
                  retry_delay=3,
-                 voice=False
+                 voice=False,
+                 force_write=False
                  ):
         """creates a new instance of TCUController
 
@@ -56,6 +65,7 @@ class TCUController(harpoon.Project):
         :param bool retry_connect: continuously retries to connect to TCU
         :param int retry_delay: delay in seconds between connection retries
         :param bool voice: voice prompts
+        :param bool force_write: rewrite every register on update, not only those that changed
         """
 
         harpoon.Project.__init__(self, name, description, cores)
@@ -73,9 +83,14 @@ class TCUController(harpoon.Project):
         self.retry_connect = retry_connect
         self.retry_delay = retry_delay
         self.voice = voice
+        self.force_write = force_write
 
         self.is_connected = False
         self.is_running = False
+        # RegisterImage of the parsed header, and what the TCU registers
+        # were last confirmed to hold
+        self.register_image = None
+        self.shadow = ShadowRegisters()
 
         self._init_logger(log_dir, debug)
 
@@ -86,6 +101,7 @@ class TCUController(harpoon.Project):
         self.logger.debug('\tauto_arm = {}'.format(self.auto_arm))
         self.logger.debug('\tauto_update = {}'.format(self.auto_update))
         self.logger.debug('\tvoice = {}'.format(self.voice))
+        self.logger.debug('\tforce_write = {}'.format(self.force_write))
 
         self.init_headerfile_thread()
 
@@ -128,6 +144,8 @@ class TCUController(harpoon.Project):
     def connect(self):
         if self.address is not None:
             self.logger.info('initializing rhino connection, IP address: ' + self.address)
+            # registers may have changed while not connected
+            self.shadow.forget()
             try:
                 self.fpga_con.connect()
                 self.is_connected = True
@@ -150,6 +168,7 @@ class TCUController(harpoon.Project):
 
     def disconnect(self):
         self.logger.info('disconnecting from tcu...')
+        self.shadow.forget()
         try:
             self.fpga_con.disconnect()
             self.logger.info('disconnect successful!')
@@ -170,6 +189,7 @@ class TCUController(harpoon.Project):
         if fpga_con.ssh_connected():
             self.logger.info('starting bof...')
             self.fpga_con.launch_bof(self.bof_exe, link=True)
+            self.shadow.forget()
             if self.fpga_con.running():
                 self.logger.info('bof started!')
             else:
@@ -182,114 +202,148 @@ class TCUController(harpoon.Project):
         if fpga_con.ssh_connected():
             self.logger.info('stopping .bof...')
             self.fpga_con.kill_bof()
+            self.shadow.forget()
         else:
             self.logger.error('cannot kill bof without connection, connect to TCU first. Use tcu.connect() method')
 
     def parse_header(self):
-        self.logger.info('parsing header file...')
-        self.tcu_params = TCUParams(self.headerfile)
-        self.logger.debug('Extracted parameters from header:\n' + str(self.tcu_params))
+        """parses the header file, returns False if it could not be parsed
 
-    def write_registers(self):
+        compiled images of known headers are taken from the store
+        """
+        self.logger.info('parsing header file...')
+        try:
+            entry = register_store.load(self.headerfile)
+        except HeaderParseError as e:
+            self.logger.error('failed to parse header file: {}'.format(e))
+            return False
+        self.register_image = entry.image
+        self.logger.debug('register image {} for header file {}'.format(entry.key, self.headerfile))
+        for warning in entry.warnings:
+            self.logger.warning('header file: {}'.format(warning))
+        return True
+
+    def write_registers(self, force=False):
+        """writes the parameters to the TCU registers
+
+        only the registers, and the byte ranges of reg_pulses, that differ
+        from what the TCU was last confirmed to hold are written; with force
+        every register is rewritten in full. Returns True if the registers
+        hold the parameters afterwards
+        """
         if fpga_con.ssh_connected():
             if fpga_con.running():
+                image = self.register_image
+                if force:
+                    self.shadow.forget()
+                diff = self.diff_registers(image)
+                if not force:
+                    for message in diff.messages():
+                        self.logger.info(message)
+                if not diff:
+                    self.logger.info('registers unchanged, nothing written')
+                    return True
                 self.logger.info('writing registers...')
-                params = self.tcu_params.get_int_params()
-                reg_num_repeats.write(params['num_repeats'])
-                reg_num_pulses.write(params['num_pulses'])
-                reg_x_amp_delay.write(params['x_amp_delay'])
-                reg_l_amp_delay.write(params['l_amp_delay'])
-                reg_rex_delay.write(params['rex_delay'])
-                reg_pri_pulse_width.write(params['pri_pulse_width'])
-                reg_pre_pulse.write(params['pre_pulse'])
-
-                # need to do a bit more work for reg_pulses,
-                # as it is a more complex data structure
-                hex_params = self.tcu_params.get_hex_params()
-                pulses = hex_params['pulses']
-                pulse_param_str = str()
-                for pulse in pulses:
-                    pulse_param_str += pulse['pulse_width'].replace('\\x', '') \
-                                       + pulse['pri'].replace('\\x', '') \
-                                       + pulse['pol_mode'].replace('\\x', '') \
-                                       + pulse['frequency'].replace('\\x', '')
-
-                pulse_param_bytearray = bytearray.fromhex(pulse_param_str)
-                reg_pulses.write_bytes(pulse_param_bytearray, raw=True)
+                try:
+                    with self.batch() as batch:
+                        batch.write_changes(image, diff)
+                except Exception:
+                    self.logger.exception('failed to write registers')
+                    # the writes may or may not have happened
+                    self.shadow.forget()
+                    return False
+                for name, start, data, written in batch.results:
+                    if written:
+                        self.shadow.update(name, data, start)
+                    else:
+                        self.shadow.forget(name, start, start + len(data))
+                if batch.failed():
+                    return False
 
                 self.logger.debug('registers written')
                 if self.verify:
                     self.logger.debug('checking registers...')
-                    self.check_regs()
+                    return self.check_regs()
+                return True
             else:
+                self.shadow.forget()
                 self.logger.error('No bof running, cannot perform register writes. Use tcu.start() method.')
 
         else:
+            self.shadow.forget()
             self.logger.error('No ssh connection to TCU, cannot perform register writes. Use tcu.connect() method')
+        return False
+
+    @contextlib.contextmanager
+    def batch(self):
+        """collects register writes and sends them to the TCU in one remote command
+
+        with tcu.batch() as batch:
+            batch.write('num_repeats', image['num_repeats'])
+            batch.write('pulses', image['pulses'][10:20], 10)
+
+        nothing is sent if the block raises. Afterwards batch.results holds
+        (register, start, data, written) for every write, see ioreg.IORegBatch
+        """
+        batch = IORegBatch(self.fpga_con._pid)
+        yield batch
+        start_time = time.time()
+        batch.send(self.fpga_con)
+        self.logger.debug('{} register write(s) in one command, {:.3f}s'.format(len(batch), time.time() - start_time))
+        for name in batch.failed():
+            self.logger.error('failed to write register \'{}\''.format(name))
+
+    def diff_registers(self, image=None):
+        """returns the registers.RegisterDiff between what the TCU registers
+        were last confirmed to hold and the parsed header (or image)
+        """
+        if image is None:
+            image = self.register_image
+        return self.shadow.diff(image)
 
     def check_regs(self):
-        """reads back the TCU registers and compares them with the parameters sent"""
+        """reads back the TCU registers and compares them with the parameters sent
+
+        returns True if every register holds the expected value
+        """
         if fpga_con.ssh_connected():
             if fpga_con.running():
                 self.logger.info('verifying registers...')
-                params = self.tcu_params.get_int_params()
-                register_value_correct = True
-                if self.check_reg(reg_num_repeats, params['num_repeats']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_num_pulses, params['num_pulses']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_x_amp_delay, params['x_amp_delay']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_l_amp_delay, params['l_amp_delay']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_rex_delay, params['rex_delay']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_pri_pulse_width, params['pri_pulse_width']) == False:
-                    register_value_correct = False
-                if self.check_reg(reg_pre_pulse, params['pre_pulse']) == False:
-                    register_value_correct = False
-
-                # need to do a bit more work for reg_pulses,
-                # as it is a more complex data structure
-                hex_params = self.tcu_params.get_hex_params(hdl_format=True)
-                pulses = hex_params['pulses']
-                pulse_param_str = str()
-                for pulse in pulses:
-                    pulse_param_str += pulse['pulse_width'].replace('\"', '') + pulse['pri'].replace('\"', '') + pulse['pol_mode'].replace('\"', '') + pulse['frequency'].replace('\"', '')
-                pulse_param_str = pulse_param_str.replace('x', '')
-
-                num_pulses = reg_num_pulses.read()
-                read_value = reg_pulses.read_bytes()[0:(10*num_pulses)]
-                read_value_str = str()
-
-                if sys.version_info >= (3, 6):
-                    for pulse_index in range(num_pulses):
-                        # print('pulse[{}]'.format(pulse_index))
-                        pulse_width = read_value[pulse_index*10 + 0:pulse_index*10 + 2]
-                        # print('pw {}'.format(pulse_width.hex()))
-                        pri = read_value[pulse_index*10 + 4:pulse_index*10 + 6] + read_value[pulse_index*10 + 2:pulse_index*10 + 4]
-                        # print('pri {}'.format(pri.hex()))
-                        mode = read_value[pulse_index*10 + 6:pulse_index*10 + 8]
-                        # print('mode {}'.format(mode.hex()))
-                        freq = read_value[pulse_index*10 + 8:pulse_index*10 + 10]
-                        # print('freq {}'.format(freq.hex()))
-                        read_value_str += pulse_width.hex() + pri.hex() + mode.hex() + freq.hex()
-                    if read_value_str == pulse_param_str:
-                        self.logger.debug('Register \'{}\' verified'.format('pulses'))
-                    else:
-                        self.logger.error('Value mismatch for register \'{}\' retrieved {}, expected {}'.format('pulses', read_value_str, pulse_param_str))
-                        register_value_correct = False
-                else:
-                    self.logger.warning('cannot verify the pulses register. needs Python >= 3.6')
+                expected = decode_registers(self.register_image)
+                actual = dict()
+                actual['num_repeats'] = reg_num_repeats.read()
+                actual['num_pulses'] = reg_num_pulses.read()
+                actual['x_amp_delay'] = reg_x_amp_delay.read()
+                actual['l_amp_delay'] = reg_l_amp_delay.read()
+                actual['rex_delay'] = reg_rex_delay.read()
+                actual['pri_pulse_width'] = reg_pri_pulse_width.read()
+                actual['pre_pulse'] = reg_pre_pulse.read()
+                # read_bytes() returns the register as 16-bit words in display order
+                try:
+                    actual['pulses'] = decode_pulses(reg_pulses.read_bytes(),
+                                                     min(actual['num_pulses'], MAX_PULSES),
+                                                     word_swapped=True)
+                except ValueError as e:
+                    self.logger.error('could not decode register \'pulses\': {}'.format(e))
+                    actual['pulses'] = list()
+
+                mismatches = compare_registers(expected, actual)
+                for mismatch in mismatches:
+                    self.logger.error(format_mismatch(mismatch))
+                    self.shadow.forget(mismatch[0])
+                register_value_correct = len(mismatches) == 0
 
                 if register_value_correct:
                     self.logger.debug('All registers have been verified')
                 else:
                     self.logger.error('One or more registers contain incorrect value(s) - see {} for details'.format(self.log_dir+'tcu_'+self.fpga_con.address+'.log'))
+                return register_value_correct
             else:
+                self.shadow.forget()
                 self.logger.error('No bof running, cannot perform register reads. Use tcu.start() method.')
 
         else:
+            self.shadow.forget()
             self.logger.error('No ssh connection to TCU, cannot perform register reads. Use tcu.connect() method.')
 
     def check_reg(self, register, expected_value):
@@ -308,9 +362,16 @@ class TCUController(harpoon.Project):
         if fpga_con.ssh_connected():
             if fpga_con.running():
                 self.logger.info('arming tcu...')
-                reg_instruction.write(0)
-                # time.sleep(3)
-                reg_instruction.write(1)
+                try:
+                    with self.batch() as batch:
+                        batch.write('instruction', INSTRUCTION_STRUCT.pack(0))
+                        # time.sleep(3)
+                        batch.write('instruction', INSTRUCTION_STRUCT.pack(1))
+                except Exception:
+                    self.logger.exception('failed to arm tcu')
+                    return
+                if batch.failed():
+                    return
                 if self.voice:
                     os.system('spd-say -t female1 -i -0 "armed" -r -30 -p -30')
             else:
@@ -343,7 +404,22 @@ class TCUController(harpoon.Project):
         if fpga_con.ssh_connected():
             if fpga_con.running():
                 self.logger.info('aborting experiment...')
-                reg_num_repeats.write(1)
+                try:
+                    with self.batch() as batch:
+                        batch.write('num_repeats', struct.pack('<' + SCALAR_REGISTERS['num_repeats'], 1))
+                except Exception:
+                    self.logger.exception('failed to abort experiment')
+                    # num_repeats may or may not have been written
+                    self.shadow.forget('num_repeats')
+                    return
+                for name, start, data, written in batch.results:
+                    if written:
+                        self.shadow.update(name, data, start)
+                    else:
+                        self.shadow.forget(name, start, start + len(data))
+                if batch.failed():
+                    self.logger.error('failed to abort experiment, num_repeats was not written')
+                    return
                 if self.voice:
                     os.system('spd-say -t female1 -i -0 "aborted" -r -30 -p -30')
             else:
@@ -359,12 +435,21 @@ class FileEventHandler(PatternMatchingEventHandler):
 
     def on_modified(self, event):
         super(FileEventHandler, self).on_modified(event)
+        self.update()
+
+    def on_moved(self, event):
+        # headers written atomically are renamed over the watched file
+        super(FileEventHandler, self).on_moved(event)
+        self.update()
+
+    def update(self):
         self.logger.info('headerfile changed')
         if tcu.auto_update:
             if tcu.voice:
                 os.system('spd-say -t female1 -i -30 "updated" -r -30')
-            tcu.parse_header()
-            tcu.write_registers()
+            if not tcu.parse_header():
+                return
+            tcu.write_registers(force=tcu.force_write)
             if tcu.auto_arm:
                 print('arming tcu')
                 tcu.arm()
@@ -549,6 +634,9 @@ if __name__ == '__main__':
                         action='store_true', default=False)
     parser.add_argument('-c', '--check_regs', help='verify registers after writing',
                         action='store_true', default=False)
+    parser.add_argument('-F', '--force_write', help='rewrite every register on update, '
+                        'not only those that changed',
+                        action='store_true', default=False)
     parser.add_argument('-l', '--logdir', help='directory to store log file '
                         '[\'/tmp/\']', default='/tmp/')
     parser.add_argument('-g', '--gui', action="store_true", default=False)
@@ -579,7 +667,8 @@ if __name__ == '__main__':
                         auto_arm=args.auto_arm,
                         retry_connect=args.retry_connect,
                         retry_delay=args.retry_delay,
-                        voice=args.voice
+                        voice=args.voice,
+                        force_write=args.force_write
                         )
 
     if args.kill is True:
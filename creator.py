@@ -13,10 +13,13 @@ import argparse
 import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem, QFileDialog, QMessageBox
-import datetime
 
+from ambiguity import analyse_batch, format_ambiguity
 from creator_gui import Ui_MainWindow
-from parser import TCUParams
+from parser import HeaderParseError, TCUParams
+from planner import MEGABYTE, format_duration, format_plans, plan
+from store import register_store
+from validation import ParameterBatch, check_batch, format_violation, violations
 
 VERSION = '1.2.1'
 class Creator(Ui_MainWindow):
@@ -66,6 +69,10 @@ class Creator(Ui_MainWindow):
         self.spin_adc_delay.setProperty("value", self.tcu_params.adc_delay)
         self.spin_samples_per_pri.setProperty("value", self.tcu_params.samples_per_pri)
         self.combo_waveform_index.setProperty("currentIndex", self.tcu_params.waveform_index -1)
+        # range and velocity ambiguity of the pulses, updated with the table
+        self.label_ambiguity = QtWidgets.QLabel(self.centralwidget)
+        self.label_ambiguity.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.gridLayout.addWidget(self.label_ambiguity, 2, 0, 1, 2)
         self.update_table()
         # disabling the RF pulse width field in the pulses editor selection
         # this will be used for future NeXtRAD experiments capable of waveforms
@@ -122,12 +129,29 @@ class Creator(Ui_MainWindow):
             pri = eval(self.table_pulse_params.item(row, 1).text())
             pol_mode = eval(self.table_pulse_params.item(row, 2).text())
             frequency = eval(self.table_pulse_params.item(row, 3).text())
+        # timing conflicts are only warned about by the controllers, ask here
+        params = self.tcu_params.snapshot().to_dict()
+        params['num_pulses'] = len(params['pulses'])  # exported headers load every pulse
+        conflicts = violations(check_batch(ParameterBatch.from_params([params], self.tcu_params.clk_period_ns),
+                                           ['timing_conflicts']))
+        if conflicts:
+            answer = QMessageBox.question(self.main_window, 'Timing conflicts',
+                                          '\n'.join(format_violation(conflict) for conflict in conflicts) +
+                                          '\n\nExport anyway?')
+            if answer != QMessageBox.Yes:
+                return False
         self.tcu_params.export()
         print("exported")
+        # compile the exported header now, so the controllers find it in the store
+        try:
+            register_store.load(self.tcu_params.outputfilename)
+        except HeaderParseError as e:
+            QMessageBox.warning(self.main_window, 'Invalid parameters', str(e))
+        return True
 
     def export_close(self):
-        self.export()
-        window.close()
+        if self.export():
+            window.close()
 
     # TODO: this needs to be fixed, what gets updated first? table or object?
     def add_pulse(self):
@@ -200,6 +224,16 @@ class Creator(Ui_MainWindow):
             self.button_edit_pulse.setEnabled(False)
             self.button_remove_pulse.setEnabled(False)
             self.label_pulse_index.setText("No pulse selected")
+        self.update_ambiguity()
+
+    def update_ambiguity(self):
+        if len(self.tcu_params.pulses) == 0:
+            self.label_ambiguity.setText('')
+            return
+        params = self.tcu_params.snapshot().to_dict()
+        params['num_pulses'] = len(params['pulses'])  # exported headers load every pulse
+        batch = ParameterBatch.from_params([params], self.tcu_params.clk_period_ns)
+        self.label_ambiguity.setText(format_ambiguity(analyse_batch(batch)))
 
     def update_selection(self):
         index_list = self._get_selected_rows()
@@ -227,36 +261,16 @@ class Creator(Ui_MainWindow):
             self.spin_frequency.setRange(8500, 9200)
 
     def update_metadata(self):
-        samples_per_pri = self.spin_samples_per_pri.value()
-        num_pulses = len(self.tcu_params.pulses)
-        num_repeats = self.spin_num_repeats.value()
-        time_block_microseconds = 0
-        for pulse in self.tcu_params.pulses:
-            time_block_microseconds += pulse['pri']
-        time_experiment_microseconds = time_block_microseconds * num_repeats
-        time_experiment_seconds = time_experiment_microseconds / 1000000
-        num_pris = num_pulses * num_repeats
-        num_samples = num_pris * samples_per_pri
-        experiment_size_bits = num_samples * 32
-        experiment_size_bytes = experiment_size_bits // 8
-        experiment_megabytes = experiment_size_bytes // (1024*1024)
-
-        # print('samples_per_pri = ' + str(samples_per_pri))
-        # print('num_pulses = ' + str(num_pulses))
-        # print('num_repeats = ' + str(num_repeats))
-        # print('time_block = ' + str(time_block_microseconds))
-        # print('time_experiment_microseconds = ' + str(time_experiment_microseconds))
-        # print('time_experiment_seconds = ' + str(time_experiment_seconds))
-        # time_experiment_minutes = time_experiment_seconds/60
-        # print('time_experiment_minutes = ' + str(time_experiment_minutes))
-        # time_experiment_hours = time_experiment_minutes/60
-        # print('time_experiment_hours = ' + str(time_experiment_hours))
-        # TODO: clip values over 24 hrs
-        if time_experiment_seconds < 86400:
-            self.lcdNumber_time.display(str(datetime.timedelta(seconds=int(time_experiment_seconds))))
-        else:
-            self.lcdNumber_time.display('large')
-        self.lcdNumber_size.display(str(experiment_megabytes))
+        params = self.tcu_params.snapshot().to_dict()
+        params['num_pulses'] = len(params['pulses'])  # exported headers load every pulse
+        params['num_repeats'] = self.spin_num_repeats.value()
+        params['samples_per_pri'] = self.spin_samples_per_pri.value()
+        experiment_plan = plan(params, self.tcu_params.clk_period_ns)
+        duration = format_duration(experiment_plan.duration_ns)
+        self.lcdNumber_time.setDigitCount(max(8, len(duration)))
+        self.lcdNumber_time.display(duration)
+        self.lcdNumber_size.display(str(experiment_plan.total_bytes // MEGABYTE))
+        self.lcdNumber_size.setToolTip('<pre>{}</pre>'.format(format_plans([('experiment', experiment_plan)])))
 
     def toggle_params(self):
         if self.display_more_pulses:
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# hdl.py
+# writes register images as VHDL packages, memory init files and C headers
+
+import argparse
+import contextlib
+import io
+import logging
+import os
+import os.path
+import re
+import struct
+import sys
+
+from compiler import image_path, iter_header_files
+from parser import HeaderParseError, TCUParams
+from registers import IMAGE_BYTES, PULSE_STRUCT, REGISTER_OFFSETS, SCALAR_REGISTERS, decode_registers
+
+logger = logging.getLogger('tcu_hdl_logger')
+
+# every artifact describes the bytes of a registers.RegisterImage, so it
+# always matches what the controllers write to the TCU. Multi-byte values
+# are the register bytes read as a little endian number, as in the image.
+
+FORMATS = ('vhdl', 'coe', 'mem', 'h')
+EXTENSIONS = {'vhdl': '_pkg.vhd', 'coe': '.coe', 'mem': '.mem', 'h': '.h'}
+WORD_STRUCTS = {1: '<B', 2: '<H', 4: '<I'}
+
+
+@contextlib.contextmanager
+def _open_output(target):
+    """ yields a text file for a file name, or target itself if it is file-like """
+    if hasattr(target, 'write'):
+        yield target
+    else:
+        with open(target, 'w', newline='\n') as output_file:
+            yield output_file
+
+
+def identifier(name):
+    """ returns name turned into a valid VHDL and C identifier """
+    name = re.sub(r'[^0-9a-zA-Z]+', '_', name).strip('_').lower()
+    if not name or name[0].isdigit():
+        name = 'tcu_' + name
+    return name
+
+
+def register_hex(image, name):
+    """ returns the contents of a register as a hex number, most significant
+        byte first; unused pulses in 'pulses' are zero
+    """
+    offset, size = REGISTER_OFFSETS[name]
+    return ''.join('{:02x}'.format(byte) for byte in reversed(image.to_bytes()[offset:offset + size]))
+
+
+def image_words(image, word_bytes=2):
+    """ returns the whole image as a list of little endian words """
+    if word_bytes not in WORD_STRUCTS:
+        raise ValueError('word size must be one of {} bytes'.format(sorted(WORD_STRUCTS)))
+    if IMAGE_BYTES % word_bytes != 0:
+        raise ValueError('image of {} bytes cannot be split into {} byte words'.format(IMAGE_BYTES, word_bytes))
+    word_struct = struct.Struct(WORD_STRUCTS[word_bytes])
+    return [word for (word,) in word_struct.iter_unpack(image.to_bytes())]
+
+
+def _source_comment(source, prefix):
+    return '{} generated from {}\n'.format(prefix, source) if source else ''
+
+
+def write_vhdl_package(image, target, package_name='tcu_registers_pkg', clk_period_ns=10, source=None):
+    """ writes a VHDL package with a constant for every register """
+    with _open_output(target) as output:
+        output.write('-- {}\n'.format(package_name))
+        output.write(_source_comment(source, '--'))
+        output.write('-- system clock period : {}ns\n\n'.format(clk_period_ns))
+        output.write('library ieee;\nuse ieee.std_logic_1164.all;\n\n')
+        output.write('package {} is\n\n'.format(package_name))
+        output.write('    constant NUM_PULSES_USED : natural := {};\n'.format(image.num_pulses))
+        output.write('    constant IMAGE_BYTES : natural := {};\n\n'.format(IMAGE_BYTES))
+        params = decode_registers(image)
+        for name in REGISTER_OFFSETS:
+            size = REGISTER_OFFSETS[name][1]
+            comment = '' if name == 'pulses' else '  -- {}'.format(params[name])
+            output.write('    constant {}_REG : std_logic_vector({} downto 0) := x"{}";{}\n'.format(
+                name.upper(), 8 * size - 1, register_hex(image, name), comment))
+        output.write('\n    -- <p. width>, <pri offset>, <mode>, <freq> of each pulse in PULSES_REG\n')
+        for index, pulse in enumerate(params['pulses']):
+            output.write('    -- pulse {}: {}, {}, {}, {}\n'.format(index, pulse['pulse_width'], pulse['pri'],
+                                                                   pulse['pol_mode'], pulse['frequency']))
+        output.write('\nend package {};\n'.format(package_name))
+
+
+def write_coe(image, target, word_bytes=2, source=None):
+    """ writes the image as a Xilinx .coe memory initialisation file """
+    width = 2 * word_bytes
+    with _open_output(target) as output:
+        output.write(_source_comment(source, ';'))
+        output.write('; TCU register image, {} bytes, {} bit little endian words\n'.format(IMAGE_BYTES,
+                                                                                     8 * word_bytes))
+        output.write('memory_initialization_radix=16;\nmemory_initialization_vector=\n')
+        words = ['{:0{}x}'.format(word, width) for word in image_words(image, word_bytes)]
+        output.write(',\n'.join(words) + ';\n')
+
+
+def write_mem(image, target, word_bytes=2, source=None):
+    """ writes the image as a $readmemh style .mem file, one word per line """
+    width = 2 * word_bytes
+    with _open_output(target) as output:
+        output.write(_source_comment(source, '//'))
+        output.write('@0\n')
+        for word in image_words(image, word_bytes):
+            output.write('{:0{}x}\n'.format(word, width))
+
+
+def write_c_header(image, target, prefix='tcu', source=None):
+    """ writes a C header with the register layout, values and image bytes """
+    prefix = identifier(prefix)
+    guard = prefix.upper() + '_REGISTERS_H'
+    params = decode_registers(image)
+    with _open_output(target) as output:
+        output.write(_source_comment(source, '//'))
+        output.write('#ifndef {0}\n#define {0}\n\n#include <stdint.h>\n\n'.format(guard))
+        output.write('#define {}_IMAGE_BYTES {}\n'.format(prefix.upper(), IMAGE_BYTES))
+        output.write('#define {}_PULSE_BYTES {}\n'.format(prefix.upper(), PULSE_STRUCT.size))
+        output.write('#define {}_NUM_PULSES_USED {}\n\n'.format(prefix.upper(), image.num_pulses))
+        for name, (offset, size) in REGISTER_OFFSETS.items():
+            output.write('#define {}_{}_OFFSET {}\n'.format(prefix.upper(), name.upper(), offset))
+            output.write('#define {}_{}_SIZE {}\n'.format(prefix.upper(), name.upper(), size))
+        output.write('\n')
+        for name in SCALAR_REGISTERS:
+            output.write('#define {}_{}_VALUE 0x{}u  /* {} */\n'.format(prefix.upper(), name.upper(),
+                                                                       register_hex(image, name), params[name]))
+        output.write('\nstatic const uint8_t {}_register_image[{}_IMAGE_BYTES] = {{\n'.format(prefix,
+                                                                                            prefix.upper()))
+        data = image.to_bytes()
+        for start in range(0, len(data), 12):
+            output.write('    ' + ', '.join('0x{:02x}'.format(byte) for byte in data[start:start + 12]) + ',\n')
+        output.write('}};\n\n#endif /* {} */\n'.format(guard))
+
+
+def write_artifacts(tcu_params, base_name, formats=FORMATS, word_bytes=2, source=None):
+    """ writes the artifacts of tcu_params to base_name + extension
+
+        returns the list of files written
+    """
+    image = tcu_params.get_register_image()
+    name = identifier(os.path.basename(base_name))
+    written = list()
+    for artifact in formats:
+        file_name = base_name + EXTENSIONS[artifact]
+        if artifact == 'vhdl':
+            write_vhdl_package(image, file_name, name + '_pkg', tcu_params.clk_period_ns, source)
+        elif artifact == 'coe':
+            write_coe(image, file_name, word_bytes, source)
+        elif artifact == 'mem':
+            write_mem(image, file_name, word_bytes, source)
+        elif artifact == 'h':
+            write_c_header(image, file_name, name, source)
+        written.append(file_name)
+    return written
+
+
+def to_vhdl_package_str(tcu_params, package_name='tcu_registers_pkg'):
+    """ returns the VHDL package of tcu_params as a string """
+    output = io.StringIO()
+    write_vhdl_package(tcu_params.get_register_image(), output, package_name, tcu_params.clk_period_ns)
+    return output.getvalue()
+
+
+if __name__ == '__main__':
+    clargparser = argparse.ArgumentParser(usage='hdl.py [-o DIR] [-f FORMATS] PATH [PATH ...]',
+                                          description='HDL and C artifacts for the TCU '
+                                                      'register image of NeXtRAD header files')
+    clargparser.add_argument('paths', nargs='+',
+                             help='header files, directories or glob patterns')
+    clargparser.add_argument('-o', '--outputdir', default='.',
+                             help='directory for the generated files [.]')
+    clargparser.add_argument('-f', '--formats', default=','.join(FORMATS),
+                             help='comma separated artifacts to write [{}]'.format(','.join(FORMATS)))
+    clargparser.add_argument('-w', '--word-bytes', type=int, default=2,
+                             help='bytes per word in .coe and .mem files [2]')
+    clargparser.add_argument('-p', '--pattern', default='*.ini',
+                             help='file pattern used in directories [*.ini]')
+    clargparser.add_argument('-R', '--recursive', action='store_true', default=False,
+                             help='search directories recursively')
+    args = clargparser.parse_args()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(console)
+    logger.setLevel(logging.INFO)
+
+    formats = [artifact.strip() for artifact in args.formats.split(',') if artifact.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        clargparser.error('unknown format(s): {}'.format(', '.join(sorted(unknown))))
+
+    num_errors = 0
+    for header, root in iter_header_files(args.paths, args.pattern, args.recursive):
+        base_name = os.path.splitext(image_path(header, root, args.outputdir))[0]
+        try:
+            tcu_params = TCUParams(header, cache=None)
+            if os.path.dirname(base_name):
+                os.makedirs(os.path.dirname(base_name), exist_ok=True)
+            written = write_artifacts(tcu_params, base_name, formats, args.word_bytes, source=header)
+        except HeaderParseError as e:
+            logger.error(str(e))
+            num_errors += 1
+            continue
+        except ValueError as e:
+            logger.error('{}: {}'.format(header, e))
+            num_errors += 1
+            continue
+        logger.info('{} -> {}'.format(header, ', '.join(written)))
+    sys.exit(0 if num_errors == 0 else 65)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# ioreg.py
+# batched writes to the register files of a running bof
+
+import re
+
+from registers import SCALAR_REGISTERS, align_ranges, to_echo_str
+
+# REMOTE COMMAND:
+# ---------------------
+# every register of a running bof is a file in /proc/<pid>/hw/ioreg. A
+# batch writes each register (or byte range of one) with dd at its offset
+# and echoes the exit status of every write, all in one shell command:
+#
+# echo -en '<bytes>' | dd of=<ioreg>/<register> bs=<len> count=1 seek=<start> iflag=fullblock oflag=seek_bytes conv=notrunc 2>/dev/null; echo "ioreg <index> $?"; ...
+#
+# the block size is the length of the write, so dd collects the whole range
+# from the pipe and writes it with a single write() call, as harpoon does.
+# Smaller blocks would update the 32-bit registers one half at a time and
+# the FPGA could see a mix of the old and new value.
+#
+# the status lines are only produced by running the command, the echoed
+# command itself holds a literal '$?' and never matches STATUS_RE.
+
+IOREG_DIR = '/proc/{}/hw/ioreg'
+WORD_BYTES = 2  # registers are written in whole 16-bit words
+
+STATUS_RE = re.compile(r'^ioreg (\d+) (\d+)\s*$', re.MULTILINE)
+
+
+class IORegBatch(object):
+    """Register writes sent to the TCU in one remote command
+
+    Writes are sent in the order they were added, so the same register may
+    be written more than once (arming writes 0 then 1 to instruction).
+    After send(), results holds (register, start, data, written) for every
+    write.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.writes = list()
+        self.results = None
+
+    def __len__(self):
+        return len(self.writes)
+
+    def write(self, name, data, start=0):
+        """ adds a write of data to register name, from byte start """
+        data = bytes(data)
+        if start % WORD_BYTES or len(data) % WORD_BYTES:
+            raise ValueError('register \'{}\' writes must be whole {} byte words, got [{}:{}]'
+                             .format(name, WORD_BYTES, start, start + len(data)))
+        self.writes.append((name, start, data))
+
+    def write_changes(self, image, diff):
+        """ adds writes of the registers of RegisterImage image changed in
+            a registers.RegisterDiff: changed scalar registers in full, and
+            the changed byte ranges of reg_pulses widened to whole words
+        """
+        for name in SCALAR_REGISTERS:
+            if name in diff.byte_ranges:
+                self.write(name, image[name])
+        if 'pulses' in diff.byte_ranges:
+            data = image['pulses']
+            for start, stop in align_ranges(diff.byte_ranges['pulses'], WORD_BYTES, len(data)):
+                self.write('pulses', data[start:stop], start)
+
+    def command(self):
+        """ returns the shell command performing every write """
+        ioreg_dir = IOREG_DIR.format(self.pid)
+        return '; '.join('echo -en \'{}\' | dd of={}/{} bs={} count=1 seek={} iflag=fullblock '
+                         'oflag=seek_bytes conv=notrunc 2>/dev/null; '
+                         'echo "ioreg {} $?"'.format(to_echo_str(data), ioreg_dir, name, len(data), start, index)
+                         for index, (name, start, data) in enumerate(self.writes))
+
+    def parse(self, output):
+        """ returns (register, start, data, written) for every write, given
+            the output of command()
+
+            writes without a status line, e.g. when the command was cut
+            short, count as failed
+        """
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        status = dict((int(index), int(code)) for index, code in STATUS_RE.findall(output))
+        return [(name, start, data, status.get(index) == 0)
+                for index, (name, start, data) in enumerate(self.writes)]
+
+    def send(self, fpga_con):
+        """ performs every write in one remote command over fpga_con and
+            returns the results
+        """
+        self.results = self.parse(fpga_con._action(self.command())) if self.writes else list()
+        return self.results
+
+    def failed(self):
+        """ returns the names of the registers that were not written """
+        return [name for name, start, data, written in self.results or () if not written]
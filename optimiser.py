@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# optimiser.py
+# searches staggered pulse schedules for the best range and velocity ambiguity
+
+import argparse
+import collections
+import logging
+import sys
+import time
+import numpy
+import prettytable
+
+from ambiguity import analyse_batch
+from compiler import pool_map
+from parser import HeaderFileParser, HeaderParseError, TCUParams
+from registers import MAX_PULSES
+from sweep import parse_values
+from validation import (L_BAND_MHZ, L_BAND_MODES, X_BAND_MHZ, ParameterBatch, check_batch,
+                        valid_mask)
+
+logger = logging.getLogger('tcu_optimiser_logger')
+
+# SEARCH:
+# ---------------------
+# every pulse of a schedule takes one of the PRIs and one of the (pol_mode,
+# frequency) pairs whose frequency lies in the band of the mode. Candidates
+# are numbered in mixed radix, so any range of the search space is decoded
+# directly into arrays and the space is split into independent tasks.
+#
+# a pulse block repeats, so rotations of a schedule are the same experiment
+# and only the smallest rotation of every schedule is scored.
+# Candidates are scored on the ambiguity of the whole block first; only
+# those beating the best schedules found so far are validated.
+
+# objective name -> score of an ambiguity.Ambiguity, higher is better;
+# bands without pulses are ignored
+OBJECTIVES = collections.OrderedDict([
+    ('range', lambda ambiguity: numpy.fmin.reduce(ambiguity.unambiguous_range, axis=1)),
+    ('speed', lambda ambiguity: numpy.fmin.reduce(ambiguity.blind_speed, axis=1)),
+    ('product', lambda ambiguity: (numpy.fmin.reduce(ambiguity.unambiguous_range, axis=1) *
+                                   numpy.fmin.reduce(ambiguity.blind_speed, axis=1))),
+])
+
+MAX_CANDIDATES = 2**62
+
+
+def in_band(pol_mode, frequency):
+    """ returns True if frequency (MHz) lies in the band of pol_mode """
+    low, high = L_BAND_MHZ if pol_mode < L_BAND_MODES else X_BAND_MHZ
+    return low <= frequency <= high
+
+
+class SearchSpace(object):
+    """All schedules of num_pulses pulses built from the given choices
+
+    pris are in microseconds and frequencies in MHz. Schedules are
+    numbered 0 .. size - 1, see digits().
+    """
+
+    def __init__(self, num_pulses, pris, modes, frequencies):
+        if not 1 <= num_pulses <= MAX_PULSES:
+            raise ValueError('num_pulses must be between 1 and {}'.format(MAX_PULSES))
+        self.num_pulses = num_pulses
+        self.pris = numpy.array(sorted(set(pris)), dtype=numpy.float64)
+        pairs = [(mode, frequency) for mode in sorted(set(modes)) for frequency in sorted(set(frequencies))
+                 if in_band(mode, frequency)]
+        if len(self.pris) == 0 or not pairs:
+            raise ValueError('no PRI, or no pol_mode with a frequency in its band')
+        self.modes = numpy.array([mode for mode, _ in pairs], dtype=numpy.float64)
+        self.frequencies = numpy.array([frequency for _, frequency in pairs], dtype=numpy.float64)
+        self.choices = len(self.pris) * len(pairs)
+        self.size = self.choices ** num_pulses
+        if self.size > MAX_CANDIDATES:
+            raise ValueError('search space of {} candidates is too large'.format(self.size))
+
+    def digits(self, index):
+        """ returns the (N, num_pulses) choices of the numbered schedules """
+        digits = numpy.empty((len(index), self.num_pulses), dtype=numpy.int64)
+        for pulse in range(self.num_pulses - 1, -1, -1):
+            index, digits[:, pulse] = numpy.divmod(index, self.choices)
+        return digits
+
+    def canonical(self, digits):
+        """ returns the mask of the rows of digits that are the smallest
+            of their rotations
+        """
+        keep = digits[:, 0] <= digits.min(axis=1)
+        rows = numpy.arange(len(digits))
+        for shift in range(1, self.num_pulses):
+            rotated = numpy.roll(digits, -shift, axis=1)
+            differ = digits != rotated
+            first = differ.argmax(axis=1)
+            keep &= ~differ.any(axis=1) | (digits[rows, first] < rotated[rows, first])
+        return keep
+
+    def schedule(self, digits):
+        """ returns the pri, pol_mode and frequency arrays of choices """
+        pri, pair = numpy.divmod(digits, len(self.modes))
+        return self.pris[pri], self.modes[pair], self.frequencies[pair]
+
+    def batch(self, base, digits):
+        """ returns a ParameterBatch of the base parameters with the pulses
+            of every row of digits
+        """
+        num_rows = len(digits)
+        pri, pol_mode, frequency = self.schedule(digits)
+        scalars = dict((name, numpy.full(num_rows, base[name])) for name in ParameterBatch.SCALARS)
+        scalars['num_pulses'] = numpy.full(num_rows, self.num_pulses)
+        pulses = {'pulse_width': numpy.full(digits.shape, base['pulse_width']),
+                  'pri': pri, 'pol_mode': pol_mode, 'frequency': frequency}
+        return ParameterBatch(scalars, pulses, numpy.full(num_rows, self.num_pulses), base['clk_period_ns'])
+
+
+def search_range(space, base, start, stop, objective, top, threshold=-numpy.inf, block_size=16384):
+    """ returns the best valid schedules numbered [start, stop)
+
+        returns (scores, indices, counts) where scores and indices hold at
+        most 'top' schedules scoring above threshold, best first, and counts
+        is a dictionary of the number of 'scored', 'pruned' and 'invalid'
+        candidates.
+    """
+    score = OBJECTIVES[objective]
+    best_scores = numpy.empty(0)
+    best_indices = numpy.empty(0, dtype=numpy.int64)
+    counts = {'scored': 0, 'pruned': 0, 'invalid': 0}
+    for block_start in range(start, stop, block_size):
+        index = numpy.arange(block_start, min(stop, block_start + block_size), dtype=numpy.int64)
+        digits = space.digits(index)
+        canonical = space.canonical(digits)
+        index = index[canonical]
+        digits = digits[canonical]
+        scores = score(analyse_batch(space.batch(base, digits)))
+        counts['scored'] += len(index)
+        promising = scores > threshold  # NaN scores are dropped as well
+        counts['pruned'] += len(index) - int(promising.sum())
+        if not promising.any():
+            continue
+        index = index[promising]
+        scores = scores[promising]
+        valid = valid_mask(check_batch(space.batch(base, digits[promising])))
+        counts['invalid'] += len(index) - int(valid.sum())
+        best_scores = numpy.concatenate([best_scores, scores[valid]])
+        best_indices = numpy.concatenate([best_indices, index[valid]])
+        order = numpy.argsort(-best_scores, kind='mergesort')[:top]
+        best_scores = best_scores[order]
+        best_indices = best_indices[order]
+        if len(best_scores) == top:
+            threshold = max(threshold, best_scores[-1])
+    return best_scores, best_indices, counts
+
+
+def base_parameters(tcu_params, num_pulses, pulse_width=None):
+    """ returns the values of tcu_params shared by every schedule of
+        num_pulses pulses; the total number of PRIs is kept
+    """
+    params = tcu_params.snapshot().to_dict()
+    base = dict((name, params[name]) for name in ParameterBatch.SCALARS)
+    base['num_pulses'] = num_pulses
+    base['num_repeats'] = params['num_pulses'] * params['num_repeats'] // num_pulses
+    if pulse_width is None:
+        pulse_width = params['pulses'][0]['pulse_width'] if params['pulses'] else 0
+    base['pulse_width'] = pulse_width
+    base['clk_period_ns'] = params['clk_period_ns']
+    return base
+
+
+def optimise(tcu_params, space, objective='range', top=10, pulse_width=None, jobs=None,
+             task_size=262144, window=None):
+    """ searches space for the best 'top' valid schedules of tcu_params
+
+        tasks of task_size candidates run in a process pool with at most
+        'window' in flight. Each task is given the score of the worst of the
+        best schedules found so far, so later tasks prune more.
+        Returns (scores, schedules, counts) where schedules are lists of
+        pulse dictionaries, best first.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError('unknown objective "{}"'.format(objective))
+    base = base_parameters(tcu_params, space.num_pulses, pulse_width)
+    best_scores = numpy.empty(0)
+    best_indices = numpy.empty(0, dtype=numpy.int64)
+    threshold = -numpy.inf
+    counts = {'scored': 0, 'pruned': 0, 'invalid': 0}
+    # threshold is read as each task is submitted
+    tasks = ((space, base, start, min(space.size, start + task_size), objective, top, threshold)
+             for start in range(0, space.size, task_size))
+    for scores, indices, task_counts in pool_map(search_range, tasks, jobs, window):
+        for name in counts:
+            counts[name] += task_counts[name]
+        best_scores = numpy.concatenate([best_scores, scores])
+        best_indices = numpy.concatenate([best_indices, indices])
+        order = numpy.lexsort((best_indices, -best_scores))[:top]
+        best_scores = best_scores[order]
+        best_indices = best_indices[order]
+        if len(best_scores) == top:
+            threshold = max(threshold, best_scores[-1])
+    pri, pol_mode, frequency = space.schedule(space.digits(best_indices))
+    schedules = [[{'pulse_width': base['pulse_width'], 'pri': float(pri[row, pulse]),
+                   'pol_mode': int(pol_mode[row, pulse]), 'frequency': float(frequency[row, pulse])}
+                  for pulse in range(space.num_pulses)] for row in range(len(best_indices))]
+    return best_scores.tolist(), schedules, counts
+
+
+if __name__ == '__main__':
+
+    # -------------------------------------------------------------------------
+    # PARSE COMMAND LINE ARGUMENTS
+    # -------------------------------------------------------------------------
+    clargparser = argparse.ArgumentParser(usage='optimiser.py [options] -n PULSES --pri PRIS HEADER',
+                                          description='Staggered pulse schedule optimiser for '
+                                                      'NeXtRAD header files')
+    clargparser.add_argument('headerfile', help='header file holding the other parameters')
+    clargparser.add_argument('-n', '--num-pulses', type=int, required=True,
+                             help='pulses per schedule (1-{})'.format(MAX_PULSES))
+    clargparser.add_argument('--pri', required=True, help='PRIs in us, "500,1000" or "500:2000:250"')
+    clargparser.add_argument('--pol-mode', default='0:7:1', help='pol_modes [0:7:1]')
+    clargparser.add_argument('--frequency', help='frequencies in MHz [those of the header]')
+    clargparser.add_argument('--pulse-width', type=float, help='pulse width in us [that of the first pulse]')
+    clargparser.add_argument('-O', '--objective', default='range', choices=list(OBJECTIVES),
+                             help='maximise the unambiguous range, the first blind speed '
+                                  'or their product [range]')
+    clargparser.add_argument('-k', '--top', type=int, default=10, help='schedules to report [10]')
+    clargparser.add_argument('-o', '--output', help='write the best schedule to this header file')
+    clargparser.add_argument('-j', '--jobs', type=int, default=None,
+                             help='number of worker processes [cpu count]')
+    args = clargparser.parse_args()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(console)
+    logger.setLevel(logging.INFO)
+
+    try:
+        tcu_params = TCUParams(args.headerfile)
+    except HeaderParseError as e:
+        logger.error('failed to parse header file: {}'.format(e))
+        sys.exit(65)
+    if args.frequency:
+        frequencies = parse_values(args.frequency)
+    else:
+        frequencies = [pulse['frequency'] for pulse in tcu_params.pulses]
+    try:
+        space = SearchSpace(args.num_pulses, parse_values(args.pri), parse_values(args.pol_mode, int),
+                            frequencies)
+    except ValueError as e:
+        clargparser.error(str(e))
+
+    start_time = time.time()
+    scores, schedules, counts = optimise(tcu_params, space, args.objective, args.top,
+                                         args.pulse_width, args.jobs)
+    elapsed = time.time() - start_time
+
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Rank', args.objective.capitalize(), 'PRIs [us]', 'Modes', 'Frequencies [MHz]']
+    for rank, (score, schedule) in enumerate(zip(scores, schedules), 1):
+        ptable.add_row([rank, '{:.6g}'.format(score),
+                        ','.join('{:g}'.format(pulse['pri']) for pulse in schedule),
+                        ','.join(str(pulse['pol_mode']) for pulse in schedule),
+                        ','.join('{:g}'.format(pulse['frequency']) for pulse in schedule)])
+    print(ptable)
+    logger.info('searched {} candidates in {:.2f}s: {} scored, {} pruned, {} invalid'.format(
+        space.size, elapsed, counts['scored'], counts['pruned'], counts['invalid']))
+
+    if not schedules:
+        logger.error('no valid schedule found')
+        sys.exit(1)
+    if args.output:
+        params = tcu_params.snapshot().to_dict()
+        params['pulses'] = schedules[0]
+        params['num_pulses'] = space.num_pulses
+        params['num_repeats'] = base_parameters(tcu_params, space.num_pulses)['num_repeats']
+        hfparser = HeaderFileParser()
+        hfparser.file_name = args.headerfile
+        hfparser.set_tcu_params(params)
+        hfparser.write_header(args.output)
+        logger.info('best schedule written to {}'.format(args.output))
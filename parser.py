@@ -1,55 +1,498 @@
-import configparser
+import collections
+import functools
+import hashlib
 import logging
+import os
 import os.path
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import types
+import numpy
 import prettytable
 
+from registers import PULSE_FIELDS, PULSE_FIELD_BYTES, encode_registers
+
+PULSE_PARAMETERS_SECTION = 'PulseParameters'
+NODE_SEPARATOR = ':'  # [PulseParameters:<node>] overrides values on one node
+
+# TICK MODEL:
+# ---------------------
+# header durations are decimal microseconds. They are converted to whole
+# picoseconds first, rounding away the binary error of the float (2.3 us is
+# 2299999.9999999995 ps as a float), and from there to clock ticks with
+# integer division only, so a duration that is a whole number of clock
+# periods always gives exactly that number of ticks.
+DEFAULT_CLK_PERIOD_NS = 10
+PICOSECONDS_PER_MICROSECOND = 10**6
+
+
+class HeaderParseError(ValueError):
+    """Raised when the [PulseParameters] section of a header file is malformed
+
+    line and column are 1-based and refer to the header file; either may be
+    None when the error cannot be pinned to a location.
+    """
+    def __init__(self, message, file_name=None, line=None, column=None):
+        ValueError.__init__(self, message)
+        self.message = message
+        self.file_name = file_name
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        location = ''
+        if self.file_name:
+            location += str(self.file_name) + ':'
+        if self.line is not None:
+            location += str(self.line) + ':'
+            if self.column is not None:
+                location += str(self.column) + ':'
+        if location:
+            return location + ' ' + self.message
+        return self.message
+
+
+class _ExpressionCompiler(object):
+    """Recursive descent compiler for numeric header expressions
+
+    grammar:
+        expr   := term (('+' | '-') term)*
+        term   := unary (('*' | '/' | '//') unary)*
+        unary  := ('+' | '-') unary | atom
+        atom   := NUMBER | '(' expr ')'
+
+    Header expressions only contain literals, so compiling an expression folds
+    it into a single constant. Operators follow python semantics ('/' returns
+    a float, '//' floors), which keeps results identical to the eval() based
+    parser this replaces.
+    """
+    _TOKEN_RE = re.compile(r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                           r'|(?P<op>//|[-+*/()]))')
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = self._tokenize(source)
+        self.index = 0
+
+    def _tokenize(self, source):
+        tokens = list()
+        position = 0
+        end = len(source.rstrip())
+        while position < end:
+            match = self._TOKEN_RE.match(source, position)
+            if match is None:
+                column = position + len(source[position:]) - len(source[position:].lstrip())
+                raise HeaderParseError('unexpected character {!r} in expression {!r}'
+                                       .format(source[column], source), column=column + 1)
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind), match.start(kind) + 1))
+            position = match.end()
+        tokens.append(('end', '', end + 1))
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.index]
+
+    def _next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def compile(self):
+        if self._peek()[0] == 'end':
+            raise HeaderParseError('empty expression', column=1)
+        value = self._expr()
+        kind, text, column = self._peek()
+        if kind != 'end':
+            raise HeaderParseError('unexpected {!r} in expression {!r}'
+                                   .format(text, self.source), column=column)
+        return value
+
+    def _expr(self):
+        value = self._term()
+        while self._peek()[1] in ('+', '-'):
+            kind, op, column = self._next()
+            rhs = self._term()
+            value = value + rhs if op == '+' else value - rhs
+        return value
+
+    def _term(self):
+        value = self._unary()
+        while self._peek()[1] in ('*', '/', '//'):
+            kind, op, column = self._next()
+            rhs = self._unary()
+            if op == '*':
+                value = value * rhs
+            elif rhs == 0:
+                raise HeaderParseError('division by zero in expression {!r}'
+                                       .format(self.source), column=column)
+            elif op == '/':
+                value = value / rhs
+            else:
+                value = value // rhs
+        return value
+
+    def _unary(self):
+        if self._peek()[1] in ('+', '-'):
+            kind, op, column = self._next()
+            value = self._unary()
+            return value if op == '+' else -value
+        return self._atom()
+
+    def _atom(self):
+        kind, text, column = self._next()
+        if kind == 'number':
+            if '.' in text or 'e' in text or 'E' in text:
+                return float(text)
+            return int(text)
+        if text == '(':
+            value = self._expr()
+            kind, text, column = self._next()
+            if text != ')':
+                raise HeaderParseError('expected \')\' in expression {!r}'
+                                       .format(self.source), column=column)
+            return value
+        if kind == 'end':
+            raise HeaderParseError('unexpected end of expression {!r}'
+                                   .format(self.source), column=column)
+        raise HeaderParseError('unexpected {!r} in expression {!r}'
+                               .format(text, self.source), column=column)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_expression(source):
+    """ compiles a numeric expression (numbers, + - * / //, parentheses)
+
+        compiled expressions are cached, so headers rewritten with the same
+        values are not re-tokenised. raises HeaderParseError with a column
+        relative to the start of source.
+    """
+    return _ExpressionCompiler(source).compile()
+
+
+def evaluate_expression(source, file_name=None, line=None, column=1):
+    """ returns the value of a numeric expression taken from a header file
+
+        column is the position of source within its line, used to report
+        errors relative to the header file
+    """
+    try:
+        return compile_expression(source)
+    except HeaderParseError as e:
+        raise HeaderParseError(e.message, file_name, line,
+                               None if e.column is None else column + e.column - 1)
+
+
+def _read_sections(lines, select):
+    """ extracts the raw key/value pairs of the sections picked by select
+
+        select maps a section name to the key it is returned under, or None
+        to skip the section. Returns an ordered dictionary mapping key ->
+        section, where each section is an ordered dictionary mapping key ->
+        (value, line, column) and line and column locate the value in the
+        file. Comment prefixes follow the cnc software ('/'), and '#' or ';'
+        lines are skipped as well.
+    """
+    sections = collections.OrderedDict()
+    params = None
+    key = None
+    for line_number, raw_line in enumerate(lines, 1):
+        stripped = raw_line.strip()
+        if not stripped or stripped[0] in '/#;':
+            continue
+        if stripped[0] == '[' and stripped.endswith(']'):
+            name = select(stripped[1:-1].strip())
+            params = None if name is None else sections.setdefault(name, collections.OrderedDict())
+            key = None
+            continue
+        if params is None:
+            continue
+        if raw_line[0].isspace() and key is not None:
+            # continuation of a multi-line value
+            value, line, column = params[key]
+            params[key] = (value + '\n' + stripped, line, column)
+            continue
+        delimiter = len(raw_line)
+        for char in '=:':
+            position = raw_line.find(char)
+            if position != -1:
+                delimiter = min(delimiter, position)
+        key = raw_line[:delimiter].strip()
+        if delimiter == len(raw_line):
+            # key without a value
+            params[key] = ('', line_number, len(raw_line.rstrip('\r\n')) + 1)
+            continue
+        value = raw_line[delimiter + 1:].rstrip('\r\n')
+        column = delimiter + 2 + len(value) - len(value.lstrip())
+        params[key] = (value.strip(), line_number, column)
+    return sections
+
+
+def read_pulse_parameters(lines, section=PULSE_PARAMETERS_SECTION):
+    """ extracts the raw key/value pairs of a section from header file lines
+
+        returns None if the section does not exist, otherwise an ordered
+        dictionary mapping key -> (value, line, column), where line and column
+        locate the value in the file. Only the requested section is parsed.
+    """
+    return _read_sections(lines, lambda name: name if name == section else None).get(section)
+
+
+def read_node_parameters(lines, section=PULSE_PARAMETERS_SECTION):
+    """ extracts a section and its per-node override sections in one pass
+
+        override sections are named [<section>:<node>], e.g.
+        [PulseParameters:node1], and hold only the keys that differ on that
+        node. Returns (section, nodes) where section is as returned by
+        read_pulse_parameters() and nodes is an ordered dictionary mapping
+        node -> override section.
+    """
+    def select(name):
+        # the shared section is returned under '', node names are never empty
+        if name == section:
+            return ''
+        name, separator, node = name.partition(NODE_SEPARATOR)
+        if separator and name.strip() == section and node.strip():
+            return node.strip()
+        return None
+
+    sections = _read_sections(lines, select)
+    base = sections.pop('', None)
+    return base, sections
+
+
+def _values_equal(key, old, new):
+    """ returns True if two header values describe the same parameter value """
+    if old == new:
+        return True
+    try:
+        if key == 'PULSES':
+            old_pulses = [pulse.split(',') for pulse in old.replace('"', '').split('|')]
+            new_pulses = [pulse.split(',') for pulse in new.replace('"', '').split('|')]
+            return (len(old_pulses) == len(new_pulses) and
+                    all(len(old_fields) == len(new_fields) and
+                        all(compile_expression(o) == compile_expression(n)
+                            for o, n in zip(old_fields, new_fields))
+                        for old_fields, new_fields in zip(old_pulses, new_pulses)))
+        return compile_expression(old) == compile_expression(new)
+    except HeaderParseError:
+        return False
+
+
+def patch_section(lines, values, section=PULSE_PARAMETERS_SECTION):
+    """ returns header file lines with the keys of a section set to values
+
+        lines are kept as they are unless the key they hold has a different
+        value, in which case only the value part of the line is replaced
+        (continuation lines of the old value are dropped). Keys missing from
+        the section are appended to it, and the section is appended to the
+        file if it does not exist.
+    """
+    newline = '\n'
+    for line in lines:
+        if line.endswith('\r\n'):
+            newline = '\r\n'
+            break
+        if line.endswith('\n'):
+            break
+    patched = list()
+    remaining = collections.OrderedDict(values)
+    in_section = False
+    section_found = False
+    insert_at = None
+
+    def append_missing():
+        new_lines = ['{} = {}{}'.format(key, value, newline) for key, value in remaining.items()]
+        patched[insert_at:insert_at] = new_lines
+        remaining.clear()
+
+    index = 0
+    while index < len(lines):
+        raw_line = lines[index]
+        index += 1
+        stripped = raw_line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            if in_section:
+                append_missing()
+            in_section = stripped[1:-1].strip() == section
+            section_found = section_found or in_section
+            patched.append(raw_line)
+            insert_at = len(patched)
+            continue
+        if not in_section or not stripped or stripped[0] in '/#;':
+            patched.append(raw_line)
+            continue
+        # a key line and the continuation lines of its value
+        group = [raw_line]
+        while (index < len(lines) and lines[index][:1].isspace() and lines[index].strip()
+               and lines[index].strip()[0] not in '/#;'):
+            group.append(lines[index])
+            index += 1
+        delimiter = len(raw_line)
+        for char in '=:':
+            position = raw_line.find(char)
+            if position != -1:
+                delimiter = min(delimiter, position)
+        key = raw_line[:delimiter].strip()
+        if key in remaining:
+            value = remaining.pop(key)
+            old_value = raw_line[delimiter + 1:].strip() if delimiter < len(raw_line) else ''
+            old_value = '\n'.join([old_value] + [line.strip() for line in group[1:]])
+            if not _values_equal(key, old_value, value):
+                body = raw_line.rstrip('\r\n')
+                ending = raw_line[len(body):] or newline
+                value = value.replace('\n', newline + '\t')
+                if delimiter == len(raw_line):
+                    group = ['{} = {}{}'.format(body.rstrip(), value, ending)]
+                else:
+                    rest = body[delimiter + 1:]
+                    padding = rest[:len(rest) - len(rest.lstrip())]
+                    group = [body[:delimiter + 1] + padding + value + ending]
+        patched.extend(group)
+        insert_at = len(patched)
+
+    if in_section:
+        append_missing()
+    if not section_found:
+        if patched and not patched[-1].endswith(('\n', '\r')):
+            patched[-1] += newline
+        if patched and patched[-1].strip():
+            patched.append(newline)
+        patched.append('[{}]{}'.format(section, newline))
+        insert_at = len(patched)
+        append_missing()
+    return patched
+
+
+def write_file_atomic(file_name, content, binary=False):
+    """ replaces a file with new content without exposing partial writes
+
+        content is written to a temporary file in the same directory, which
+        then replaces file_name. Nothing is written if file_name already
+        holds content, so file watchers see no event. Returns True if the
+        file was written.
+    """
+    mode = 'b' if binary else ''
+    if os.path.isfile(file_name):
+        with open(file_name, 'r' + mode, **({} if binary else {'newline': ''})) as old_file:
+            if old_file.read() == content:
+                return False
+    directory = os.path.dirname(os.path.abspath(file_name))
+    handle, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_name) + '.')
+    try:
+        with open(handle, 'w' + mode, **({} if binary else {'newline': ''})) as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if os.path.isfile(file_name):
+            shutil.copymode(file_name, temp_name)
+        else:
+            os.chmod(temp_name, 0o666 & ~_umask())
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    return True
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
 class HeaderFileParser(object):
     """NeXtRAD.ini File Parser"""
+
+    DEFAULT_PARAMS = collections.OrderedDict([('WAVEFORM_INDEX', '0'),
+                                              ('NUM_PRIS', '0'),
+                                              ('PRE_PULSE', '0'),
+                                              ('PRI_PULSE_WIDTH', '0'),
+                                              ('X_AMP_DELAY', '0'),
+                                              ('L_AMP_DELAY', '0'),
+                                              ('REX_DELAY', '0'),
+                                              ('DAC_DELAY', '0'),
+                                              ('ADC_DELAY', '0'),
+                                              ('SAMPLES_PER_PRI', '0'),
+                                              ('PULSES', '""')])
+
+    # keys evaluated into a single value of get_tcu_params()
+    SCALAR_PARAMS = collections.OrderedDict([('PRI_PULSE_WIDTH', 'pri_pulse_width'),
+                                             ('PRE_PULSE', 'pre_pulse'),
+                                             ('X_AMP_DELAY', 'x_amp_delay'),
+                                             ('L_AMP_DELAY', 'l_amp_delay'),
+                                             ('REX_DELAY', 'rex_delay'),
+                                             ('DAC_DELAY', 'dac_delay'),
+                                             ('ADC_DELAY', 'adc_delay'),
+                                             ('SAMPLES_PER_PRI', 'samples_per_pri'),
+                                             ('WAVEFORM_INDEX', 'waveform_index')])
+
+    # optional, DEFAULT_CLK_PERIOD_NS when not in the header
+    CLK_PERIOD_PARAM = 'CLK_PERIOD_NS'
+
     def __init__(self, file_name=''):
         self.logger = logging.getLogger('header_file_parser_logger')
-        self.file_parser = configparser.ConfigParser(comment_prefixes='/', allow_no_value=True)
-        self.file_parser.optionxform = str  # retain upper case for keys
-        self.file_parser['PulseParameters'] = {'WAVEFORM_INDEX': '0',
-                                               'NUM_PRIS': '0',
-                                               'PRE_PULSE': '0',
-                                               'PRI_PULSE_WIDTH': '0',
-                                               'X_AMP_DELAY': '0',
-                                               'L_AMP_DELAY': '0',
-                                               'REX_DELAY': '0',
-                                               'DAC_DELAY': '0',
-                                               'ADC_DELAY': '0',
-                                               'SAMPLES_PER_PRI': '0',
-                                               'PULSES': '""'}
+        self.file_name = file_name
+        # raw [PulseParameters] values, and where they were found in the file
+        self.pulse_params = collections.OrderedDict(self.DEFAULT_PARAMS)
+        self.locations = dict()
+        self.section_found = False
+        # raw values of the [PulseParameters:<node>] sections, by node
+        self.node_params = collections.OrderedDict()
+        self.node_locations = dict()
         if file_name != '':
             self.read_header(file_name)
 
     def __str__(self):
         params = ''
-        params += 'waveform_index: ' + str(self.file_parser['PulseParameters']['WAVEFORM_INDEX']) + '\n'
-        params += 'num_pris: ' + str(self.file_parser['PulseParameters']['NUM_PRIS']) + '\n'
-        params += 'pre_pulse: ' + str(self.file_parser['PulseParameters']['PRE_PULSE']) + '\n'
-        params += 'pri_pulse_width: ' + str(self.file_parser['PulseParameters']['PRI_PULSE_WIDTH']) + '\n'
-        params += 'x_amp_delay: ' + str(self.file_parser['PulseParameters']['X_AMP_DELAY']) + '\n'
-        params += 'l_amp_delay: ' + str(self.file_parser['PulseParameters']['L_AMP_DELAY']) + '\n'
-        params += 'rex_delay: ' + str(self.file_parser['PulseParameters']['REX_DELAY']) + '\n'
-        params += 'dac_delay: ' + str(self.file_parser['PulseParameters']['DAC_DELAY']) + '\n'
-        params += 'adc_delay: ' + str(self.file_parser['PulseParameters']['ADC_DELAY']) + '\n'
-        params += 'samples_per_pri: ' + str(self.file_parser['PulseParameters']['SAMPLES_PER_PRI']) + '\n'
-        params += 'pulses: ' + self.file_parser['PulseParameters']['PULSES']
+        params += 'waveform_index: ' + str(self.pulse_params['WAVEFORM_INDEX']) + '\n'
+        params += 'num_pris: ' + str(self.pulse_params['NUM_PRIS']) + '\n'
+        params += 'pre_pulse: ' + str(self.pulse_params['PRE_PULSE']) + '\n'
+        params += 'pri_pulse_width: ' + str(self.pulse_params['PRI_PULSE_WIDTH']) + '\n'
+        params += 'x_amp_delay: ' + str(self.pulse_params['X_AMP_DELAY']) + '\n'
+        params += 'l_amp_delay: ' + str(self.pulse_params['L_AMP_DELAY']) + '\n'
+        params += 'rex_delay: ' + str(self.pulse_params['REX_DELAY']) + '\n'
+        params += 'dac_delay: ' + str(self.pulse_params['DAC_DELAY']) + '\n'
+        params += 'adc_delay: ' + str(self.pulse_params['ADC_DELAY']) + '\n'
+        params += 'samples_per_pri: ' + str(self.pulse_params['SAMPLES_PER_PRI']) + '\n'
+        params += 'pulses: ' + self.pulse_params['PULSES']
         return params
 
     def read_header(self, file_name):
         """ Parses a given header file for TCU parameters """
-
-        self.header_file = self.file_parser.read(file_name)
-        if len(self.header_file) > 0:
-            if not self.file_parser.has_section('PulseParameters'):
-                self.logger.error('No "PulseParameters" section found in '
-                                  'header file "{}"'.format(file_name))
-        else:
+        self.file_name = file_name
+        try:
+            with open(file_name) as header_file:
+                section, nodes = read_node_parameters(header_file)
+        except OSError:
             self.logger.error('Could not find header file "{}", no '
                               'parameters extracted'.format(file_name))
+            return
+        self.load_section(section, file_name, nodes)
+
+    def load_section(self, section, file_name='', nodes=None):
+        """ loads a section previously extracted by read_pulse_parameters(),
+            and optionally the node sections from read_node_parameters()
+        """
+        self.file_name = file_name
+        for node, node_section in (nodes or dict()).items():
+            self.node_params[node] = collections.OrderedDict(
+                (key, value) for key, (value, line, column) in node_section.items())
+            self.node_locations[node] = dict(
+                (key, (line, column)) for key, (value, line, column) in node_section.items())
+        if section is None:
+            self.logger.error('No "PulseParameters" section found in '
+                              'header file "{}"'.format(file_name))
+            return
+        self.section_found = True
+        for key, (value, line, column) in section.items():
+            self.pulse_params[key] = value
+            self.locations[key] = (line, column)
 
     def get_tcu_params(self):
         """ Returns a dictionary containing TCU parameters
@@ -72,66 +515,155 @@ class HeaderFileParser(object):
                 'adc_delay'         ->  int
                 'samples_per_pri'   ->  int
                 'waveform_index'    ->  int
+                'clk_period_ns'     ->  int or float
+
+            raises HeaderParseError if a value is missing or malformed
         """
         tcu_params = dict()
-        if self.file_parser.has_section('PulseParameters'):
-            pulses = self._extract_param('PULSES')
-            pulses = pulses.replace('"', '')
-            pulses_list = pulses.split('|')
-            if pulses_list == ['']:
-                pulses_list.clear()
-            tcu_params['num_pulses'] = len(pulses_list)
-            num_pris = eval(self._extract_param('NUM_PRIS'))
-            if tcu_params['num_pulses'] != 0:
-                tcu_params['num_repeats'] = num_pris//tcu_params['num_pulses']
-            else:
-                tcu_params['num_repeats'] = 0
-            tcu_params['pri_pulse_width'] = eval(self._extract_param('PRI_PULSE_WIDTH'))
-            tcu_params['pre_pulse'] = eval(self._extract_param('PRE_PULSE'))
-            tcu_params['x_amp_delay'] = eval(self._extract_param('X_AMP_DELAY'))
-            tcu_params['l_amp_delay'] = eval(self._extract_param('L_AMP_DELAY'))
-            tcu_params['rex_delay'] = eval(self._extract_param('REX_DELAY'))
-            tcu_params['dac_delay'] = eval(self._extract_param('DAC_DELAY'))
-            tcu_params['adc_delay'] = eval(self._extract_param('ADC_DELAY'))
-            tcu_params['samples_per_pri'] = eval(self._extract_param('SAMPLES_PER_PRI'))
-            tcu_params['waveform_index'] = eval(self._extract_param('WAVEFORM_INDEX'))
-            tcu_params['pulses'] = []
-            for pulse in pulses_list:
-                pulse_params = pulse.split(',')
-                pulse_param_dict = {'pulse_width':eval(pulse_params[0]),
-                                    'pri':eval(pulse_params[1]),
-                                    'pol_mode':eval(pulse_params[2]),
-                                    'frequency':eval(pulse_params[3])}
-                tcu_params['pulses'].append(pulse_param_dict)
+        pulses_list = self._extract_pulses()
+        tcu_params['num_pulses'] = len(pulses_list)
+        tcu_params['num_repeats'] = self._num_repeats(tcu_params['num_pulses'])
+        for key, name in self.SCALAR_PARAMS.items():
+            tcu_params[name] = self._eval_param(key)
+        tcu_params['pulses'] = pulses_list
+        tcu_params['clk_period_ns'] = self.clk_period_ns()
         return tcu_params
 
+    def nodes(self):
+        """ returns the names of the nodes with an override section """
+        return list(self.node_params)
+
+    def node_parser(self, node):
+        """ returns a HeaderFileParser holding the values of a node: the
+            shared [PulseParameters] with the node's overrides layered on top
+
+            raises KeyError for an unknown node
+        """
+        overrides = self.node_params[node]
+        hfparser = HeaderFileParser()
+        hfparser.file_name = self.file_name
+        hfparser.section_found = self.section_found
+        hfparser.pulse_params.update(self.pulse_params)
+        hfparser.pulse_params.update(overrides)
+        hfparser.locations.update(self.locations)
+        hfparser.locations.update(self.node_locations[node])
+        return hfparser
+
+    def get_node_params(self):
+        """ returns an ordered dictionary mapping every node to its TCU
+            parameters, laid out like get_tcu_params()
+
+            the shared values are evaluated once, each node only evaluates
+            the keys it overrides. Nodes that do not override PULSES share
+            the pulse dictionaries of the shared section.
+
+            raises HeaderParseError if a value is missing or malformed
+        """
+        shared = self.get_tcu_params()
+        node_params = collections.OrderedDict()
+        for node, overrides in self.node_params.items():
+            hfparser = self.node_parser(node)
+            tcu_params = dict(shared)
+            if 'PULSES' in overrides:
+                tcu_params['pulses'] = hfparser._extract_pulses()
+                tcu_params['num_pulses'] = len(tcu_params['pulses'])
+            if 'PULSES' in overrides or 'NUM_PRIS' in overrides:
+                tcu_params['num_repeats'] = hfparser._num_repeats(tcu_params['num_pulses'])
+            for key in overrides:
+                if key in self.SCALAR_PARAMS:
+                    tcu_params[self.SCALAR_PARAMS[key]] = hfparser._eval_param(key)
+            if self.CLK_PERIOD_PARAM in overrides:
+                tcu_params['clk_period_ns'] = hfparser.clk_period_ns()
+            node_params[node] = tcu_params
+        return node_params
+
+    def clk_period_ns(self):
+        """ returns the clock period the durations are converted with
+
+            raises HeaderParseError if CLK_PERIOD_NS is malformed or not
+            positive
+        """
+        if self.CLK_PERIOD_PARAM not in self.pulse_params:
+            return DEFAULT_CLK_PERIOD_NS
+        value = self._eval_param(self.CLK_PERIOD_PARAM)
+        if clock_period_ps(value) <= 0:
+            line, column = self.locations.get(self.CLK_PERIOD_PARAM, (None, 1))
+            raise HeaderParseError('{} must be at least 1 ps, got {}'.format(self.CLK_PERIOD_PARAM, value),
+                                   self.file_name, line, column)
+        return value
+
+    def _num_repeats(self, num_pulses):
+        num_pris = self._eval_param('NUM_PRIS')
+        if num_pulses != 0:
+            return num_pris//num_pulses
+        return 0
+
     def _extract_param(self, param):
-        """ returns the value of given param name
+        """ returns the raw value of given param name and its (line, column)
 
-            program exists if parameter is not found
+            raises HeaderParseError if parameter is not found
         """
-        result = ""
         try:
-            result = self.file_parser['PulseParameters'][param]
-        except Exception as e:
-            self.logger.error('Could not find required parameter "{}"'
-                              .format(param, self.file_name))
-            exit(65)
-        return result
-
-
-    # NOTE: Simply using 'self.file_parser.write(headerfile)' will change the
-    #       existing header's format and remove its comments. This could be
-    #       fixed using configobj module. For now, a temporary ini file is
-    #       generated for the cnc cpp software to parse.
+            result = self.pulse_params[param]
+        except KeyError:
+            raise HeaderParseError('Could not find required parameter "{}"'
+                                   .format(param), self.file_name)
+        return result, self.locations.get(param, (None, 1))
+
+    def _eval_param(self, param):
+        value, (line, column) = self._extract_param(param)
+        return evaluate_expression(value, self.file_name, line, column)
+
+    def _extract_pulses(self):
+        """ returns the list of pulse dictionaries described by PULSES """
+        value, (line, column) = self._extract_param('PULSES')
+        pulses_list = list()
+        if value.replace('"', '').strip() == '':
+            return pulses_list
+        # column offsets are tracked so errors point at the offending field
+        offset = 0
+        for pulse in value.split('|'):
+            fields = list()
+            field_offset = offset
+            for field in pulse.split(','):
+                fields.append((field.replace('"', ''), field_offset))
+                field_offset += len(field) + 1
+            offset += len(pulse) + 1
+            if len(fields) != len(PULSE_FIELDS):
+                raise HeaderParseError('pulse "{}" has {} fields, expected {} '
+                                       '(pulse_width,pri,pol_mode,frequency)'
+                                       .format(pulse, len(fields), len(PULSE_FIELDS)),
+                                       self.file_name, line, column + fields[0][1])
+            pulse_param_dict = dict()
+            for name, (field, field_offset) in zip(PULSE_FIELDS, fields):
+                pulse_param_dict[name] = evaluate_expression(field, self.file_name, line,
+                                                             column + field_offset)
+            pulses_list.append(pulse_param_dict)
+        return pulses_list
+
     def write_header(self, file_name):
-        """ writes tcu params to header file """
-        with open(file_name, 'w') as configfile:
-            self.file_parser.write(configfile)
-            # configfile.write('# Intermediary ini file for TCU\n')
-            # configfile.write('[PulseParameters]\n')
-            # for key in self.file_parser['PulseParameters']:
-            #     configfile.write(key + ' = ' + self.file_parser['PulseParameters'][key]+'\n')
+        """ writes tcu params to header file
+
+            only the [PulseParameters] keys whose values changed are rewritten,
+            everything else in the file (comments, ordering, other sections)
+            is kept. A header file that does not exist yet is based on the
+            header these params were read from. The file is replaced
+            atomically and left untouched if its contents would not change.
+
+            returns True if the file was written
+        """
+        lines = list()
+        for template in (file_name, self.file_name):
+            if template and os.path.isfile(template):
+                with open(template, newline='') as template_file:
+                    lines = template_file.readlines()
+                break
+        content = ''.join(patch_section(lines, self.pulse_params))
+        if write_file_atomic(file_name, content):
+            self.logger.debug('header file "{}" written'.format(file_name))
+            return True
+        self.logger.debug('header file "{}" unchanged, not written'.format(file_name))
+        return False
 
     def set_tcu_params(self, params):
         """ sets parser with given parameters
@@ -154,35 +686,460 @@ class HeaderFileParser(object):
                 'adc_delay'         ->  int
                 'samples_per_pri'   ->  int
                 'waveform_index'    ->  int
+
+            and optionally 'clk_period_ns', only written if it is not the
+            default or the header already sets it
         """
         # TODO: check that all the required items exist in the params argument
-        self.file_parser['PulseParameters']['PULSES'] = '"'
+        self.pulse_params['PULSES'] = '"'
         for index, pulse in enumerate(params['pulses']):
-            self.file_parser['PulseParameters']['PULSES'] += str(pulse['pulse_width'])+','+str(pulse['pri'])+','+str(pulse['pol_mode'])+','+str(pulse['frequency'])
+            self.pulse_params['PULSES'] += str(pulse['pulse_width'])+','+str(pulse['pri'])+','+str(pulse['pol_mode'])+','+str(pulse['frequency'])
             if index < (len(params['pulses']) - 1):
-                self.file_parser['PulseParameters']['PULSES'] += '|'
-        self.file_parser['PulseParameters']['PULSES'] += '"'
-        self.file_parser['PulseParameters']['NUM_PRIS'] = str(params['num_pulses'] * params['num_repeats'])
-        self.file_parser['PulseParameters']['PRI_PULSE_WIDTH'] = str(params['pri_pulse_width'])
-        self.file_parser['PulseParameters']['PRE_PULSE'] = str(params['pre_pulse'])
-        self.file_parser['PulseParameters']['X_AMP_DELAY'] = str(params['x_amp_delay'])
-        self.file_parser['PulseParameters']['L_AMP_DELAY'] = str(params['l_amp_delay'])
-        self.file_parser['PulseParameters']['REX_DELAY'] = str(params['rex_delay'])
-        self.file_parser['PulseParameters']['DAC_DELAY'] = str(params['dac_delay'])
-        self.file_parser['PulseParameters']['ADC_DELAY'] = str(params['adc_delay'])
-        self.file_parser['PulseParameters']['SAMPLES_PER_PRI'] = str(params['samples_per_pri'])
-        self.file_parser['PulseParameters']['WAVEFORM_INDEX'] = str(params['waveform_index'])
+                self.pulse_params['PULSES'] += '|'
+        self.pulse_params['PULSES'] += '"'
+        self.pulse_params['NUM_PRIS'] = str(params['num_pulses'] * params['num_repeats'])
+        self.pulse_params['PRI_PULSE_WIDTH'] = str(params['pri_pulse_width'])
+        self.pulse_params['PRE_PULSE'] = str(params['pre_pulse'])
+        self.pulse_params['X_AMP_DELAY'] = str(params['x_amp_delay'])
+        self.pulse_params['L_AMP_DELAY'] = str(params['l_amp_delay'])
+        self.pulse_params['REX_DELAY'] = str(params['rex_delay'])
+        self.pulse_params['DAC_DELAY'] = str(params['dac_delay'])
+        self.pulse_params['ADC_DELAY'] = str(params['adc_delay'])
+        self.pulse_params['SAMPLES_PER_PRI'] = str(params['samples_per_pri'])
+        self.pulse_params['WAVEFORM_INDEX'] = str(params['waveform_index'])
+        clk_period_ns = params.get('clk_period_ns', DEFAULT_CLK_PERIOD_NS)
+        if clk_period_ns != DEFAULT_CLK_PERIOD_NS or self.CLK_PERIOD_PARAM in self.pulse_params:
+            self.pulse_params[self.CLK_PERIOD_PARAM] = str(clk_period_ns)
+
+
+def freeze_tcu_params(params):
+    """ returns a read-only view of a get_tcu_params() dictionary """
+    frozen = dict(params)
+    frozen['pulses'] = tuple(types.MappingProxyType(dict(pulse)) for pulse in params['pulses'])
+    return types.MappingProxyType(frozen)
+
+
+class FrozenPulse(collections.namedtuple('FrozenPulse', PULSE_FIELDS)):
+    """Immutable pulse, hashable and comparable so it can be used as a key"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, pulse):
+        return cls(*[pulse[field] for field in PULSE_FIELDS])
+
+    def to_dict(self):
+        """ returns the pulse in the dictionary layout of get_tcu_params() """
+        return dict(zip(PULSE_FIELDS, self))
+
+
+SNAPSHOT_FIELDS = ('num_pulses', 'num_repeats', 'pri_pulse_width', 'pre_pulse', 'x_amp_delay',
+                   'l_amp_delay', 'rex_delay', 'dac_delay', 'adc_delay', 'samples_per_pri',
+                   'waveform_index', 'clk_period_ns', 'pulses')
+
+
+class ParamsSnapshot(collections.namedtuple('ParamsSnapshot', SNAPSHOT_FIELDS)):
+    """Immutable set of TCU parameters
+
+    Holds the values of get_tcu_params() with the pulses as a tuple of
+    FrozenPulse, and nothing else, so it is far smaller than a TCUParams
+    or a dictionary and can be used as a cache key.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, params):
+        """ builds a snapshot from a get_tcu_params() dictionary or a TCUParams """
+        if not isinstance(params, dict):
+            params = vars(params)
+        # dictionaries built by hand may leave out the clock period
+        params = dict(params, clk_period_ns=params.get('clk_period_ns', DEFAULT_CLK_PERIOD_NS))
+        values = [params[name] for name in SNAPSHOT_FIELDS[:-1]]
+        pulses = tuple(FrozenPulse.from_dict(pulse) for pulse in params['pulses'])
+        return cls(*(values + [pulses]))
+
+    def to_dict(self):
+        """ returns the parameters in the layout of get_tcu_params(), as
+            expected by HeaderFileParser.set_tcu_params()
+        """
+        params = dict(zip(SNAPSHOT_FIELDS, self))
+        params['pulses'] = [pulse.to_dict() for pulse in self.pulses]
+        return params
+
+
+class HeaderCache(object):
+    """Bounded LRU cache of parsed [PulseParameters] sections
+
+    Lookups are keyed on (path, size, mtime_ns) first. When the stat key is
+    unknown, or too recent to be trusted on filesystems with coarse
+    timestamps, the section is re-read and keyed on a hash of its contents,
+    so rewriting other sections of the header (or touching it) does not
+    trigger a re-evaluation.
+
+    Entries are (section, params) tuples where section is the raw output of
+    read_pulse_parameters() and params is a freeze_tcu_params() snapshot.
+    """
+
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, maxsize=32):
+        self.logger = logging.getLogger('header_file_parser_logger')
+        self.maxsize = maxsize
+        self._stat_keys = collections.OrderedDict()  # stat key -> content hash
+        self._entries = collections.OrderedDict()    # content hash -> entry
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.content_hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._stat_keys.clear()
+            self._entries.clear()
+
+    def lookup(self, file_name):
+        """ returns a (section, params) entry for the given header file
+
+            raises HeaderParseError if the header cannot be parsed, and
+            OSError if it cannot be read
+        """
+        stat = os.stat(file_name)
+        stat_key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        trusted = time.time() * 10**9 - stat.st_mtime_ns > self.RACY_WINDOW_NS
+        with self._lock:
+            content_hash = self._stat_keys.get(stat_key) if trusted else None
+            if content_hash is not None and content_hash in self._entries:
+                self.hits += 1
+                self._stat_keys.move_to_end(stat_key)
+                self._entries.move_to_end(content_hash)
+                self._log('hit', file_name)
+                return self._entries[content_hash]
+
+        with open(file_name) as header_file:
+            section = read_pulse_parameters(header_file)
+        content_hash = self._hash_section(section)
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None:
+                self.content_hits += 1
+                self._entries.move_to_end(content_hash)
+                self._remember(stat_key, content_hash, trusted)
+                self._log('content hit', file_name)
+                return entry
+
+        hfparser = HeaderFileParser()
+        hfparser.load_section(section, file_name)
+        entry = (section, freeze_tcu_params(hfparser.get_tcu_params()))
+        with self._lock:
+            self.misses += 1
+            self._entries[content_hash] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._remember(stat_key, content_hash, trusted)
+            self._log('miss', file_name)
+        return entry
+
+    def _remember(self, stat_key, content_hash, trusted):
+        if not trusted:
+            return
+        self._stat_keys[stat_key] = content_hash
+        self._stat_keys.move_to_end(stat_key)
+        while len(self._stat_keys) > self.maxsize:
+            self._stat_keys.popitem(last=False)
+
+    def _hash_section(self, section):
+        digest = hashlib.sha1()
+        if section is not None:
+            for key, (value, line, column) in section.items():
+                digest.update(key.encode('utf-8') + b'\0' + value.encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def _log(self, result, file_name):
+        self.logger.debug('header cache {} for "{}" [hits={}, content_hits={}, misses={}]'
+                          .format(result, file_name, self.hits, self.content_hits, self.misses))
+
+
+header_cache = HeaderCache()
+
+
+class PulseTable(object):
+    """Struct-of-arrays view of the pulses in an experiment
+
+    Holds one numpy array per pulse field so that tick conversion and range
+    checks run as array operations. TCUParams.pulses (a list of dictionaries)
+    remains the editable form; a PulseTable is built from it on demand.
+    """
+
+    DTYPES = {'pulse_width': numpy.float64,
+              'pri': numpy.float64,
+              'pol_mode': numpy.int64,
+              'frequency': numpy.float64}
+
+    def __init__(self, pulse_width, pri, pol_mode, frequency):
+        self.pulse_width = pulse_width
+        self.pri = pri
+        self.pol_mode = pol_mode
+        self.frequency = frequency
+
+    @classmethod
+    def from_pulses(cls, pulses):
+        """ builds a table from a list of pulse dictionaries """
+        columns = [numpy.array([pulse[field] for pulse in pulses], dtype=cls.DTYPES[field])
+                   for field in PULSE_FIELDS]
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self.pri)
+
+    def columns(self):
+        return [getattr(self, field) for field in PULSE_FIELDS]
+
+    def to_pulses(self):
+        """ returns the table as a list of pulse dictionaries """
+        return [dict(zip(PULSE_FIELDS, row))
+                for row in zip(*[column.tolist() for column in self.columns()])]
+
+    def to_register_values(self, clk_period_ns, pre_pulse_ticks):
+        """ returns a new table holding the integer values loaded into reg_pulses
+
+            pulse_width is converted to clock ticks, pri becomes the PRI offset
+            in clock ticks, (PRI) - pre_pulse - pulse_width, and pol_mode and
+            frequency are truncated to integers.
+        """
+        pulse_width = to_clock_ticks(self.pulse_width, clk_period_ns)
+        pri_offset = to_clock_ticks(self.pri, clk_period_ns) - pre_pulse_ticks - pulse_width
+        return PulseTable(pulse_width, pri_offset,
+                          self.pol_mode.astype(numpy.int64),
+                          self.frequency.astype(numpy.int64))
+
+    def range_violations(self):
+        """ returns (pulse index, field, value) for every register value that
+            does not fit its field in reg_pulses
+
+            only meaningful on a table returned by to_register_values()
+        """
+        violations = list()
+        for field in PULSE_FIELDS:
+            column = getattr(self, field)
+            limit = 1 << (8 * PULSE_FIELD_BYTES[field])
+            for index in numpy.flatnonzero((column < 0) | (column >= limit)).tolist():
+                violations.append((index, field, int(column[index])))
+        violations.sort()
+        return violations
+
+
+def to_picoseconds(x):
+    """ converts time durations in microseconds into whole picoseconds
+
+        returns an int for a scalar and an int64 array otherwise
+    """
+    if numpy.isscalar(x):
+        return int(round(x * PICOSECONDS_PER_MICROSECOND))
+    return numpy.rint(numpy.asarray(x, dtype=numpy.float64) * PICOSECONDS_PER_MICROSECOND).astype(numpy.int64)
+
+
+def clock_period_ps(clk_period_ns):
+    """ returns the clock period in whole picoseconds """
+    return int(round(clk_period_ns * 1000))
+
+
+def to_clock_ticks(x, clk_period_ns):
+    """ converts time durations in microseconds into numbers of clock ticks
+
+        works on scalars and numpy arrays, see TICK MODEL
+    """
+    return to_picoseconds(x) // clock_period_ps(clk_period_ns)
+
+
+class Pulse(dict):
+    """Pulse dictionary that reports in-place edits to its owner"""
+
+    def __init__(self, pulse=(), on_change=None):
+        dict.__init__(self, pulse)
+        self._on_change = on_change
+
+    def __reduce__(self):
+        return (Pulse, (dict(self),))
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        self._changed()
+        return value
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+
+class PulseList(list):
+    """List of Pulse dictionaries that reports additions, edits and removals
+
+    Plain dictionaries added to the list are converted to Pulse instances so
+    that editing a pulse in place is reported as well.
+    """
+
+    def __init__(self, pulses=(), on_change=None):
+        self._on_change = on_change
+        list.__init__(self, [self._wrap(pulse) for pulse in pulses])
+
+    def _wrap(self, pulse):
+        return Pulse(pulse, self._changed)
+
+    def __reduce__(self):
+        return (PulseList, ([dict(pulse) for pulse in self],))
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._wrap(pulse) for pulse in value]
+        else:
+            value = self._wrap(value)
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __iadd__(self, pulses):
+        self.extend(pulses)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._changed()
+        return self
+
+    def append(self, pulse):
+        list.append(self, self._wrap(pulse))
+        self._changed()
+
+    def extend(self, pulses):
+        list.extend(self, [self._wrap(pulse) for pulse in pulses])
+        self._changed()
+
+    def insert(self, index, pulse):
+        list.insert(self, index, self._wrap(pulse))
+        self._changed()
+
+    def remove(self, pulse):
+        list.remove(self, pulse)
+        self._changed()
+
+    def pop(self, *args):
+        pulse = list.pop(self, *args)
+        self._changed()
+        return pulse
+
+    def clear(self):
+        list.clear(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
 
 
 class TCUParams(object):
-    """docstring for TCUPulseParams."""
+    """docstring for TCUPulseParams.
+
+    Derived forms (integer, hex and register image) are computed once and
+    memoised until a parameter is assigned or a pulse is added, edited or
+    removed. They are shared between callers and must not be modified.
+    """
 
-    def __init__(self, headerfile, outputfile='PulseParameters.ini'):
+    def __init__(self, headerfile, outputfile='PulseParameters.ini', cache=header_cache, clk_period_ns=None):
         # clk_period_ns=10, num_pulses=1, num_repeats=1, pri_pulse_width=50, pre_pulse=30, x_amp_delay=3.5, l_amp_delay=1.0, params=list()
-        self.hfparser = HeaderFileParser(headerfile)
+        # pass cache=None to always re-read the header file
+        # clk_period_ns overrides the CLK_PERIOD_NS of the header
+        object.__setattr__(self, '_derived', dict())
         self.outputfilename = outputfile
-        params = self.hfparser.get_tcu_params()
-        self.clk_period_ns = 10
+        entry = None
+        if cache is not None:
+            try:
+                entry = cache.lookup(headerfile)
+            except OSError:
+                pass  # HeaderFileParser reports the missing file below
+        if entry is not None:
+            section, params = entry
+            self.hfparser = HeaderFileParser()
+            self.hfparser.load_section(section, headerfile)
+        else:
+            self.hfparser = HeaderFileParser(headerfile)
+            params = self.hfparser.get_tcu_params()
+        if clk_period_ns is not None:
+            params = dict(params, clk_period_ns=clk_period_ns)
+        self._load_params(params)
+
+    @classmethod
+    def for_nodes(cls, headerfile, outputfile='PulseParameters.ini', clk_period_ns=None):
+        """ returns an ordered dictionary mapping every node of a multi-node
+            header file to its TCUParams
+
+            the header is read and its shared values evaluated once for all
+            nodes, see HeaderFileParser.get_node_params(). The hfparser of
+            each TCUParams holds the values of its node, so export() writes a
+            single-node header. clk_period_ns overrides the clock period of
+            every node. raises HeaderParseError like get_tcu_params()
+        """
+        hfparser = HeaderFileParser(headerfile)
+        # the pulse table only depends on the pulses, nodes sharing them share it
+        shared_table = None
+        nodes = collections.OrderedDict()
+        for node, params in hfparser.get_node_params().items():
+            if clk_period_ns is not None:
+                params['clk_period_ns'] = clk_period_ns
+            shared_pulses = 'PULSES' not in hfparser.node_params[node]
+            tcu_params = cls.__new__(cls)
+            object.__setattr__(tcu_params, '_derived', dict())
+            tcu_params.outputfilename = outputfile
+            tcu_params.hfparser = hfparser.node_parser(node)
+            tcu_params._load_params(params, shared_table if shared_pulses else None)
+            if shared_pulses:
+                shared_table = tcu_params.pulse_table
+            nodes[node] = tcu_params
+        return nodes
+
+    def _load_params(self, params, pulse_table=None):
+        """ sets the parameters from a dictionary laid out like
+            HeaderFileParser.get_tcu_params(), pulse_table is the PulseTable
+            of its pulses if already known
+        """
+        self.clk_period_ns = params.get('clk_period_ns', DEFAULT_CLK_PERIOD_NS)
         self.num_pulses = params['num_pulses']
         self.num_repeats = params['num_repeats']
         self.pri_pulse_width = params['pri_pulse_width']
@@ -195,8 +1152,43 @@ class TCUParams(object):
         self.adc_delay = params['adc_delay']
         self.samples_per_pri = params['samples_per_pri']
         self.waveform_index = params['waveform_index']
+        if pulse_table is not None:
+            self._derived['table'] = pulse_table
+        for index, field, value in self.check_pulse_ranges():
+            self.hfparser.logger.warning('pulse {} {} register value {} does not fit in {} bytes'
+                                         .format(index, field, value, PULSE_FIELD_BYTES[field]))
+
+    def __setattr__(self, name, value):
+        if name == 'pulses':
+            value = PulseList(value, self._invalidate)
+        object.__setattr__(self, name, value)
+        self._invalidate()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_derived']
+        return state
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_derived', dict())
+        self.__dict__.update(state)
+        self.pulses = state['pulses']
+
+    def _invalidate(self):
+        self._derived.clear()
+
+    def _memoised(self, key, compute):
+        """ returns the derived value stored under key, computing it if needed """
+        try:
+            return self._derived[key]
+        except KeyError:
+            value = self._derived[key] = compute()
+            return value
 
     def __str__(self):
+        return self._memoised('str', self._to_table_str)
+
+    def _to_table_str(self):
         ptable_global = prettytable.PrettyTable()
         ptable_global.field_names = ['Parameter', 'Value', 'Hex Cycles [little endian]']
         ptable_global.align['Parameter'] = 'l'
@@ -237,6 +1229,7 @@ class TCUParams(object):
                   'adc_delay':self.adc_delay,
                   'samples_per_pri':self.samples_per_pri,
                   'waveform_index':self.waveform_index,
+                  'clk_period_ns':self.clk_period_ns,
                   'pulses':self.pulses}
         self.hfparser.set_tcu_params(params)
         self.hfparser.write_header(self.outputfilename)
@@ -284,21 +1277,21 @@ class TCUParams(object):
         print()
         print('-- <p. width>, <pri>, <mode>, <freq>')
         print()
-        for index, pulse in enumerate(self.pulses):
+        for index, pulse in enumerate(self._pulse_register_values().to_pulses()):
             print('-- pulse ' + str(index))
-            pulse_width = self._to_clock_ticks(pulse['pulse_width'])
-            pri = self._to_clock_ticks(pulse['pri'])
-            pri_offset = pri - pre_pulse - pulse_width
-            print(self._int_to_hex_str(pulse_width, big_endian=True, hdl=True) + ', ' +
+            print(self._int_to_hex_str(pulse['pulse_width'], big_endian=True, hdl=True) + ', ' +
                   # TODO: 1x32bit or 2x16bit?
-                  self._int_to_hex_str(pri_offset, big_endian=True, hdl=True) + ', ' +
-                  self._int_to_hex_str(int(pulse['pol_mode']), big_endian=True, hdl=True) + ', ' +
-                  self._int_to_hex_str(int(pulse['frequency']), big_endian=False, hdl=True) + ', ')
+                  self._int_to_hex_str(pulse['pri'], big_endian=True, hdl=True) + ', ' +
+                  self._int_to_hex_str(pulse['pol_mode'], big_endian=True, hdl=True) + ', ' +
+                  self._int_to_hex_str(pulse['frequency'], big_endian=False, hdl=True) + ', ')
         print('\nothers => x\"ffff\"')
         print('-' * 100)
 
     def get_hex_params(self, hdl_format=False):
         """returns a dictionary of parameters in hex string format"""
+        return self._memoised(('hex', hdl_format), lambda: self._hex_params(hdl_format))
+
+    def _hex_params(self, hdl_format):
         hex_params = dict()
         hex_params['num_pulses'] = self._int_to_hex_str(self.num_pulses, hdl=hdl_format, big_endian=hdl_format, bytes=4)
         hex_params['num_repeats'] = self._int_to_hex_str(self.num_repeats, hdl=hdl_format, big_endian=hdl_format)
@@ -313,19 +1306,23 @@ class TCUParams(object):
         rex_delay = (self._to_clock_ticks(self.rex_delay))
         hex_params['rex_delay'] = self._int_to_hex_str(rex_delay, hdl=hdl_format, big_endian=hdl_format)
         hex_params['pulses'] = list()
-        for index, pulse in enumerate(self.pulses):
-            pulse_width = self._to_clock_ticks(pulse['pulse_width'])
-            pri = self._to_clock_ticks(pulse['pri'])
-            pri_offset = pri - pre_pulse - pulse_width
-            hex_params['pulses'].append({'pulse_width': self._int_to_hex_str(pulse_width, hdl=hdl_format, big_endian=hdl_format),
-                                         'pri': self._int_to_hex_str(pri_offset, hdl=hdl_format, big_endian=hdl_format, bytes=4),
-                                         'pol_mode': self._int_to_hex_str(int(pulse['pol_mode']), hdl=hdl_format, big_endian=hdl_format),
-                                         'frequency': self._int_to_hex_str(int(pulse['frequency']), hdl=hdl_format, big_endian=(not hdl_format))})
+        for pulse in self._pulse_register_values().to_pulses():
+            hex_params['pulses'].append({'pulse_width': self._int_to_hex_str(pulse['pulse_width'], hdl=hdl_format, big_endian=hdl_format),
+                                         'pri': self._int_to_hex_str(pulse['pri'], hdl=hdl_format, big_endian=hdl_format, bytes=4),
+                                         'pol_mode': self._int_to_hex_str(pulse['pol_mode'], hdl=hdl_format, big_endian=hdl_format),
+                                         'frequency': self._int_to_hex_str(pulse['frequency'], hdl=hdl_format, big_endian=(not hdl_format))})
 
         return hex_params
 
+    def get_register_image(self):
+        """returns the registers.RegisterImage of the current parameters"""
+        return self._memoised('image', lambda: encode_registers(self.get_int_params()))
+
     def get_int_params(self, hdl_format=False):
         """returns a dictionary of parameters in integer format"""
+        return self._memoised('int', self._int_params)
+
+    def _int_params(self):
         int_params = dict()
         int_params['num_pulses'] = self.num_pulses
         int_params['num_repeats'] = self.num_repeats
@@ -339,22 +1336,34 @@ class TCUParams(object):
         int_params['l_amp_delay'] = l_amp_delay
         rex_delay = self._to_clock_ticks(self.rex_delay)
         int_params['rex_delay'] = rex_delay
-        int_params['pulses'] = list()
-        for index, pulse in enumerate(self.pulses):
-            pulse_width = self._to_clock_ticks(pulse['pulse_width'])
-            pri = self._to_clock_ticks(pulse['pri'])
-            pri_offset = pri - pre_pulse - pulse_width
-            int_params['pulses'].append({'pulse_width': pulse_width,
-                                         'pri': pri_offset,
-                                         'pol_mode': int(pulse['pol_mode']),
-                                         'frequency': int(pulse['frequency'])})
+        int_params['pulses'] = self._pulse_register_values().to_pulses()
 
         return int_params
 
+    def snapshot(self):
+        """returns the current parameters as a ParamsSnapshot"""
+        return self._memoised('snapshot', lambda: ParamsSnapshot.from_dict(self))
+
+    @property
+    def pulse_table(self):
+        """array-backed PulseTable of the current pulses"""
+        return self._memoised('table', lambda: PulseTable.from_pulses(self.pulses))
+
+    def _pulse_register_values(self):
+        """ returns the PulseTable of integer values loaded into reg_pulses """
+        return self._memoised('register_values', lambda: self.pulse_table.to_register_values(
+            self.clk_period_ns, self._to_clock_ticks(self.pre_pulse)))
+
+    def check_pulse_ranges(self):
+        """ returns (pulse index, field, value) for every pulse register
+            value that would not fit its field in reg_pulses
+        """
+        return self._pulse_register_values().range_violations()
+
     def _to_clock_ticks(self, x):
         """ converts a time duration into a number of clock ticks """
         # NOTE: assumes inputs are in microseconds
-        return(int(x * 1000 // self.clk_period_ns))
+        return to_clock_ticks(x, self.clk_period_ns)
 
     def _int_to_hex_str(self, num, bytes=2, big_endian=False, hdl=False):
         """ returns a hexidecimal string in format given an integer
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# planner.py
+# duration, data rates and storage of an experiment, and whether a host keeps up
+
+import argparse
+import collections
+import fractions
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import prettytable
+
+from conflicts import ADC_TICKS_PER_SAMPLE
+from parser import (DEFAULT_CLK_PERIOD_NS, HeaderParseError, ParamsSnapshot, TCUParams, clock_period_ps,
+                    to_clock_ticks)
+
+BITS_PER_SAMPLE = 32  # 16 bit I and Q
+MEGABYTE = 1024 * 1024
+
+# all quantities are exact: times are the clock ticks loaded into the
+# registers, durations and rates are fractions.Fraction (of nanoseconds, per
+# second), worked out from the clock period in whole picoseconds
+Plan = collections.namedtuple('Plan', ['num_pris', 'num_samples', 'bytes_per_sample', 'block_ticks',
+                                       'duration_ns', 'total_bytes', 'sample_rate', 'data_rate',
+                                       'peak_pri_rate', 'sampling_rate'])
+
+
+def plan(params, clk_period_ns=None, bits_per_sample=BITS_PER_SAMPLE):
+    """ returns the Plan of a TCUParams, ParamsSnapshot or dictionary laid
+        out like HeaderFileParser.get_tcu_params()
+
+        clk_period_ns defaults to that of the parameters
+
+        sample_rate is in samples per second over the whole experiment,
+        data_rate the sustained bytes per second, peak_pri_rate the bytes
+        per second over the shortest PRI and sampling_rate the bytes per
+        second while the ADC samples.
+    """
+    if isinstance(params, ParamsSnapshot):
+        params = params.to_dict()
+    elif not isinstance(params, dict):
+        params = vars(params)
+    if clk_period_ns is None:
+        clk_period_ns = params.get('clk_period_ns', DEFAULT_CLK_PERIOD_NS)
+    clk_period_ps = clock_period_ps(clk_period_ns)
+    if bits_per_sample % 8 != 0:
+        raise ValueError('bits_per_sample must be a whole number of bytes')
+    bytes_per_sample = bits_per_sample // 8
+    pulses = params['pulses'][:params['num_pulses']]
+    pri_ticks = [to_clock_ticks(pulse['pri'], clk_period_ns) for pulse in pulses]
+    block_ticks = sum(pri_ticks)
+    num_pris = len(pulses) * params['num_repeats']
+    samples_per_pri = int(params['samples_per_pri'])
+    num_samples = num_pris * samples_per_pri
+    duration_ps = block_ticks * params['num_repeats'] * clk_period_ps
+    pri_bytes = samples_per_pri * bytes_per_sample
+    if duration_ps > 0:
+        sample_rate = fractions.Fraction(num_samples * 10**12, duration_ps)
+    else:
+        sample_rate = fractions.Fraction(0)
+    shortest_ps = min(pri_ticks) * clk_period_ps if pri_ticks else 0
+    if shortest_ps > 0:
+        peak_pri_rate = fractions.Fraction(pri_bytes * 10**12, shortest_ps)
+    else:
+        peak_pri_rate = fractions.Fraction(0)
+    sampling_rate = fractions.Fraction(bytes_per_sample * 10**12, ADC_TICKS_PER_SAMPLE * clk_period_ps)
+    return Plan(num_pris, num_samples, bytes_per_sample, block_ticks, fractions.Fraction(duration_ps, 1000),
+                num_samples * bytes_per_sample, sample_rate, sample_rate * bytes_per_sample,
+                peak_pri_rate, sampling_rate)
+
+
+def format_duration(duration_ns):
+    """ returns a duration as [<days>d ]HH:MM:SS, rounded down to the second """
+    minutes, seconds = divmod(int(duration_ns // 10**9), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    text = '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    if days:
+        text = '{}d {}'.format(days, text)
+    return text
+
+
+def disk_write_rate(directory, size_bytes=256 * MEGABYTE, block_bytes=4 * MEGABYTE):
+    """ measures how fast the host writes to directory, in bytes per second
+
+        size_bytes of incompressible data are written to a temporary file
+        and flushed to disk; the file is removed afterwards
+    """
+    block = os.urandom(block_bytes)
+    written = 0
+    start_time = time.time()
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.tcu_planner.') as temp_file:
+        while written < size_bytes:
+            temp_file.write(block)
+            written += block_bytes
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+        elapsed = time.time() - start_time
+    return written / elapsed if elapsed > 0 else float('inf')
+
+
+def check_host(experiment_plan, directory, measured_rate=None):
+    """ returns the reasons directory cannot record an experiment, an empty
+        list if it can
+
+        measured_rate is a result of disk_write_rate(), the write speed is
+        not checked without it
+    """
+    problems = list()
+    free_bytes = shutil.disk_usage(directory).free
+    if free_bytes < experiment_plan.total_bytes:
+        problems.append('{:.1f} MB free in {}, {:.1f} MB needed'.format(
+            free_bytes / MEGABYTE, directory, experiment_plan.total_bytes / MEGABYTE))
+    if measured_rate is not None and measured_rate < experiment_plan.data_rate:
+        problems.append('{} writes {:.2f} MB/s, {:.2f} MB/s needed'.format(
+            directory, measured_rate / MEGABYTE, float(experiment_plan.data_rate) / MEGABYTE))
+    return problems
+
+
+def format_plans(plans):
+    """ returns a table of (name, Plan) pairs """
+    ptable = prettytable.PrettyTable()
+    ptable.field_names = ['Node', 'Duration', 'PRIs', 'Samples', 'Sustained [MB/s]',
+                          'Peak PRI [MB/s]', 'Sampling [MB/s]', 'Storage [MB]']
+    for name, experiment_plan in plans:
+        ptable.add_row([name, format_duration(experiment_plan.duration_ns), experiment_plan.num_pris,
+                        experiment_plan.num_samples,
+                        '{:.3f}'.format(float(experiment_plan.data_rate) / MEGABYTE),
+                        '{:.3f}'.format(float(experiment_plan.peak_pri_rate) / MEGABYTE),
+                        '{:.3f}'.format(float(experiment_plan.sampling_rate) / MEGABYTE),
+                        '{:.1f}'.format(experiment_plan.total_bytes / MEGABYTE)])
+    return str(ptable)
+
+
+if __name__ == '__main__':
+    clargparser = argparse.ArgumentParser(usage='planner.py [-b BITS] [-c NS] [-d DIR] HEADER',
+                                          description='Duration, data rates and storage of a '
+                                                      'NeXtRAD header file')
+    clargparser.add_argument('headerfile', help='header file to plan')
+    clargparser.add_argument('-b', '--bits-per-sample', type=int, default=BITS_PER_SAMPLE,
+                             help='recorded bits per sample [{}]'.format(BITS_PER_SAMPLE))
+    clargparser.add_argument('-c', '--clk-period', type=float, metavar='NS',
+                             help='clock period in ns [CLK_PERIOD_NS of the header, or {}]'
+                                  .format(DEFAULT_CLK_PERIOD_NS))
+    clargparser.add_argument('-d', '--directory',
+                             help='check free space of the recording directory')
+    clargparser.add_argument('-w', '--write-test', type=int, metavar='MB',
+                             help='also measure the write speed of the recording '
+                                  'directory, writing MB megabytes')
+    args = clargparser.parse_args()
+    if args.write_test and not args.directory:
+        clargparser.error('--write-test needs the recording directory (-d)')
+
+    try:
+        nodes = TCUParams.for_nodes(args.headerfile, clk_period_ns=args.clk_period)
+        if not nodes:
+            nodes = {os.path.basename(args.headerfile): TCUParams(args.headerfile, clk_period_ns=args.clk_period)}
+    except HeaderParseError as e:
+        sys.stderr.write('failed to parse header file: {}\n'.format(e))
+        sys.exit(65)
+    try:
+        plans = [(node, plan(tcu_params, bits_per_sample=args.bits_per_sample))
+                 for node, tcu_params in nodes.items()]
+    except ValueError as e:
+        clargparser.error(str(e))
+    print(format_plans(plans))
+    total_bytes = sum(experiment_plan.total_bytes for _, experiment_plan in plans)
+    print('total storage: {:.1f} MB'.format(total_bytes / MEGABYTE))
+
+    if args.directory:
+        measured_rate = None
+        if args.write_test:
+            measured_rate = disk_write_rate(args.directory, args.write_test * MEGABYTE)
+            print('{} writes {:.2f} MB/s'.format(args.directory, measured_rate / MEGABYTE))
+        # every node records on its own host, so each is checked on its own
+        num_problems = 0
+        for node, experiment_plan in plans:
+            for problem in check_host(experiment_plan, args.directory, measured_rate):
+                print('{} cannot be recorded: {}'.format(node, problem))
+                num_problems += 1
+        sys.exit(1 if num_problems else 0)
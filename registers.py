@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+# registers.py
+# byte-level layout of the TCU registers
+
+import collections
+import functools
+import re
+import struct
+
+# REGISTER LAYOUT:
+# ---------------------
+# scalar registers are little endian unsigned integers
+#
+# num_repeats      0x04
+# num_pulses       0x02
+# x_amp_delay      0x02
+# l_amp_delay      0x02
+# rex_delay        0x02
+# pri_pulse_width  0x04
+# pre_pulse        0x02
+#
+# pulses           0x8c (140 bytes), 10 bytes per pulse:
+#   [0:2]   pulse_width         little endian
+#   [2:4]   pri offset [15:0]   little endian
+#   [4:6]   pri offset [31:16]  little endian
+#   [6:8]   pol_mode            little endian
+#   [8:10]  frequency           big endian
+
+SCALAR_REGISTERS = collections.OrderedDict([('num_repeats', 'I'),
+                                            ('num_pulses', 'H'),
+                                            ('x_amp_delay', 'H'),
+                                            ('l_amp_delay', 'H'),
+                                            ('rex_delay', 'H'),
+                                            ('pri_pulse_width', 'I'),
+                                            ('pre_pulse', 'H')])
+SCALAR_STRUCT = struct.Struct('<' + ''.join(SCALAR_REGISTERS.values()))
+PULSE_STRUCT = struct.Struct('<5H')
+PULSE_FIELDS = ('pulse_width', 'pri', 'pol_mode', 'frequency')
+# width in bytes of each pulse field in the pulses register
+PULSE_FIELD_BYTES = {'pulse_width': 2, 'pri': 4, 'pol_mode': 2, 'frequency': 2}
+PULSES_REGISTER_BYTES = 140
+MAX_PULSES = PULSES_REGISTER_BYTES // PULSE_STRUCT.size
+IMAGE_BYTES = SCALAR_STRUCT.size + PULSES_REGISTER_BYTES
+
+# (offset, size) of every register within a RegisterImage buffer
+REGISTER_OFFSETS = collections.OrderedDict()
+_offset = 0
+for _name, _code in SCALAR_REGISTERS.items():
+    REGISTER_OFFSETS[_name] = (_offset, struct.calcsize('<' + _code))
+    _offset += struct.calcsize('<' + _code)
+REGISTER_OFFSETS['pulses'] = (_offset, PULSES_REGISTER_BYTES)
+del _offset, _name, _code
+
+_OD_WORD_RE = re.compile(r'^[0-9a-fA-F]{4}$')
+
+
+class RegisterImage(object):
+    """Byte image of the TCU registers for one set of parameters
+
+    All registers share one preallocated buffer. Indexing by register name
+    returns a memoryview of the bytes written to that register; for 'pulses'
+    only the 10 * num_pulses bytes in use are returned.
+    """
+
+    def __init__(self, buffer, num_pulses):
+        self.buffer = buffer
+        self.num_pulses = num_pulses
+
+    def __getitem__(self, name):
+        offset, size = REGISTER_OFFSETS[name]
+        if name == 'pulses':
+            size = self.num_pulses * PULSE_STRUCT.size
+        return memoryview(self.buffer)[offset:offset + size]
+
+    def __eq__(self, other):
+        return (isinstance(other, RegisterImage) and self.num_pulses == other.num_pulses
+                and self.buffer == other.buffer)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def keys(self):
+        return REGISTER_OFFSETS.keys()
+
+    def items(self):
+        return [(name, self[name]) for name in REGISTER_OFFSETS]
+
+    def to_bytes(self):
+        return bytes(self.buffer)
+
+
+@functools.lru_cache(maxsize=MAX_PULSES + 1)
+def _pulse_block_struct(num_pulses):
+    """ returns the precompiled layout of a block of num_pulses pulses """
+    return struct.Struct('<' + '5H' * num_pulses)
+
+
+def _swap16(value):
+    if not 0 <= value <= 0xffff:
+        return value  # left for pack_into to reject
+    return ((value & 0xff) << 8) | (value >> 8)
+
+
+def encode_registers(int_params):
+    """ returns the RegisterImage for a dictionary of integer parameters
+
+        'int_params' is laid out as returned by TCUParams.get_int_params().
+        raises ValueError if a value does not fit in its register.
+    """
+    pulses = int_params['pulses']
+    if len(pulses) > MAX_PULSES:
+        raise ValueError('{} pulses do not fit in the pulses register (max {})'
+                         .format(len(pulses), MAX_PULSES))
+    buffer = bytearray(IMAGE_BYTES)
+    values = [int_params[name] for name in SCALAR_REGISTERS]
+    pulse_values = list()
+    for pulse in pulses:
+        pri = pulse['pri']
+        pulse_values.extend((pulse['pulse_width'], pri & 0xffff, pri >> 16,
+                             pulse['pol_mode'], _swap16(pulse['frequency'])))
+    try:
+        SCALAR_STRUCT.pack_into(buffer, 0, *values)
+        _pulse_block_struct(len(pulses)).pack_into(buffer, REGISTER_OFFSETS['pulses'][0],
+                                                   *pulse_values)
+    except struct.error:
+        raise ValueError(_find_overflow(int_params))
+    return RegisterImage(buffer, len(pulses))
+
+
+def _find_overflow(int_params):
+    """ returns a message naming the first value that does not fit its register """
+    for name in SCALAR_REGISTERS:
+        size = REGISTER_OFFSETS[name][1]
+        if not 0 <= int_params[name] < 1 << (8 * size):
+            return 'register \'{}\' value {} does not fit in {} bytes'.format(name, int_params[name], size)
+    for index, pulse in enumerate(int_params['pulses']):
+        for field in PULSE_FIELDS:
+            size = PULSE_FIELD_BYTES[field]
+            if not 0 <= pulse[field] < 1 << (8 * size):
+                return 'pulse {} {} value {} does not fit in {} bytes'.format(index, field, pulse[field], size)
+    return 'register value out of range'
+
+
+def to_echo_str(data):
+    """ returns data as an escaped string for 'echo -en' """
+    return ''.join('\\x{:02x}'.format(byte) for byte in bytearray(data))
+
+
+def _word_struct(word_swapped):
+    return struct.Struct('>H' if word_swapped else '<H')
+
+
+def decode_pulses(data, num_pulses=None, word_swapped=False):
+    """ returns the list of pulse dictionaries held in a pulses register image
+
+        data is any bytes-like object and is read in place. When num_pulses
+        is None every complete pulse in data is decoded. Readbacks that
+        present the register as 16-bit words in display order (as 'od -x'
+        and harpoon's read_bytes() do) need word_swapped=True.
+    """
+    view = memoryview(data)
+    if num_pulses is None:
+        num_pulses = len(view) // PULSE_STRUCT.size
+    view = view[:num_pulses * PULSE_STRUCT.size]
+    if len(view) != num_pulses * PULSE_STRUCT.size:
+        raise ValueError('pulses register holds {} bytes, {} pulses need {}'
+                         .format(len(view), num_pulses, num_pulses * PULSE_STRUCT.size))
+    pulse_struct = struct.Struct(('>' if word_swapped else '<') + '5H')
+    pulses = list()
+    for pulse_width, pri_lower, pri_upper, pol_mode, frequency in pulse_struct.iter_unpack(view):
+        pulses.append({'pulse_width': pulse_width,
+                       'pri': pri_lower | (pri_upper << 16),
+                       'pol_mode': pol_mode,
+                       'frequency': _swap16(frequency)})
+    return pulses
+
+
+def decode_register(name, data, word_swapped=False):
+    """ returns the integer value held in a scalar register image """
+    size = REGISTER_OFFSETS[name][1]
+    view = memoryview(data)
+    if len(view) < size:
+        raise ValueError('register \'{}\' holds {} bytes, expected {}'.format(name, len(view), size))
+    words = [word for (word,) in _word_struct(word_swapped).iter_unpack(view[:size])]
+    value = 0
+    for index, word in enumerate(words):
+        value |= word << (16 * index)
+    return value
+
+
+def decode_registers(registers, word_swapped=False):
+    """ returns a dictionary of integer parameters decoded from register images
+
+        'registers' maps register names to bytes-like contents, e.g. a
+        RegisterImage. The result is laid out like TCUParams.get_int_params(),
+        restricted to the registers present; pulses are decoded using the
+        num_pulses register when available.
+    """
+    params = dict()
+    for name in SCALAR_REGISTERS:
+        if name in registers.keys():
+            params[name] = decode_register(name, registers[name], word_swapped)
+    if 'pulses' in registers.keys():
+        params['pulses'] = decode_pulses(registers['pulses'], params.get('num_pulses'), word_swapped)
+    return params
+
+
+def compare_registers(expected, actual):
+    """ returns the differences between two dictionaries of integer parameters
+
+        each mismatch is a tuple (register, pulse index, field, expected,
+        actual); pulse index and field are None for scalar registers. Only
+        registers present in both dictionaries are compared.
+    """
+    mismatches = list()
+    for name in SCALAR_REGISTERS:
+        if name in expected and name in actual and expected[name] != actual[name]:
+            mismatches.append((name, None, None, expected[name], actual[name]))
+    if 'pulses' in expected and 'pulses' in actual:
+        expected_pulses = expected['pulses']
+        actual_pulses = actual['pulses']
+        for index in range(max(len(expected_pulses), len(actual_pulses))):
+            if index >= len(expected_pulses) or index >= len(actual_pulses):
+                mismatches.append(('pulses', index, None,
+                                   expected_pulses[index] if index < len(expected_pulses) else None,
+                                   actual_pulses[index] if index < len(actual_pulses) else None))
+                continue
+            for field in PULSE_FIELDS:
+                if expected_pulses[index][field] != actual_pulses[index][field]:
+                    mismatches.append(('pulses', index, field, expected_pulses[index][field],
+                                       actual_pulses[index][field]))
+    return mismatches
+
+
+def format_mismatch(mismatch):
+    """ returns a log message for a compare_registers() mismatch """
+    name, index, field, expected, actual = mismatch
+    if index is None:
+        return 'Value mismatch for register \'{}\' retrieved {}, expected {}'.format(name, actual, expected)
+    if field is None:
+        return 'Value mismatch for register \'{}\' pulse {}: retrieved {}, expected {}'.format(
+            name, index, actual, expected)
+    return 'Value mismatch for register \'{}\' pulse {} {}: retrieved {}, expected {}'.format(
+        name, index, field, actual, expected)
+
+
+def od_words_to_bytes(text):
+    """ returns the raw bytes described by the output of 'od -x -An'
+
+        od prints 16-bit words in host (little endian) order; anything that is
+        not a 4 digit hex word, such as the echoed command or the shell
+        prompt, is ignored.
+    """
+    words = [int(token, 16) for token in text.split() if _OD_WORD_RE.match(token)]
+    return struct.pack('<{}H'.format(len(words)), *words)
+
+
+def byte_ranges(old, new):
+    """ returns the (start, stop) ranges of the bytes of new that differ from old
+
+        bytes of new past the end of old always count as changed; adjacent
+        changed bytes are merged into one range.
+    """
+    old = bytes(old)
+    new = bytes(new)
+    return _flagged_ranges([index >= len(old) or old[index] != new[index] for index in range(len(new))])
+
+
+def _flagged_ranges(flags):
+    """ returns the (start, stop) ranges of consecutive true flags """
+    ranges = list()
+    start = None
+    for index, flag in enumerate(flags):
+        if flag and start is None:
+            start = index
+        elif not flag and start is not None:
+            ranges.append((start, index))
+            start = None
+    if start is not None:
+        ranges.append((start, len(flags)))
+    return ranges
+
+
+def align_ranges(ranges, word_bytes, size):
+    """ widens (start, stop) byte ranges to whole words of word_bytes,
+        merging ranges that then touch or overlap; no range ends past size
+    """
+    aligned = list()
+    for start, stop in ranges:
+        start -= start % word_bytes
+        stop = min(size, stop + (-stop) % word_bytes)
+        if aligned and start <= aligned[-1][1]:
+            aligned[-1] = (aligned[-1][0], max(aligned[-1][1], stop))
+        else:
+            aligned.append((start, stop))
+    return aligned
+
+
+class RegisterDiff(object):
+    """Differences between two RegisterImages
+
+    registers:   OrderedDict of scalar register name -> (old, new) value
+    pulses:      compare_registers() mismatches within reg_pulses
+    byte_ranges: OrderedDict of register name -> list of (start, stop) byte
+                 ranges within that register to rewrite
+
+    Every changed register, including 'pulses', has an entry in byte_ranges.
+    """
+
+    def __init__(self, registers, pulses, byte_ranges):
+        self.registers = registers
+        self.pulses = pulses
+        self.byte_ranges = byte_ranges
+
+    def __bool__(self):
+        return bool(self.byte_ranges)
+
+    __nonzero__ = __bool__
+
+    def changed(self):
+        """ returns the names of the registers to rewrite, in layout order """
+        return list(self.byte_ranges.keys())
+
+    def messages(self):
+        """ returns a log message for every change """
+        messages = ['register \'{}\': {} -> {}'.format(name, old, new)
+                    for name, (old, new) in self.registers.items()]
+        for name, index, field, old, new in self.pulses:
+            if field is None:
+                messages.append('register \'{}\' pulse {}: {} -> {}'.format(name, index, old, new))
+            else:
+                messages.append('register \'{}\' pulse {} {}: {} -> {}'.format(name, index, field, old, new))
+        if 'pulses' in self.byte_ranges:
+            messages.append('register \'pulses\' bytes changed: {}'.format(
+                ', '.join('[{}:{}]'.format(start, stop) for start, stop in self.byte_ranges['pulses'])))
+        return messages
+
+
+def diff_images(old, new):
+    """ returns the RegisterDiff turning RegisterImage old into new
+
+        old may be None when the register contents are unknown, in which
+        case every register is reported as changed.
+    """
+    new_params = decode_registers(new)
+    if old is None:
+        registers = collections.OrderedDict((name, (None, new_params[name])) for name in SCALAR_REGISTERS)
+        pulses = [('pulses', index, None, None, pulse) for index, pulse in enumerate(new_params['pulses'])]
+        ranges = collections.OrderedDict((name, [(0, len(new[name]))]) for name in REGISTER_OFFSETS)
+        return RegisterDiff(registers, pulses, ranges)
+    old_params = decode_registers(old)
+    registers = collections.OrderedDict()
+    pulses = list()
+    for mismatch in compare_registers(old_params, new_params):
+        name, index, field, old_value, new_value = mismatch
+        if index is None:
+            registers[name] = (old_value, new_value)
+        elif index < len(new_params['pulses']):
+            pulses.append(mismatch)  # pulses that are no longer used need no rewrite
+    ranges = collections.OrderedDict()
+    for name in REGISTER_OFFSETS:
+        changed = byte_ranges(old[name], new[name])
+        if changed:
+            ranges[name] = changed
+    return RegisterDiff(registers, pulses, ranges)
+
+
+class ShadowRegisters(object):
+    """Register contents last written to the TCU and confirmed
+
+    A copy of the TCU registers as far as they are known, byte by byte.
+    Bytes are only known once a write to them succeeded (and was verified,
+    where the caller verifies); anything else, including everything after
+    the bof restarts or the connection drops, is unknown and diff() always
+    reports it as changed.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray(IMAGE_BYTES)
+        self.known = bytearray(IMAGE_BYTES)
+
+    def __bool__(self):
+        return any(self.known)
+
+    __nonzero__ = __bool__
+
+    def update(self, name, data, start=0):
+        """ records that data now fills register name from byte start """
+        offset = REGISTER_OFFSETS[name][0] + start
+        data = bytes(data)
+        self.buffer[offset:offset + len(data)] = data
+        self.known[offset:offset + len(data)] = b'\x01' * len(data)
+
+    def forget(self, name=None, start=0, stop=None):
+        """ marks bytes [start, stop) of a register (all of it by default),
+            or all registers, as unknown
+        """
+        names = REGISTER_OFFSETS.keys() if name is None else [name]
+        for name in names:
+            offset, size = REGISTER_OFFSETS[name]
+            stop_offset = offset + (size if stop is None else stop)
+            self.known[offset + start:stop_offset] = bytes(stop_offset - offset - start)
+
+    def is_known(self, name, start=0, stop=None):
+        """ returns True if bytes [start, stop) of a register (all of it by
+            default) are known
+        """
+        offset, size = REGISTER_OFFSETS[name]
+        stop = size if stop is None else stop
+        return all(self.known[offset + start:offset + stop])
+
+    def _pulse_known(self, index):
+        return self.is_known('pulses', index * PULSE_STRUCT.size, (index + 1) * PULSE_STRUCT.size)
+
+    def diff(self, image):
+        """ returns the RegisterDiff turning the shadow into RegisterImage
+            image
+
+            unknown scalar registers and pulses are reported with None as
+            their old value, unknown bytes always fall in byte_ranges
+        """
+        if not self:
+            return diff_images(None, image)
+        diff = diff_images(RegisterImage(bytearray(self.buffer), image.num_pulses), image)
+        new_params = decode_registers(image)
+        registers = collections.OrderedDict()
+        ranges = collections.OrderedDict()
+        for name in REGISTER_OFFSETS:
+            offset = REGISTER_OFFSETS[name][0]
+            new = image[name]
+            changed = _flagged_ranges([not self.known[offset + index] or self.buffer[offset + index] != byte
+                                       for index, byte in enumerate(bytes(new))])
+            if changed:
+                ranges[name] = changed
+            if name == 'pulses':
+                continue
+            if not self.is_known(name):
+                registers[name] = (None, new_params[name])
+            elif name in diff.registers:
+                registers[name] = diff.registers[name]
+        pulses = [mismatch for mismatch in diff.pulses if self._pulse_known(mismatch[1])]
+        for index, pulse in enumerate(new_params['pulses']):
+            if not self._pulse_known(index):
+                pulses.append(('pulses', index, None, None, pulse))
+        pulses.sort(key=lambda mismatch: mismatch[1])
+        return RegisterDiff(registers, pulses, ranges)
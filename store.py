@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# store.py
+# content-addressed store of compiled register images
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # not available on windows, entries are still written atomically
+    fcntl = None
+
+from hdl import write_vhdl_package
+from parser import HeaderFileParser, HeaderParseError, TCUParams, read_pulse_parameters
+from registers import IMAGE_BYTES, RegisterImage, decode_register, decode_registers
+from validation import format_violation, split_violations, validate
+
+# STORE LAYOUT:
+# ---------------------
+# <root>/<key>/image.bin       register image, see registers.py
+# <root>/<key>/summary.json    decoded registers and header parameters
+# <root>/<key>/registers_pkg.vhd
+#
+# key is the sha1 of STORE_FORMAT, the normalised [PulseParameters] values
+# and the clock period. Entries are built in a temporary directory and
+# renamed into place, so readers only ever see complete entries. The
+# modification time of an entry is its last use, eviction removes the least
+# recently used entries.
+
+DEFAULT_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'tcu_store')
+
+IMAGE_FILE = 'image.bin'
+SUMMARY_FILE = 'summary.json'
+VHDL_FILE = 'registers_pkg.vhd'
+
+# version of the compiled output (tick conversion, register encoding); bump
+# it whenever the same header compiles differently, so older entries are
+# no longer found and age out of the store
+# 2: durations converted to clock ticks exactly, see parser.py TICK MODEL
+STORE_FORMAT = 2
+
+
+
+class StoreEntry(object):
+    """A compiled header in the store
+
+    image is the registers.RegisterImage; the summary (decoded registers and
+    header parameters) is only read from the store when first used.
+    """
+
+    def __init__(self, key, image, entry_dir, summary=None):
+        self.key = key
+        self.image = image
+        self.entry_dir = entry_dir
+        self.vhdl_file = os.path.join(entry_dir, VHDL_FILE)
+        self._summary = summary
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            with open(os.path.join(self.entry_dir, SUMMARY_FILE)) as summary_file:
+                self._summary = json.load(summary_file)
+        return self._summary
+
+    @property
+    def warnings(self):
+        """ returns the validation warnings of the header, see validation.WARNING_RULES """
+        return self.summary.get('warnings', [])
+
+
+def params_key(pulse_params, clk_period_ns=10):
+    """ returns the store key of the raw [PulseParameters] values held by a
+        HeaderFileParser
+
+        values are compared without surrounding whitespace and regardless of
+        the order of the keys in the file, so reformatting a header keeps
+        its key. Keys change with STORE_FORMAT
+    """
+    digest = hashlib.sha1('format={}\0clk_period_ns={}\0'.format(STORE_FORMAT, clk_period_ns).encode('utf-8'))
+    for key in sorted(pulse_params):
+        digest.update(key.encode('utf-8') + b'\0' + pulse_params[key].strip().encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+class RegisterStore(object):
+    """Local store of compiled register images, keyed on header contents
+
+    Safe for use by several processes at once: entries appear atomically and
+    eviction is serialised with a lock file where the platform supports it.
+    At most max_entries entries and, if given, max_bytes bytes are kept.
+    """
+
+    def __init__(self, root=None, max_entries=256, max_bytes=None):
+        self.logger = logging.getLogger('tcu_store_logger')
+        self.root = root or os.environ.get('TCU_STORE_DIR', DEFAULT_ROOT)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.root, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """ returns the StoreEntry stored under key, or None """
+        entry_dir = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, IMAGE_FILE), 'rb') as image_file:
+                buffer = bytearray(image_file.read())
+            os.utime(entry_dir)
+        except OSError:
+            return None  # missing, or evicted while reading
+        if len(buffer) != IMAGE_BYTES:
+            return None
+        num_pulses = decode_register('num_pulses', RegisterImage(buffer, 0)['num_pulses'])
+        return StoreEntry(key, RegisterImage(buffer, num_pulses), entry_dir)
+
+    def put(self, key, tcu_params, source=None, warnings=()):
+        """ stores the compiled form of tcu_params under key, with the
+            formatted validation warnings of the header
+
+            raises ValueError if the parameters cannot be encoded
+        """
+        image = tcu_params.get_register_image()
+        summary = {'num_pulses': image.num_pulses,
+                   'clk_period_ns': tcu_params.clk_period_ns,
+                   'source': source,
+                   'registers': decode_registers(image),
+                   'params': tcu_params.snapshot().to_dict(),
+                   'warnings': list(warnings)}
+        os.makedirs(self.root, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=self.root, prefix='.' + key + '.')
+        try:
+            with open(os.path.join(temp_dir, IMAGE_FILE), 'wb') as image_file:
+                image_file.write(image.buffer)
+            with open(os.path.join(temp_dir, SUMMARY_FILE), 'w') as summary_file:
+                json.dump(summary, summary_file, indent=2, sort_keys=True)
+            write_vhdl_package(image, os.path.join(temp_dir, VHDL_FILE), 'tcu_registers_pkg',
+                               tcu_params.clk_period_ns, source)
+            with self._locked():
+                try:
+                    os.rename(temp_dir, self.entry_dir(key))
+                except OSError:
+                    pass  # stored by another process in the meantime
+                self._evict()
+        finally:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        return StoreEntry(key, image, self.entry_dir(key), summary)
+
+    def load(self, file_name, clk_period_ns=None):
+        """ returns the StoreEntry of a header file, compiling and storing it
+            if it is not in the store yet
+
+            clk_period_ns overrides the CLK_PERIOD_NS of the header
+
+            on a hit only the [PulseParameters] section is read, nothing is
+            evaluated or encoded. raises HeaderParseError if the header
+            cannot be parsed or breaks a validation rule; rules in
+            validation.WARNING_RULES are kept in the entry's warnings instead.
+        """
+        try:
+            with open(file_name) as header_file:
+                section = read_pulse_parameters(header_file)
+        except OSError as e:
+            raise HeaderParseError('could not read header file: {}'.format(e), file_name)
+        if section is None:
+            raise HeaderParseError('no "PulseParameters" section found', file_name)
+        hfparser = HeaderFileParser()
+        hfparser.load_section(section, file_name)
+        if clk_period_ns is None:
+            clk_period_ns = hfparser.clk_period_ns()
+        entry = self.get(params_key(hfparser.pulse_params, clk_period_ns))
+        if entry is not None:
+            self.logger.debug('store hit for "{}" [{}]'.format(file_name, entry.key))
+            return entry
+        self.logger.debug('store miss for "{}"'.format(file_name))
+        tcu_params = TCUParams(file_name, clk_period_ns=clk_period_ns)
+        # keyed on what was parsed, in case the file changed since it was read
+        key = params_key(tcu_params.hfparser.pulse_params, clk_period_ns)
+        header_violations, header_warnings = split_violations(validate(tcu_params))
+        if header_violations:
+            raise HeaderParseError('; '.join(format_violation(violation) for violation in header_violations),
+                                   file_name)
+        try:
+            return self.put(key, tcu_params, os.path.abspath(file_name),
+                            [format_violation(violation) for violation in header_warnings])
+        except ValueError as e:
+            raise HeaderParseError(str(e), file_name)
+
+    def entries(self):
+        """ returns (last use, bytes, key) of every entry, least recently used first """
+        entries = list()
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return entries
+        for name in names:
+            entry_dir = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, file_name))
+                           for file_name in os.listdir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime_ns, size, name))
+            except OSError:
+                continue
+        entries.sort()
+        return entries
+
+    def _evict(self):
+        """ removes least recently used entries beyond the limits, with the lock held """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or
+                           (self.max_bytes is not None and total > self.max_bytes)):
+            _, size, key = entries.pop(0)
+            self._remove(key)
+            total -= size
+            self.logger.debug('evicted store entry {}'.format(key))
+
+    def _remove(self, key):
+        # renamed first so readers never see a partly deleted entry
+        doomed = tempfile.mkdtemp(dir=self.root, prefix='.evicted.')
+        try:
+            os.rename(self.entry_dir(key), os.path.join(doomed, key))
+        except OSError:
+            pass
+        shutil.rmtree(doomed, ignore_errors=True)
+
+    def clear(self):
+        with self._locked():
+            for _, _, key in self.entries():
+                self._remove(key)
+
+
+register_store = RegisterStore()
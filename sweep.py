@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# sweep.py
+# generates families of experiments from a base header file
+
+import argparse
+import copy
+import csv
+import itertools
+import logging
+import os
+import os.path
+import sys
+import time
+
+from compiler import pool_map
+from parser import HeaderFileParser, HeaderParseError
+from registers import encode_registers
+from validation import ParameterBatch, check_batch, format_violation, valid_mask, violations
+
+logger = logging.getLogger('tcu_sweep_logger')
+
+# parameters that can be swept:
+#   pri, frequency  ->  set on every pulse
+#   pol_mode        ->  sequence of modes, one pulse per mode; the pulses of the
+#                       base header are repeated to match its length
+#   num_repeats, waveform_index, pre_pulse, pri_pulse_width
+SWEEP_PARAMETERS = ('pri', 'pol_mode', 'frequency', 'num_repeats', 'waveform_index',
+                    'pre_pulse', 'pri_pulse_width')
+
+REPORT_FIELDS = ['index', 'status', 'header', 'image', 'message']
+
+
+def product_sweep(axes):
+    """ yields every combination of the values of axes, an ordered list of
+        (parameter, values) pairs, as a dictionary of overrides
+    """
+    names = [name for name, _ in axes]
+    for values in itertools.product(*[values for _, values in axes]):
+        yield dict(zip(names, values))
+
+
+def zip_sweep(axes):
+    """ yields the n-th values of all axes together, stopping at the shortest """
+    names = [name for name, _ in axes]
+    for values in zip(*[values for _, values in axes]):
+        yield dict(zip(names, values))
+
+
+def apply_overrides(base_params, overrides):
+    """ returns a copy of params laid out like HeaderFileParser.get_tcu_params()
+        with the swept parameters set
+    """
+    unknown = set(overrides) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError('cannot sweep {}'.format(', '.join(sorted(unknown))))
+    params = dict(base_params)
+    pulses = [dict(pulse) for pulse in base_params['pulses']]
+    if 'pol_mode' in overrides:
+        modes = overrides['pol_mode']
+        pulses = [dict(pulses[index % len(pulses)], pol_mode=mode) for index, mode in enumerate(modes)]
+        params['num_pulses'] = len(pulses)
+    for field in ('pri', 'frequency'):
+        if field in overrides:
+            for pulse in pulses:
+                pulse[field] = overrides[field]
+    for name in ('num_repeats', 'waveform_index', 'pre_pulse', 'pri_pulse_width'):
+        if name in overrides:
+            params[name] = overrides[name]
+    params['pulses'] = pulses
+    return params
+
+
+def iter_valid_blocks(base_params, points, block_size=256, clk_period_ns=10):
+    """ yields the configurations of a sweep in validated blocks
+
+        points are consumed block_size at a time and each block is validated
+        with one vectorised check, so invalid configurations are dropped
+        before any file is written. A block is a list of (index, params,
+        None) for valid configurations and (index, None, message) for
+        rejected ones.
+    """
+    points = enumerate(points)
+    while True:
+        block = [(index, apply_overrides(base_params, overrides))
+                 for index, overrides in itertools.islice(points, block_size)]
+        if not block:
+            return
+        results = check_batch(ParameterBatch.from_params([params for _, params in block], clk_period_ns))
+        valid = valid_mask(results).tolist()
+        messages = dict()
+        for violation in violations(results):
+            messages.setdefault(violation.candidate, list()).append(format_violation(violation))
+        yield [(index, params, None) if valid[row] else (index, None, '; '.join(messages[row]))
+               for row, (index, params) in enumerate(block)]
+
+
+def write_block(block, template, output_dir, headers=True, images=True, clk_period_ns=10):
+    """ writes the header file and/or register image of every valid
+        configuration in a block from iter_valid_blocks(), returning a
+        report row for each configuration, rejected ones included
+    """
+    # failures are returned in the results, not logged by each worker
+    logging.getLogger('header_file_parser_logger').setLevel(logging.CRITICAL)
+    rows = [{'index': index, 'status': 'invalid', 'header': '', 'image': '', 'message': message}
+            for index, params, message in block if params is None]
+    block = [(index, params) for index, params, _ in block if params is not None]
+    if not block:
+        return rows
+    registers = ParameterBatch.from_params([params for _, params in block], clk_period_ns).register_values()
+    for row, (index, params) in enumerate(block):
+        result = {'index': index, 'status': 'error', 'header': '', 'image': '', 'message': ''}
+        base_name = os.path.join(output_dir, 'sweep_{:06d}'.format(index))
+        try:
+            if headers:
+                hfparser = HeaderFileParser()
+                hfparser.file_name = template
+                hfparser.set_tcu_params(params)
+                hfparser.write_header(base_name + '.ini')
+                result['header'] = base_name + '.ini'
+            if images:
+                num_pulses = params['num_pulses']
+                int_params = dict((name, int(values[row])) for name, values in registers.items()
+                                  if name != 'pulses')
+                int_params['pulses'] = [dict((field, int(values[row, column]))
+                                             for field, values in registers['pulses'].items())
+                                        for column in range(num_pulses)]
+                image = encode_registers(int_params)
+                with open(base_name + '.bin', 'wb') as image_file:
+                    image_file.write(image.buffer)
+                result['image'] = base_name + '.bin'
+        except (OSError, ValueError) as e:
+            result['message'] = str(e)
+        else:
+            result['status'] = 'ok'
+        rows.append(result)
+    return rows
+
+
+def run_sweep(base_header, points, output_dir, headers=True, images=True, jobs=None,
+              block_size=256, window=None):
+    """ validates and writes the configurations of a sweep over base_header
+
+        yields a report row per configuration as blocks complete. Blocks are
+        validated here and written by a process pool with at most 'window'
+        blocks in flight, so memory use does not grow with the size of the
+        sweep.
+    """
+    hfparser = HeaderFileParser(base_header)
+    base_params = hfparser.get_tcu_params()
+    base_params = copy.deepcopy(dict(base_params))
+    os.makedirs(output_dir, exist_ok=True)
+    clk_period_ns = base_params['clk_period_ns']
+    tasks = ((block, base_header, output_dir, headers, images, clk_period_ns)
+             for block in iter_valid_blocks(base_params, points, block_size, clk_period_ns))
+    for rows in pool_map(write_block, tasks, jobs, window):
+        for row in rows:
+            yield row
+
+
+def parse_values(text, cast=float):
+    """ parses a comma separated list of values, or start:stop:step """
+    if ':' in text:
+        start, stop, step = [cast(value) for value in text.split(':')]
+        values = list()
+        value = start
+        while value <= stop:
+            values.append(value)
+            value += step
+        return values
+    return [cast(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+
+    # -------------------------------------------------------------------------
+    # PARSE COMMAND LINE ARGUMENTS
+    # -------------------------------------------------------------------------
+    clargparser = argparse.ArgumentParser(usage='sweep.py [options] -o DIR HEADER',
+                                          description='Parameter sweep generator for '
+                                                      'NeXtRAD header files')
+    clargparser.add_argument('headerfile', help='base header file of the sweep')
+    clargparser.add_argument('-o', '--outputdir', required=True,
+                             help='directory for the generated files')
+    clargparser.add_argument('--pri', help='PRIs in us, "500,1000" or "500:2000:250"')
+    clargparser.add_argument('--pol-mode',
+                             help='pol_mode sequences separated by ";", e.g. "4,5;6,7"')
+    clargparser.add_argument('--frequency', help='frequencies in MHz')
+    clargparser.add_argument('--num-repeats', help='numbers of repeats')
+    clargparser.add_argument('--waveform-index', help='waveform indices')
+    clargparser.add_argument('--pre-pulse', help='pre pulse durations in us')
+    clargparser.add_argument('--pri-pulse-width', help='PRI pulse widths in us')
+    clargparser.add_argument('-z', '--zip', action='store_true', default=False,
+                             help='step all swept parameters together instead of '
+                                  'taking every combination')
+    clargparser.add_argument('--no-headers', action='store_true', default=False,
+                             help='only write register images')
+    clargparser.add_argument('--no-images', action='store_true', default=False,
+                             help='only write header files')
+    clargparser.add_argument('-r', '--report', default='sweep_report.csv',
+                             help='summary report [./sweep_report.csv]')
+    clargparser.add_argument('-j', '--jobs', type=int, default=None,
+                             help='number of worker processes [cpu count]')
+    args = clargparser.parse_args()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logger.addHandler(console)
+    logger.setLevel(logging.INFO)
+
+    axes = list()
+    if args.pri:
+        axes.append(('pri', parse_values(args.pri)))
+    if args.pol_mode:
+        axes.append(('pol_mode', [parse_values(modes, int) for modes in args.pol_mode.split(';')]))
+    if args.frequency:
+        axes.append(('frequency', parse_values(args.frequency)))
+    if args.num_repeats:
+        axes.append(('num_repeats', parse_values(args.num_repeats, int)))
+    if args.waveform_index:
+        axes.append(('waveform_index', parse_values(args.waveform_index, int)))
+    if args.pre_pulse:
+        axes.append(('pre_pulse', parse_values(args.pre_pulse)))
+    if args.pri_pulse_width:
+        axes.append(('pri_pulse_width', parse_values(args.pri_pulse_width)))
+    if not axes:
+        clargparser.error('nothing to sweep')
+    points = zip_sweep(axes) if args.zip else product_sweep(axes)
+
+    counts = {'ok': 0, 'invalid': 0, 'error': 0}
+    start_time = time.time()
+    try:
+        with open(args.report, 'w', newline='') as report_file:
+            report = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+            report.writeheader()
+            for row in run_sweep(args.headerfile, points, args.outputdir,
+                                 headers=not args.no_headers, images=not args.no_images,
+                                 jobs=args.jobs):
+                report.writerow(row)
+                counts[row['status']] += 1
+                if row['status'] == 'error':
+                    logger.error('configuration {}: {}'.format(row['index'], row['message']))
+    except HeaderParseError as e:
+        logger.error('failed to parse base header file: {}'.format(e))
+        sys.exit(65)
+    elapsed = time.time() - start_time
+
+    total = sum(counts.values())
+    logger.info('swept {} configuration(s): {} written, {} invalid, {} failed in {:.2f}s '
+                '({:.1f} configurations/s), report written to {}'.format(
+                    total, counts['ok'], counts['invalid'], counts['error'], elapsed,
+                    total / elapsed if elapsed > 0 else 0.0, args.report))
+    sys.exit(0 if counts['error'] == 0 else 65)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# timeline.py
+# cycle-accurate event timeline of an experiment, generated in numpy chunks
+
+import argparse
+import sys
+import numpy
+import prettytable
+
+from parser import DEFAULT_CLK_PERIOD_NS, TCUParams
+
+# TIMELINE MODEL:
+# ---------------------
+# all times are in clock ticks (clk_period_ns) from the start of the first PRI
+#
+# PRI start          pre-pulse begins
+# main bang          PRI start + pre_pulse
+# main bang end      main bang + pulse_width
+# amplifier off      main bang end + x_amp_delay (pol_mode 4+, X-band)
+#                    main bang end + l_amp_delay (pol_mode 0-3, L-band)
+# REX                main bang end + rex_delay
+# DAC trigger        main bang + dac_delay
+# ADC trigger        main bang + adc_delay
+# next PRI start     main bang end + PRI offset
+#
+# dac_delay and adc_delay are header values in clock ticks, every other
+# value is converted to clock ticks the way it is loaded into the registers
+
+PRI_START = 0
+MAIN_BANG = 1
+MAIN_BANG_END = 2
+X_AMP_OFF = 3
+L_AMP_OFF = 4
+REX = 5
+DAC = 6
+ADC = 7
+EVENT_NAMES = ('pri_start', 'main_bang', 'main_bang_end', 'x_amp_off',
+               'l_amp_off', 'rex', 'dac', 'adc')
+EVENTS_PER_PRI = 7  # one amplifier switches off per PRI
+
+EVENT_DTYPE = numpy.dtype([('tick', numpy.int64),
+                           ('pri', numpy.uint32),
+                           ('pulse', numpy.uint8),
+                           ('pol_mode', numpy.uint8),
+                           ('event', numpy.uint8)])
+
+PRI_DTYPE = numpy.dtype([('tick', numpy.int64),
+                         ('repeat', numpy.uint32),
+                         ('pulse', numpy.uint8),
+                         ('pol_mode', numpy.uint8),
+                         ('frequency', numpy.float64)])
+
+L_BAND_MODES = 4  # pol_mode 0-3 are L-band, 4 and up X-band
+
+
+class Timeline(object):
+    """Event timeline of all num_pulses * num_repeats PRIs of an experiment
+
+    Events are ordered by PRI, and by tick within a PRI. The relative event
+    times of every pulse are computed once, so any range of the timeline can
+    be generated directly with a few array operations and nothing is held
+    per PRI.
+    """
+
+    def __init__(self, tcu_params):
+        registers = tcu_params.get_int_params()
+        num_pulses = registers['num_pulses']
+        if num_pulses > len(registers['pulses']):
+            raise ValueError('num_pulses is {} but only {} pulses are defined'
+                             .format(num_pulses, len(registers['pulses'])))
+        self.clk_period_ns = tcu_params.clk_period_ns
+        self.num_pulses = num_pulses
+        self.num_repeats = registers['num_repeats']
+        self.num_pris = num_pulses * self.num_repeats
+
+        pulses = registers['pulses'][:num_pulses]
+        pulse_width = numpy.array([pulse['pulse_width'] for pulse in pulses], dtype=numpy.int64)
+        pri_offset = numpy.array([pulse['pri'] for pulse in pulses], dtype=numpy.int64)
+        self.pol_mode = numpy.array([pulse['pol_mode'] for pulse in pulses], dtype=numpy.uint8)
+        l_band = self.pol_mode < L_BAND_MODES
+
+        main_bang = numpy.full(num_pulses, registers['pre_pulse'], dtype=numpy.int64)
+        main_bang_end = main_bang + pulse_width
+        amp_delay = numpy.where(l_band, registers['l_amp_delay'], registers['x_amp_delay'])
+        offsets = numpy.column_stack([numpy.zeros(num_pulses, dtype=numpy.int64),
+                                      main_bang,
+                                      main_bang_end,
+                                      main_bang_end + amp_delay,
+                                      main_bang_end + registers['rex_delay'],
+                                      main_bang + int(tcu_params.dac_delay),
+                                      main_bang + int(tcu_params.adc_delay)])
+        codes = numpy.column_stack([numpy.full(num_pulses, PRI_START),
+                                    numpy.full(num_pulses, MAIN_BANG),
+                                    numpy.full(num_pulses, MAIN_BANG_END),
+                                    numpy.where(l_band, L_AMP_OFF, X_AMP_OFF),
+                                    numpy.full(num_pulses, REX),
+                                    numpy.full(num_pulses, DAC),
+                                    numpy.full(num_pulses, ADC)]).astype(numpy.uint8)
+        order = numpy.argsort(offsets, axis=1, kind='mergesort')
+        rows = numpy.arange(num_pulses)[:, None]
+        self.offsets = offsets[rows, order]
+        self.codes = codes[rows, order]
+
+        # PRI lengths in ticks and start of each pulse's PRI within a repeat
+        self.pri_ticks = main_bang_end + pri_offset
+        self.pri_start = numpy.concatenate(([0], numpy.cumsum(self.pri_ticks)[:-1])).astype(numpy.int64)
+        self.repeat_ticks = int(self.pri_ticks.sum())
+
+    def __len__(self):
+        return self.num_pris * EVENTS_PER_PRI
+
+    @property
+    def duration_ticks(self):
+        """ length of the experiment in clock ticks """
+        return self.repeat_ticks * self.num_repeats
+
+    def events(self, start, stop):
+        """ returns events [start, stop) of the timeline as an EVENT_DTYPE array """
+        start = max(0, start)
+        stop = min(len(self), stop)
+        index = numpy.arange(start, max(start, stop), dtype=numpy.int64)
+        pri, slot = numpy.divmod(index, EVENTS_PER_PRI)
+        repeat, pulse = numpy.divmod(pri, max(self.num_pulses, 1))
+        events = numpy.empty(len(index), dtype=EVENT_DTYPE)
+        events['tick'] = repeat * self.repeat_ticks + self.pri_start[pulse] + self.offsets[pulse, slot]
+        events['pri'] = pri
+        events['pulse'] = pulse
+        events['pol_mode'] = self.pol_mode[pulse]
+        events['event'] = self.codes[pulse, slot]
+        return events
+
+    def chunks(self, chunk_size=65536):
+        """ yields the timeline as EVENT_DTYPE arrays of chunk_size events
+
+            only the last chunk may be shorter
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        for start in range(0, len(self), chunk_size):
+            yield self.events(start, start + chunk_size)
+
+
+class PRIIndex(object):
+    """Maps PRI numbers to pulses and clock ticks to PRI numbers
+
+    Lookups use the periodicity of the pulse block: PRI n is pulse
+    n % num_pulses of repeat n // num_pulses, so both directions take
+    constant time regardless of the length of the experiment. Every lookup
+    accepts a scalar or an array of PRI numbers or ticks.
+    """
+
+    def __init__(self, tcu_params):
+        self.timeline = Timeline(tcu_params)
+        num_pulses = self.timeline.num_pulses
+        self.frequency = numpy.array([pulse['frequency'] for pulse in tcu_params.pulses[:num_pulses]],
+                                     dtype=numpy.float64)
+
+    def __len__(self):
+        return self.timeline.num_pris
+
+    def _check_pri(self, pri):
+        pri = numpy.asarray(pri, dtype=numpy.int64)
+        if numpy.any((pri < 0) | (pri >= len(self))):
+            raise IndexError('PRI number out of range [0, {})'.format(len(self)))
+        return pri
+
+    def pri_table(self, pri):
+        """ returns the PRI_DTYPE records of the given PRI numbers """
+        pri = self._check_pri(pri)
+        timeline = self.timeline
+        repeat, pulse = numpy.divmod(pri, max(timeline.num_pulses, 1))
+        records = numpy.empty(pri.shape, dtype=PRI_DTYPE)
+        records['tick'] = repeat * timeline.repeat_ticks + timeline.pri_start[pulse]
+        records['repeat'] = repeat
+        records['pulse'] = pulse
+        records['pol_mode'] = timeline.pol_mode[pulse]
+        records['frequency'] = self.frequency[pulse]
+        return records
+
+    def pri_at(self, tick):
+        """ returns the number of the PRI running at the given clock tick """
+        tick = numpy.asarray(tick, dtype=numpy.int64)
+        timeline = self.timeline
+        if numpy.any((tick < 0) | (tick >= timeline.duration_ticks)):
+            raise IndexError('tick out of range [0, {})'.format(timeline.duration_ticks))
+        repeat, within = numpy.divmod(tick, timeline.repeat_ticks)
+        pulse = numpy.searchsorted(timeline.pri_start, within, side='right') - 1
+        return repeat * timeline.num_pulses + pulse
+
+    def lookup(self, tick):
+        """ returns the PRI_DTYPE records of the PRIs running at the given ticks """
+        return self.pri_table(self.pri_at(tick))
+
+    def export(self, file_name, chunk_size=65536):
+        """ writes the record of every PRI to a .npy file, chunk by chunk
+
+            returns the file opened as a read-only memory map, see
+            load_pri_table()
+        """
+        table = numpy.lib.format.open_memmap(file_name, mode='w+', dtype=PRI_DTYPE, shape=(len(self),))
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            table[start:stop] = self.pri_table(numpy.arange(start, stop))
+        table.flush()
+        del table
+        return load_pri_table(file_name)
+
+
+def load_pri_table(file_name):
+    """ returns a PRI table written by PRIIndex.export() as a read-only memory map
+
+        indexing the table with a PRI number returns its PRI_DTYPE record
+    """
+    return numpy.load(file_name, mmap_mode='r')
+
+
+def iter_timeline(tcu_params, chunk_size=65536):
+    """ yields the event timeline of tcu_params in fixed-size numpy chunks """
+    return Timeline(tcu_params).chunks(chunk_size)
+
+
+if __name__ == '__main__':
+    clargparser = argparse.ArgumentParser(usage='timeline.py [-o FILE] [-p NPY] [-c CHUNK] [--clk-period NS] HEADER',
+                                          description='Cycle-accurate event timeline '
+                                                      'of a NeXtRAD header file')
+    clargparser.add_argument('headerfile', help='header file to generate the timeline of')
+    clargparser.add_argument('-o', '--output',
+                             help='write all events as csv to this file, '
+                                  'only the first PRIs are displayed if not given')
+    clargparser.add_argument('-p', '--pri-table',
+                             help='export the per PRI table to this .npy file')
+    clargparser.add_argument('-c', '--chunk', type=int, default=65536,
+                             help='events per chunk [65536]')
+    clargparser.add_argument('--clk-period', type=float, metavar='NS',
+                             help='clock period in ns [CLK_PERIOD_NS of the header, or {}]'
+                                  .format(DEFAULT_CLK_PERIOD_NS))
+    args = clargparser.parse_args()
+
+    tcu_params = TCUParams(args.headerfile, clk_period_ns=args.clk_period)
+    timeline = Timeline(tcu_params)
+    if args.pri_table:
+        PRIIndex(tcu_params).export(args.pri_table, args.chunk)
+    if args.output:
+        with open(args.output, 'wb') as output_file:
+            output_file.write(','.join(EVENT_DTYPE.names).encode() + b'\n')
+            for chunk in timeline.chunks(args.chunk):
+                numpy.savetxt(output_file, chunk, fmt='%d', delimiter=',')
+    else:
+        ptable = prettytable.PrettyTable()
+        ptable.field_names = ['Tick', 'Time [us]', 'PRI', 'Pulse', 'Mode', 'Event']
+        for event in timeline.events(0, 2 * timeline.num_pulses * EVENTS_PER_PRI):
+            ptable.add_row([event['tick'], event['tick'] * timeline.clk_period_ns / 1000.0,
+                            event['pri'], event['pulse'], event['pol_mode'],
+                            EVENT_NAMES[event['event']]])
+        print(ptable)
+    sys.stdout.write('{} PRIs, {} events, {} ticks ({:.6f} s)\n'.format(
+        timeline.num_pris, len(timeline), timeline.duration_ticks,
+        timeline.duration_ticks * timeline.clk_period_ns * 1e-9))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# validation.py
+# checks that TCU parameters describe an experiment the TCU can run
+
+import collections
+import numpy
+
+from conflicts import find_conflicts
+from parser import ParamsSnapshot, to_clock_ticks
+from registers import MAX_PULSES, PULSE_FIELD_BYTES, PULSE_FIELDS, REGISTER_OFFSETS, SCALAR_REGISTERS
+from timeline import L_BAND_MODES
+
+# frequency bands in MHz, see Creator.update_frequency_band(); the band of
+# a pulse follows its pol_mode, see timeline.L_BAND_MODES
+L_BAND_MHZ = (1235, 1365)
+X_BAND_MHZ = (8500, 9200)
+
+# scalar registers that hold a time converted to clock ticks
+TIME_REGISTERS = ('pri_pulse_width', 'pre_pulse', 'x_amp_delay', 'l_amp_delay', 'rex_delay')
+
+# a broken rule: 'candidate' is the index of the configuration in its batch,
+# 'pulse' the pulse index or None for rules on scalar parameters
+Violation = collections.namedtuple('Violation', ['rule', 'candidate', 'pulse', 'field', 'value', 'message'])
+
+
+class ParameterBatch(object):
+    """Parameters of many candidate configurations as arrays
+
+    Scalar parameters are arrays of shape (N,) and pulse fields arrays of
+    shape (N, P), holding values in header units (microseconds and MHz,
+    adc_delay in clock ticks and samples_per_pri in samples). Candidates with fewer than P pulses set num_defined accordingly; the
+    padding is never checked.
+    """
+
+    SCALARS = ('num_pulses', 'num_repeats') + TIME_REGISTERS + ('adc_delay', 'samples_per_pri')
+
+    def __init__(self, scalars, pulses, num_defined, clk_period_ns=10):
+        for name in self.SCALARS:
+            setattr(self, name, numpy.asarray(scalars[name]))
+        for field in PULSE_FIELDS:
+            setattr(self, field, numpy.asarray(pulses[field]))
+        self.num_defined = numpy.asarray(num_defined)
+        self.clk_period_ns = clk_period_ns
+
+    @classmethod
+    def from_params(cls, params_list, clk_period_ns=10):
+        """ builds a batch from TCUParams, ParamsSnapshots or dictionaries
+            laid out like HeaderFileParser.get_tcu_params()
+        """
+        params_list = [params.to_dict() if isinstance(params, ParamsSnapshot) else
+                       params if isinstance(params, dict) else vars(params) for params in params_list]
+        num_defined = [len(params['pulses']) for params in params_list]
+        width = max(num_defined + [1])
+        scalars = dict((name, [params[name] for params in params_list]) for name in cls.SCALARS)
+        pulses = dict()
+        for field in PULSE_FIELDS:
+            column = numpy.zeros((len(params_list), width), dtype=numpy.float64)
+            for row, params in enumerate(params_list):
+                column[row, :len(params['pulses'])] = [pulse[field] for pulse in params['pulses']]
+            pulses[field] = column
+        return cls(scalars, pulses, num_defined, clk_period_ns)
+
+    def __len__(self):
+        return len(self.num_pulses)
+
+    def active(self):
+        """ returns the (N, P) mask of the pulses loaded into reg_pulses """
+        loaded = numpy.minimum(self.num_pulses, self.num_defined)
+        return numpy.arange(self.pulse_width.shape[1]) < loaded[:, None]
+
+    def register_values(self):
+        """ returns the integer register values of every candidate as arrays
+
+            laid out like TCUParams.get_int_params(), with the pulses as a
+            dictionary of (N, P) arrays. Nothing is range checked.
+        """
+        values = dict()
+        values['num_pulses'] = self.num_pulses.astype(numpy.int64)
+        values['num_repeats'] = self.num_repeats.astype(numpy.int64)
+        for name in TIME_REGISTERS:
+            values[name] = to_clock_ticks(getattr(self, name), self.clk_period_ns)
+        pulse_width = to_clock_ticks(self.pulse_width, self.clk_period_ns)
+        pri_offset = (to_clock_ticks(self.pri, self.clk_period_ns) - values['pre_pulse'][:, None] -
+                      pulse_width)
+        values['pulses'] = {'pulse_width': pulse_width,
+                            'pri': pri_offset,
+                            'pol_mode': self.pol_mode.astype(numpy.int64),
+                            'frequency': self.frequency.astype(numpy.int64)}
+        return values
+
+
+def _out_of_range(values, size):
+    return (values < 0) | (values >= 1 << (8 * size))
+
+
+def _rule_num_pulses(batch, registers):
+    num_pulses = registers['num_pulses']
+    return [('num_pulses', (num_pulses < 1) | (num_pulses > MAX_PULSES), num_pulses,
+             'num_pulses must be between 1 and {}'.format(MAX_PULSES))]
+
+
+def _rule_pulses_defined(batch, registers):
+    return [('num_pulses', registers['num_pulses'] > batch.num_defined, registers['num_pulses'],
+             'more pulses enabled than defined')]
+
+
+def _rule_register_range(batch, registers):
+    checks = list()
+    for name in SCALAR_REGISTERS:
+        size = REGISTER_OFFSETS[name][1]
+        checks.append((name, _out_of_range(registers[name], size), registers[name],
+                       'does not fit in {} bytes'.format(size)))
+    return checks
+
+
+def _rule_pri_offset(batch, registers):
+    pri_offset = registers['pulses']['pri']
+    return [('pri', pri_offset < 0, pri_offset, 'PRI shorter than pre_pulse + pulse_width')]
+
+
+def _rule_pulse_register_range(batch, registers):
+    checks = list()
+    for field in PULSE_FIELDS:
+        values = registers['pulses'][field]
+        size = PULSE_FIELD_BYTES[field]
+        mask = values >= 1 << (8 * size) if field == 'pri' else _out_of_range(values, size)
+        checks.append((field, mask, values, 'does not fit in {} bytes'.format(size)))
+    return checks
+
+
+def _rule_frequency_band(batch, registers):
+    frequency = batch.frequency
+    l_band = batch.pol_mode < L_BAND_MODES
+    in_band = numpy.where(l_band,
+                          (frequency >= L_BAND_MHZ[0]) & (frequency <= L_BAND_MHZ[1]),
+                          (frequency >= X_BAND_MHZ[0]) & (frequency <= X_BAND_MHZ[1]))
+    return [('frequency', ~in_band, frequency, 'outside the band of its pol_mode')]
+
+
+def _rule_timing_conflicts(batch, registers):
+    return find_conflicts(batch, registers)
+
+
+# rule name -> (applies to pulses, check); checks return a list of
+# (field, violation mask, values, message) computed for the whole batch
+RULES = collections.OrderedDict([
+    ('num_pulses', (False, _rule_num_pulses)),
+    ('pulses_defined', (False, _rule_pulses_defined)),
+    ('register_range', (False, _rule_register_range)),
+    ('pri_offset', (True, _rule_pri_offset)),
+    ('pulse_register_range', (True, _rule_pulse_register_range)),
+    ('frequency_band', (True, _rule_frequency_band)),
+    ('timing_conflicts', (True, _rule_timing_conflicts)),
+])
+
+# rules whose violations are only warned about when arming: the timing
+# conflict model assumes one ADC sample per clock tick (see conflicts.py),
+# which is not confirmed for the TCU
+WARNING_RULES = ('timing_conflicts',)
+
+
+def check_batch(batch, rules=None):
+    """ evaluates rules on every candidate of a ParameterBatch at once
+
+        returns a list of (rule, field, mask, values, message) where mask
+        marks the candidates (shape (N,)) or pulses (shape (N, P)) breaking
+        the rule. Pulses that are not loaded into reg_pulses are never marked.
+    """
+    registers = batch.register_values()
+    active = batch.active()
+    results = list()
+    for rule in rules or RULES:
+        per_pulse, check = RULES[rule]
+        for field, mask, values, message in check(batch, registers):
+            if per_pulse:
+                mask = mask & active
+            results.append((rule, field, mask, values, message))
+    return results
+
+
+def valid_mask(results):
+    """ returns the (N,) mask of candidates that break none of the checked rules """
+    valid = None
+    for rule, field, mask, values, message in results:
+        broken = mask.any(axis=1) if mask.ndim == 2 else mask
+        valid = ~broken if valid is None else valid & ~broken
+    return valid
+
+
+def violations(results):
+    """ returns the Violations found by check_batch() as a list """
+    found = list()
+    for rule, field, mask, values, message in results:
+        for index in numpy.argwhere(mask).tolist():
+            candidate = index[0]
+            pulse = index[1] if len(index) > 1 else None
+            value = values[tuple(index)].item()
+            found.append(Violation(rule, candidate, pulse, field, value, message))
+    found.sort(key=lambda violation: (violation.candidate, -1 if violation.pulse is None else violation.pulse))
+    return found
+
+
+def validate(tcu_params, rules=None):
+    """ returns the list of Violations of a single TCUParams """
+    batch = ParameterBatch.from_params([tcu_params], tcu_params.clk_period_ns)
+    return violations(check_batch(batch, rules))
+
+
+def split_violations(found):
+    """ returns (errors, warnings) of a list of Violations, see WARNING_RULES """
+    errors = [violation for violation in found if violation.rule not in WARNING_RULES]
+    warnings = [violation for violation in found if violation.rule in WARNING_RULES]
+    return errors, warnings
+
+
+def format_violation(violation):
+    """ returns a log message for a Violation """
+    if violation.pulse is None:
+        return '{} {}: {}'.format(violation.field, violation.value, violation.message)
+    return 'pulse {} {} {}: {}'.format(violation.pulse, violation.field, violation.value, violation.message)